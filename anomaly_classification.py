@@ -0,0 +1,157 @@
+"""
+Anomaly Classification Module
+Normalizes the free-text Severity and Anomaly values of inspection data into a
+canonical severity level (small int) and a canonical anomaly type. Values are
+classified in bulk: each distinct spelling is matched once, then mapped back
+over the whole array, so ingest and backfills cost one regex pass per spelling.
+"""
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Severity level codes stored on anomaly records as severity_level
+SEVERITY_UNKNOWN = 0
+SEVERITY_LOW = 1
+SEVERITY_MEDIUM = 2
+SEVERITY_HIGH = 3
+
+# Display name of each code (index = code)
+SEVERITY_LEVELS = ('Unknown', 'Low', 'Medium', 'High')
+
+# Chart order and colors of the known levels
+SEVERITY_COLORS = {
+    'High': '#DC2626',
+    'Medium': '#F59E0B',
+    'Low': '#10B981'
+}
+
+# First matching pattern wins, so "high" outranks "monitoring" etc.
+_SEVERITY_PATTERNS = (
+    (SEVERITY_HIGH, r'high|critical|severe|major|error|remediation recommended|^(?:level\s*)?3$'),
+    (SEVERITY_MEDIUM, r'medium|moderate|warning|monitor\s*&\s*remediate|^(?:level\s*)?2$'),
+    (SEVERITY_LOW, r'low|minor|info|long-term monitoring|^(?:level\s*)?1$'),
+)
+
+# Canonical anomaly types (the spelling used by the audit page) and their colors
+ANOMALY_TYPE_COLORS = {
+    'Cell': '#FF0000',
+    'Multi Cell': '#FFA500',
+    'Bypass Diode': '#9C27B0',
+    'Short Circuit': '#506E9A',
+    'String Offline': '#FF1A94',
+    'Partial String Offline': '#FF66C4',
+    'Module Power Mismatch': '#65E667',
+    'Module Offline': '#545454',
+    'Module Missing': '#5CE1E6',
+    'Shading': '#E77148',
+    'Vegetation': '#2E7D32',
+    'Junction Box': '#BFC494',
+    'Physical Damage': '#C2185B',
+    'Other': '#8C52FF'
+}
+
+# Other spellings found in reports, keyed like _type_key
+_ANOMALY_TYPE_ALIASES = {
+    'cell hotspot': 'Cell',
+    'single cell': 'Cell',
+    'hotspot': 'Cell',
+    'multi cell hotspot': 'Multi Cell',
+    'multicell': 'Multi Cell',
+    'diode': 'Bypass Diode',
+    'jbox': 'Junction Box',
+    'junction box failure': 'Junction Box',
+    'damage': 'Physical Damage',
+    'power mismatch': 'Module Power Mismatch',
+}
+
+UNKNOWN_TYPE = 'Unknown'
+
+_ANOMALY_TYPE_KEYS = dict({name.lower(): name for name in ANOMALY_TYPE_COLORS}, **_ANOMALY_TYPE_ALIASES)
+
+
+def _clean(values):
+    """Raw values as a categorical of stripped, lower-cased strings ('' for missing)"""
+    series = pd.Series(values, dtype='object')
+    return pd.Categorical(series.where(series.notna(), '').astype(str).str.strip().str.lower())
+
+
+def severity_codes(values):
+    """Severity level code (int8) for every raw severity value"""
+    categorical = _clean(values)
+    categories = pd.Series(categorical.categories, dtype='object')
+    category_codes = np.full(len(categories), SEVERITY_UNKNOWN, dtype=np.int8)
+    # Lowest precedence first so higher ones overwrite it
+    for code, pattern in reversed(_SEVERITY_PATTERNS):
+        category_codes[categories.str.contains(pattern, regex=True).to_numpy(dtype=bool)] = code
+    return category_codes[categorical.codes]
+
+
+def _type_key(value):
+    return re.sub(r'[\s_-]+', ' ', value).strip()
+
+
+def anomaly_types(values):
+    """Canonical anomaly type for every raw value (unrecognized types keep their tidied spelling)"""
+    series = pd.Series(values, dtype='object')
+    categorical = pd.Categorical(series.where(series.notna(), '').astype(str))
+    labels = []
+    for raw in categorical.categories:
+        key = _type_key(raw)
+        labels.append(_ANOMALY_TYPE_KEYS.get(key.lower()) or key or UNKNOWN_TYPE)
+    return np.asarray(labels + [UNKNOWN_TYPE], dtype=object)[categorical.codes]
+
+
+@lru_cache(maxsize=1024)
+def severity_code(value):
+    return int(severity_codes([value])[0])
+
+
+def severity_level(value):
+    """'High', 'Medium', 'Low' or 'Unknown' for one raw severity"""
+    return SEVERITY_LEVELS[severity_code(value)]
+
+
+@lru_cache(maxsize=1024)
+def anomaly_type(value):
+    return anomaly_types([value])[0]
+
+
+def classify_records(records):
+    """Set severity_level and anomaly_type on anomaly records (dicts with Severity/Anomaly) in place"""
+    if not records:
+        return records
+    codes = severity_codes([record.get('Severity') for record in records])
+    types = anomaly_types([record.get('Anomaly') for record in records])
+    for record, code, type_name in zip(records, codes, types):
+        record['severity_level'] = int(code)
+        record['anomaly_type'] = type_name
+    return records
+
+
+def backfill_classification(anomalies_collection, query=None):
+    """
+    Classify records written before classification existed. Each distinct
+    Severity / Anomaly spelling is classified once and written with update_many.
+    Returns the number of records that got a severity level.
+    """
+    query = dict(query or {})
+    updated = 0
+    missing_level = dict(query, severity_level={'$exists': False})
+    raw_severities = anomalies_collection.distinct('Severity', missing_level)
+    for raw, code in zip(raw_severities, severity_codes(raw_severities)):
+        updated += anomalies_collection.update_many(
+            dict(missing_level, Severity=raw), {'$set': {'severity_level': int(code)}}
+        ).modified_count
+    # Records without a Severity field at all
+    updated += anomalies_collection.update_many(
+        missing_level, {'$set': {'severity_level': SEVERITY_UNKNOWN}}
+    ).modified_count
+
+    missing_type = dict(query, anomaly_type={'$exists': False})
+    raw_types = anomalies_collection.distinct('Anomaly', missing_type)
+    for raw, type_name in zip(raw_types, anomaly_types(raw_types)):
+        anomalies_collection.update_many(dict(missing_type, Anomaly=raw), {'$set': {'anomaly_type': type_name}})
+    anomalies_collection.update_many(missing_type, {'$set': {'anomaly_type': UNKNOWN_TYPE}})
+    return updated
@@ -0,0 +1,297 @@
+"""
+Anomaly Listing Module
+Keyset (cursor) paginated, field-projected listing of anomaly records with
+server-side sort and filters. Results are streamed as JSON so neither the
+server nor the client holds the whole result set.
+"""
+import base64
+import json
+from datetime import datetime
+
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from anomaly_store import build_feature_query, record_to_feature
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# Fields a client may sort on (within an audit)
+SORT_FIELDS = ('seq', 'Block', 'Anomaly', 'Severity', 'resolve_status', 'detected_at')
+
+# BSON sort order of the value types these fields hold; missing sorts as null
+_TYPE_ORDER = (
+    ('null', None),
+    ('number', ['double', 'int', 'long']),
+    ('string', ['string']),
+    ('objectId', ['objectId']),
+    ('bool', ['bool']),
+    ('date', ['date']),
+)
+
+# Top level fields a client may project (properties.<name> is allowed too)
+PROJECTABLE_FIELDS = ('audit_id', 'plant_id', 'seq', 'Block', 'Anomaly', 'Severity', 'image_name',
+                      'resolve_status', 'geometry', 'location', 'properties', 'detected_at',
+                      'status_updated_at')
+
+# Projection used when the client does not ask for specific fields
+DEFAULT_FIELDS = ('audit_id', 'seq', 'Block', 'Anomaly', 'Severity', 'image_name', 'resolve_status')
+
+
+# Listing filters and the fields hand-reported anomalies (manual_anomalies) keep them in
+MANUAL_FILTERS = (('audit_id', 'audit_id'), ('plant_id', 'plant_id'), ('block', 'block'), ('type', 'type'),
+                  ('severity', 'severity'), ('resolve_status', 'status'))
+
+
+class ListingError(ValueError):
+    """Invalid listing parameters (reported to the client as a 400)"""
+
+
+def ensure_listing_indexes(anomalies_collection):
+    """
+    (audit_id, field, _id) for every sort field, so a keyset page is an index
+    range scan, and (plant_id, _id) for plant wide listings (seq uses audit_seq)
+    """
+    for field in SORT_FIELDS:
+        if field != 'seq':
+            anomalies_collection.create_index(
+                [('audit_id', ASCENDING), (field, ASCENDING), ('_id', ASCENDING)],
+                name=f'listing_audit_{field}'
+            )
+    anomalies_collection.create_index([('plant_id', ASCENDING), ('_id', ASCENDING)], name='listing_plant')
+
+
+def ensure_manual_indexes(manual_anomalies_collection):
+    """Hand-reported anomalies of an audit / of a plant in insertion order"""
+    manual_anomalies_collection.create_index([('audit_id', ASCENDING), ('_id', ASCENDING)], name='manual_audit')
+    manual_anomalies_collection.create_index([('plant_id', ASCENDING), ('_id', ASCENDING)], name='manual_plant')
+
+
+def manual_query(args):
+    """The listing's audit_id / plant_id and filters as a query on manual_anomalies"""
+    return {field: args[param] for param, field in MANUAL_FILTERS if args.get(param)}
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(value):
+    """Compact JSON used for streamed items"""
+    return json.dumps(value, default=_json_default, separators=(',', ':'))
+
+
+def encode_cursor(sort_value, record_id):
+    """Opaque cursor holding the sort value and _id of the last record returned"""
+    raw = json_util.dumps({'v': sort_value, 'id': record_id})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        data = json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return data['v'], data['id']
+    except (ValueError, KeyError, TypeError):
+        raise ListingError('Invalid cursor')
+
+
+def parse_fields(fields_param):
+    """fields=a,b,properties.X -> Mongo projection"""
+    if not fields_param:
+        fields = DEFAULT_FIELDS
+    else:
+        fields = [f.strip() for f in fields_param.split(',') if f.strip()]
+    projection = {}
+    for field in fields:
+        if field not in PROJECTABLE_FIELDS and not (field.startswith('properties.') and len(field) > 11):
+            raise ListingError(f'Unknown field: {field}')
+        projection[field] = 1
+    return projection
+
+
+def parse_sort(sort_param):
+    """sort=field or sort=-field (descending)"""
+    sort_param = sort_param or 'seq'
+    direction = DESCENDING if sort_param.startswith('-') else ASCENDING
+    field = sort_param.lstrip('-')
+    if field not in SORT_FIELDS:
+        raise ListingError(f'Cannot sort by: {field}')
+    return field, direction
+
+
+def _type_rank(value):
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 4
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, ObjectId):
+        return 3
+    if isinstance(value, datetime):
+        return 5
+    raise ListingError('Invalid cursor')
+
+
+def _type_condition(field, ranks):
+    """Records whose field has one of the given _TYPE_ORDER ranks"""
+    conditions = [{field: {'$type': bson_type}}
+                  for rank in ranks if _TYPE_ORDER[rank][1] for bson_type in _TYPE_ORDER[rank][1]]
+    if 0 in ranks:
+        conditions.append({field: None})
+    return conditions
+
+
+def _keyset_condition(field, direction, last_value, last_id):
+    """
+    Records strictly after (last_value, last_id) in (field, _id) order, as plain
+    range conditions the (audit_id, field, _id) index answers. Query comparisons
+    only match values of the same type, so values of the types the sort puts
+    after (or before) last_value's type, e.g. text block labels after numeric
+    ones, are matched by type.
+    """
+    op = '$gt' if direction == ASCENDING else '$lt'
+    rank = _type_rank(last_value)
+    later = range(rank + 1, len(_TYPE_ORDER)) if direction == ASCENDING else range(rank)
+    conditions = [{field: last_value, '_id': {op: last_id}}]
+    if last_value is not None:
+        conditions.append({field: {op: last_value}})
+    conditions.extend(_type_condition(field, list(later)))
+    return {'$or': conditions}
+
+
+def build_listing(args):
+    """Validate request args and return (query, projection, sort, limit, sort_field)"""
+    try:
+        limit = min(max(int(args.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except ValueError:
+        raise ListingError('Invalid limit')
+
+    audit_id = args.get('audit_id')
+    if not audit_id and not args.get('plant_id'):
+        raise ListingError('audit_id or plant_id is required')
+    if not audit_id and args.get('sort') not in (None, '', 'seq'):
+        raise ListingError('Sorting needs audit_id; plant wide listings are in insertion order')
+    query = build_feature_query(
+        audit_id,
+        block=args.get('block'),
+        anomaly=args.get('type'),
+        severity=args.get('severity'),
+        resolve_status=args.get('resolve_status')
+    ) if audit_id else {}
+    if not audit_id:
+        # Plant wide listing with the same filters
+        for param, field in (('block', 'Block'), ('type', 'Anomaly'), ('severity', 'Severity'),
+                             ('resolve_status', 'resolve_status')):
+            if args.get(param):
+                query[field] = args[param]
+    if args.get('plant_id'):
+        query['plant_id'] = args['plant_id']
+
+    projection = parse_fields(args.get('fields'))
+    sort_field, direction = parse_sort(args.get('sort'))
+
+    if not audit_id:
+        # seq restarts in every audit: plant wide pages follow the (plant_id, _id) index
+        sort_field = '_id'
+    if args.get('cursor'):
+        last_value, last_id = decode_cursor(args['cursor'])
+        op = '$gt' if direction == ASCENDING else '$lt'
+        if sort_field == 'seq':
+            # seq is unique within an audit, a plain range keeps the audit_seq index
+            query['seq'] = {op: last_value}
+        elif sort_field == '_id':
+            query['_id'] = {op: last_id}
+        else:
+            query.update(_keyset_condition(sort_field, direction, last_value, last_id))
+
+    if sort_field in ('seq', '_id'):
+        sort = [(sort_field, direction)]
+    else:
+        sort = [(sort_field, direction), ('_id', direction)]
+
+    # The cursor needs the sort value even when the client did not ask for it
+    projection[sort_field] = 1
+    return query, projection, sort, limit, sort_field
+
+
+def stream_listing(anomalies_collection, args, items_key='anomalies', manual_collection=None):
+    """
+    Generator yielding one JSON document:
+    {"success": true, "<items_key>": [...], "next_cursor": "..." | null}
+    With manual_collection, the last page (next_cursor null) is followed by every
+    matching hand-reported anomaly, whole and marked "manual": true.
+    Raises ListingError before yielding anything if the args are invalid.
+    """
+    query, projection, sort, limit, sort_field = build_listing(args)
+    cursor = (anomalies_collection.find(query, projection)
+              .sort(sort)
+              .limit(limit + 1)
+              .batch_size(min(limit + 1, 500)))
+
+    def generate():
+        yield '{"success":true,"' + items_key + '":['
+        count = 0
+        last = None
+        has_more = False
+        for record in cursor:
+            if count == limit:
+                has_more = True
+                break
+            if count:
+                yield ','
+            yield dumps(record)
+            last = record
+            count += 1
+        if not has_more and manual_collection is not None:
+            for record in manual_collection.find(manual_query(args)).sort('_id', ASCENDING):
+                if count:
+                    yield ','
+                record['manual'] = True
+                yield dumps(record)
+                count += 1
+        next_cursor = encode_cursor(last.get(sort_field), last['_id']) if has_more and last else None
+        yield '],"next_cursor":' + dumps(next_cursor) + '}'
+
+    return generate()
+
+
+def stream_features_by_block(anomalies_collection, audit_id):
+    """
+    Generator yielding {"success": true, "blocks": {"<block>": [feature, ...]}} one
+    block at a time. Each block is read with the (audit_id, Block) index in seq order.
+    Returns None when the audit has no anomalies with a block.
+    """
+    blocks = {}
+    for block in anomalies_collection.distinct('Block', {'audit_id': str(audit_id)}):
+        if block is not None and block != '':
+            # 1 and "1" end up under the same JSON key
+            blocks.setdefault(str(block), []).append(block)
+    if not blocks:
+        return None
+
+    def generate():
+        yield '{"success":true,"blocks":{'
+        for index, (label, values) in enumerate(blocks.items()):
+            if index:
+                yield ','
+            yield dumps(label) + ':['
+            cursor = anomalies_collection.find(
+                {'audit_id': str(audit_id), 'Block': {'$in': values}},
+                {'properties': 1, 'geometry': 1, 'resolve_status': 1}
+            ).sort('seq', ASCENDING)
+            for position, record in enumerate(cursor):
+                if position:
+                    yield ','
+                yield dumps(record_to_feature(record))
+            yield ']'
+        yield '}}'
+
+    return generate()
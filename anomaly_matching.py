@@ -0,0 +1,134 @@
+"""
+Anomaly Matching Module
+Matches an audit's anomalies to the plant's previous audit by module identity
+(anomaly_store.module_key) with one $lookup, and stores whether each
+anomaly is new or recurring so the map and lists can filter on it
+"""
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from anomaly_trends import audit_date
+
+RECURRENCE_NEW = 'new'
+RECURRENCE_RECURRING = 'recurring'
+# No module identity or position: cannot be matched
+RECURRENCE_UNKNOWN = 'unknown'
+RECURRENCE_VALUES = (RECURRENCE_NEW, RECURRENCE_RECURRING, RECURRENCE_UNKNOWN)
+
+# Record ids per update_many when applying the classification
+UPDATE_BATCH_SIZE = 1000
+
+# Module keys listed in the stored summary as resolved since the previous audit
+MAX_LISTED_MODULES = 200
+
+
+def _plant_audit_order(audits_collection, audit):
+    """(date, _id) of the audit and of the plant's other audits"""
+    candidates = audits_collection.find(
+        {'plant_id': audit['plant_id'], '_id': {'$ne': audit['_id']}},
+        {'start_date': 1, 'completion_date': 1, 'created_at': 1}
+    )
+    return (audit_date(audit), audit['_id']), [(audit_date(candidate), candidate['_id']) for candidate in candidates]
+
+
+def previous_audit(audits_collection, audit):
+    """The plant's audit that took place before this one (None for the first audit)"""
+    current, others = _plant_audit_order(audits_collection, audit)
+    earlier = [entry for entry in others if entry < current]
+    return max(earlier)[1] if earlier else None
+
+
+def next_audit(audits_collection, audit):
+    """The plant's audit that took place after this one: the one whose previous_audit it is"""
+    current, others = _plant_audit_order(audits_collection, audit)
+    later = [entry for entry in others if entry > current]
+    return min(later)[1] if later else None
+
+
+def _matched_ids(anomalies_collection, audit_id, other_audit_id, matched):
+    """
+    Ids of the audit's keyed records that do (matched=True) or do not have a record
+    on the same module in other_audit_id, plus their module keys
+    """
+    pipeline = [
+        {'$match': {'audit_id': str(audit_id), 'module_key': {'$type': 'string'}}},
+        {'$project': {'module_key': 1}},
+        # MongoDB 5.0+ answers the let/$expr equalities below from the audit_module_key
+        # index; older servers scan the collection once per keyed record
+        {'$lookup': {
+            'from': anomalies_collection.name,
+            'let': {'key': '$module_key'},
+            'pipeline': [
+                {'$match': {'$expr': {'$and': [{'$eq': ['$audit_id', str(other_audit_id)]},
+                                               {'$eq': ['$module_key', '$$key']}]}}},
+                {'$limit': 1},
+                {'$project': {'_id': 1}}
+            ],
+            'as': 'match'
+        }},
+        {'$match': {'match.0': {'$exists': matched}}},
+        {'$project': {'module_key': 1}}
+    ]
+    return [(row['_id'], row['module_key']) for row in anomalies_collection.aggregate(pipeline)]
+
+
+def _set_recurrence(anomalies_collection, ids, value):
+    for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+        anomalies_collection.update_many({'_id': {'$in': ids[start:start + UPDATE_BATCH_SIZE]}},
+                                         {'$set': {'recurrence': value}})
+
+
+def classify_recurrence(anomalies_collection, audits_collection, audit_id, cascade=True):
+    """
+    Mark every anomaly of the audit new / recurring / unknown against the previous
+    audit and store the counts (plus modules fixed since then) on the audit.
+    With cascade the plant's next audit, now compared against this one (e.g. an
+    older audit added late), is classified again too.
+    Returns the stored recurrence summary.
+    """
+    audit = audits_collection.find_one({'_id': ObjectId(audit_id)},
+                                       {'plant_id': 1, 'start_date': 1, 'completion_date': 1, 'created_at': 1})
+    if not audit:
+        raise ValueError(f'Audit not found: {audit_id}')
+    audit_id = str(audit['_id'])
+    previous_id = previous_audit(audits_collection, audit)
+
+    anomalies_collection.update_many({'audit_id': audit_id, 'module_key': {'$not': {'$type': 'string'}}},
+                                     {'$set': {'recurrence': RECURRENCE_UNKNOWN}})
+    anomalies_collection.update_many({'audit_id': audit_id, 'module_key': {'$type': 'string'}},
+                                     {'$set': {'recurrence': RECURRENCE_NEW}})
+    recurring = []
+    resolved_modules = []
+    if previous_id:
+        recurring = [record_id for record_id, _ in
+                     _matched_ids(anomalies_collection, audit_id, previous_id, matched=True)]
+        _set_recurrence(anomalies_collection, recurring, RECURRENCE_RECURRING)
+        # Same join the other way round: previous anomalies with nothing on their module now
+        resolved_modules = sorted({key for _, key in
+                                   _matched_ids(anomalies_collection, previous_id, audit_id, matched=False)})
+
+    counts = {value: 0 for value in RECURRENCE_VALUES}
+    for row in anomalies_collection.aggregate([
+        {'$match': {'audit_id': audit_id}},
+        {'$group': {'_id': '$recurrence', 'count': {'$sum': 1}}}
+    ]):
+        if row['_id'] in counts:
+            counts[row['_id']] = row['count']
+
+    summary = dict(counts,
+                   previous_audit_id=str(previous_id) if previous_id else None,
+                   resolved_since_previous=len(resolved_modules),
+                   resolved_modules=resolved_modules[:MAX_LISTED_MODULES],
+                   computed_at=datetime.utcnow())
+    # New version: cached features and tiles pick up the recurrence field
+    audits_collection.update_one({'_id': audit['_id']},
+                                 {'$set': {'recurrence_summary': summary}, '$inc': {'anomalies_version': 1}})
+    print(f"🔁 Recurrence for audit {audit_id}: {counts[RECURRENCE_NEW]} new, "
+          f"{counts[RECURRENCE_RECURRING]} recurring, {len(resolved_modules)} module(s) fixed since "
+          f"{previous_id or 'no previous audit'}")
+    if cascade:
+        following_id = next_audit(audits_collection, audit)
+        if following_id:
+            classify_recurrence(anomalies_collection, audits_collection, following_id, cascade=False)
+    return summary
@@ -0,0 +1,430 @@
+"""
+Anomaly Storage Module
+Stores one MongoDB document per GeoJSON anomaly feature so audit pages and
+chart endpoints can use indexed queries instead of parsing the whole audit blob
+"""
+import re
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, GEOSPHERE, InsertOne, UpdateOne
+from pymongo.errors import OperationFailure
+
+from anomaly_classification import classify_records
+
+# Number of records written per insert_many round trip
+INSERT_BATCH_SIZE = 1000
+
+# Statuses a field crew can set on an anomaly
+RESOLVE_STATUSES = ('pending', 'resolved')
+
+# Upper bound on anomalies updated by one bulk status request
+MAX_BULK_STATUS_UPDATES = 5000
+
+# Fields the chart/overview endpoints need - everything else stays on disk
+SUMMARY_FIELDS = {'Block': 1, 'Anomaly': 1, 'Severity': 1, 'resolve_status': 1,
+                  'severity_level': 1, 'anomaly_type': 1}
+
+# Below this map zoom viewport queries return centroid points instead of full geometries
+CENTROID_MAX_ZOOM = 16
+
+# Upper bound on features returned for one viewport request
+MAX_VIEWPORT_FEATURES = 5000
+
+# Grid used to match anomalies without a module identity by position (about 1 m)
+MODULE_GRID_DEGREES = 0.00001
+
+# Inspection list page size (default / maximum)
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+
+def ensure_anomaly_indexes(anomalies_collection):
+    """Create the compound indexes used by the audit read paths (idempotent)"""
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('Block', ASCENDING), ('Anomaly', ASCENDING),
+         ('Severity', ASCENDING), ('resolve_status', ASCENDING)],
+        name='audit_block_anomaly_severity_status'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('Anomaly', ASCENDING)],
+        name='audit_anomaly'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('Severity', ASCENDING)],
+        name='audit_severity'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('severity_level', ASCENDING)],
+        name='audit_severity_level'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('module_key', ASCENDING)],
+        name='audit_module_key'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('recurrence', ASCENDING)],
+        name='audit_recurrence'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('resolve_status', ASCENDING)],
+        name='audit_resolve_status'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('seq', ASCENDING)],
+        name='audit_seq'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('image_name', ASCENDING)],
+        name='audit_image_name'
+    )
+    anomalies_collection.create_index(
+        [('audit_id', ASCENDING), ('location', GEOSPHERE)],
+        name='audit_location'
+    )
+
+
+def is_anomaly_feature(feature):
+    """True if the GeoJSON feature carries an anomaly (same rule add_audit always used)"""
+    return (feature.get('properties') or {}).get('Anomaly') is not None
+
+
+def _iter_positions(coordinates):
+    """Yield every [lon, lat] position of a GeoJSON coordinates array"""
+    if not isinstance(coordinates, (list, tuple)) or not coordinates:
+        return
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for part in coordinates:
+        yield from _iter_positions(part)
+
+
+def feature_centroid(feature):
+    """
+    Bounding-box centre of a feature as a GeoJSON Point, falling back to the
+    Latitude/Longitude properties. Returns None when no valid position exists.
+    """
+    lon = lat = None
+    geometry = feature.get('geometry') or {}
+    positions = list(_iter_positions(geometry.get('coordinates')))
+    if positions:
+        try:
+            lons = [float(p[0]) for p in positions]
+            lats = [float(p[1]) for p in positions]
+            lon = (min(lons) + max(lons)) / 2
+            lat = (min(lats) + max(lats)) / 2
+        except (TypeError, ValueError, IndexError):
+            lon = lat = None
+    if lon is None:
+        properties = feature.get('properties') or {}
+        try:
+            lon = float(properties.get('Longitude'))
+            lat = float(properties.get('Latitude'))
+        except (TypeError, ValueError):
+            return None
+    # 2dsphere rejects out of range coordinates, skip them instead of failing the insert
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        return None
+    return {'type': 'Point', 'coordinates': [lon, lat]}
+
+
+def bbox_to_polygon(bbox):
+    """
+    Convert [min_lon, min_lat, max_lon, max_lat] into a GeoJSON Polygon for
+    $geoWithin. Returns None for viewports too large to be a useful filter.
+    """
+    min_lon, min_lat, max_lon, max_lat = [float(v) for v in bbox]
+    min_lon, max_lon = max(min(min_lon, max_lon), -180), min(max(min_lon, max_lon), 180)
+    min_lat, max_lat = max(min(min_lat, max_lat), -90), min(max(min_lat, max_lat), 90)
+    # Polygons spanning a hemisphere are ambiguous on the sphere, just skip the filter
+    if max_lon - min_lon >= 180 or max_lat - min_lat >= 90:
+        return None
+    return {
+        'type': 'Polygon',
+        'coordinates': [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat],
+                         [min_lon, max_lat], [min_lon, min_lat]]]
+    }
+
+
+def _module_part(value):
+    """Block/String/panel/barcode value reduced to A-Z, 0-9 and dashes ('007' and '7' match)"""
+    if value is None:
+        return ''
+    text = re.sub(r'[^0-9A-Za-z]+', '-', str(value)).strip('-').upper()
+    if text.isdigit():
+        text = text.lstrip('0') or '0'
+    return text
+
+
+def module_key(properties, location=None):
+    """
+    Normalized identity of the module an anomaly sits on, comparable across audits:
+    Block/String/panel when all are known, else the barcode, else the centroid
+    rounded to MODULE_GRID_DEGREES. None when there is nothing to go on.
+    """
+    parts = [_module_part(properties.get(field)) for field in ('Block', 'String', 'panel')]
+    if all(parts):
+        return 'B{}:S{}:P{}'.format(*parts)
+    barcode = _module_part(properties.get('barcode'))
+    if barcode:
+        return f'SN:{barcode}'
+    if location:
+        lon, lat = location['coordinates']
+        # Integer grid cells: keys stay free of '.', so they can be summary map keys
+        return f'LL:{round(lat / MODULE_GRID_DEGREES)}:{round(lon / MODULE_GRID_DEGREES)}'
+    return None
+
+
+def feature_to_record(feature, audit_id, plant_id, seq, detected_at=None):
+    """Convert a GeoJSON feature into an anomaly record"""
+    properties = feature.get('properties') or {}
+    record = {
+        'audit_id': str(audit_id),
+        'plant_id': str(plant_id),
+        'seq': seq,
+        'Block': properties.get('Block'),
+        'Anomaly': properties.get('Anomaly'),
+        'Severity': properties.get('Severity'),
+        'image_name': properties.get('Image name'),
+        'resolve_status': feature.get('resolve_status', 'pending'),
+        'geometry': feature.get('geometry'),
+        'properties': properties,
+        'detected_at': detected_at or datetime.utcnow()
+    }
+    location = feature_centroid(feature)
+    if location:
+        record['location'] = location
+    record['module_key'] = module_key(properties, location)
+    return record
+
+
+def record_to_feature(record, centroid=False):
+    """
+    Rebuild the GeoJSON feature the templates and map expect from a record.
+    With centroid=True the geometry is replaced by the stored centre point.
+    """
+    geometry = record.get('geometry')
+    if centroid and record.get('location'):
+        geometry = record['location']
+    feature = {
+        'type': 'Feature',
+        'properties': record.get('properties', {}),
+        'geometry': geometry
+    }
+    if record.get('resolve_status'):
+        feature['resolve_status'] = record['resolve_status']
+    if record.get('recurrence'):
+        feature['recurrence'] = record['recurrence']
+    return feature
+
+
+def insert_audit_anomalies(anomalies_collection, audit_id, plant_id, features,
+                           start_seq=0, batch_size=INSERT_BATCH_SIZE, summary=None):
+    """
+    Write anomaly features for an audit in batches, returns number of records written.
+    Each batch gets its canonical severity level and anomaly type in one pass.
+    If a summary builder is given every written record is also counted into it.
+    """
+    detected_at = datetime.utcnow()
+    batch = []
+    written = 0
+    seq = start_seq
+
+    def flush(records):
+        classify_records(records)
+        if summary is not None:
+            for record in records:
+                summary.add(record)
+        anomalies_collection.bulk_write([InsertOne(record) for record in records], ordered=False)
+        return len(records)
+
+    for feature in features:
+        if not is_anomaly_feature(feature):
+            continue
+        batch.append(feature_to_record(feature, audit_id, plant_id, seq, detected_at))
+        seq += 1
+        if len(batch) >= batch_size:
+            written += flush(batch)
+            batch = []
+    if batch:
+        written += flush(batch)
+    return written
+
+
+def build_feature_query(audit_id, block=None, anomaly=None, severity=None, resolve_status=None, bbox=None,
+                        recurrence=None):
+    """Build an indexed query for an audit's anomaly records, skipping empty filters"""
+    query = {'audit_id': str(audit_id)}
+    if bbox:
+        polygon = bbox_to_polygon(bbox)
+        if polygon:
+            query['location'] = {'$geoWithin': {'$geometry': polygon}}
+    if block:
+        query['Block'] = block
+    if anomaly:
+        query['Anomaly'] = anomaly
+    if severity:
+        query['Severity'] = severity
+    if resolve_status:
+        query['resolve_status'] = resolve_status
+    if recurrence:
+        query['recurrence'] = recurrence
+    return query
+
+
+def find_audit_features(anomalies_collection, audit_id, limit=None, centroid=False, **filters):
+    """Return the audit's anomaly features in original GeoJSON order"""
+    projection = {'properties': 1, 'resolve_status': 1, 'recurrence': 1}
+    projection['location' if centroid else 'geometry'] = 1
+    cursor = anomalies_collection.find(
+        build_feature_query(audit_id, **filters),
+        projection
+    ).sort('seq', ASCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+    return [record_to_feature(record, centroid=centroid) for record in cursor]
+
+
+def find_audit_page(anomalies_collection, audit_id, after_seq=None, limit=PAGE_SIZE, **filters):
+    """
+    One page of an audit's anomalies for the inspection list, ordered by seq.
+    Items carry properties and status only (no geometry). Returns (items, next_cursor).
+    """
+    query = build_feature_query(audit_id, **filters)
+    if after_seq is not None:
+        query['seq'] = {'$gt': after_seq}
+    cursor = anomalies_collection.find(
+        query, {'_id': 0, 'seq': 1, 'properties': 1, 'resolve_status': 1, 'recurrence': 1}
+    ).sort('seq', ASCENDING).limit(limit + 1)
+    items = [{'seq': record['seq'],
+              'properties': record.get('properties', {}),
+              'resolve_status': record.get('resolve_status', 'pending'),
+              'recurrence': record.get('recurrence')} for record in cursor]
+    next_cursor = items[limit - 1]['seq'] if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+def find_viewport_features(anomalies_collection, audit_id, bbox, zoom=None,
+                           limit=MAX_VIEWPORT_FEATURES, **filters):
+    """
+    Features whose centroid lies inside the map viewport. Low zoom levels get
+    centroid points only. Returns (features, truncated).
+    """
+    centroid = zoom is not None and zoom < CENTROID_MAX_ZOOM
+    features = find_audit_features(anomalies_collection, audit_id, limit=limit + 1,
+                                   centroid=centroid, bbox=bbox, **filters)
+    truncated = len(features) > limit
+    return features[:limit], truncated
+
+
+def get_features_extent(anomalies_collection, audit_id, **filters):
+    """Count and [min_lon, min_lat, max_lon, max_lat] extent of the matching records"""
+    pipeline = [
+        {'$match': build_feature_query(audit_id, **filters)},
+        {'$group': {
+            '_id': None,
+            'count': {'$sum': 1},
+            'min_lon': {'$min': {'$arrayElemAt': ['$location.coordinates', 0]}},
+            'max_lon': {'$max': {'$arrayElemAt': ['$location.coordinates', 0]}},
+            'min_lat': {'$min': {'$arrayElemAt': ['$location.coordinates', 1]}},
+            'max_lat': {'$max': {'$arrayElemAt': ['$location.coordinates', 1]}}
+        }}
+    ]
+    result = list(anomalies_collection.aggregate(pipeline))
+    if not result:
+        return 0, None
+    row = result[0]
+    if row.get('min_lon') is None:
+        return row['count'], None
+    return row['count'], [row['min_lon'], row['min_lat'], row['max_lon'], row['max_lat']]
+
+
+def find_audit_records(anomalies_collection, audit_id, fields=None, **filters):
+    """Return a cursor of lightweight anomaly records (only the requested fields)"""
+    return anomalies_collection.find(
+        build_feature_query(audit_id, **filters),
+        fields or SUMMARY_FIELDS
+    )
+
+
+def backfill_module_keys(anomalies_collection, query=None, batch_size=INSERT_BATCH_SIZE):
+    """Add module_key to records written without one, returns the number updated"""
+    # None also matches records with no key yet, so they get the location fallback
+    query = dict(query or {}, module_key=None)
+    projection = {f'properties.{field}': 1 for field in ('Block', 'String', 'panel', 'barcode')}
+    projection['location'] = 1
+    batch = []
+    updated = 0
+    for record in anomalies_collection.find(query, projection):
+        batch.append(UpdateOne({'_id': record['_id']},
+                               {'$set': {'module_key': module_key(record.get('properties') or {},
+                                                                 record.get('location'))}}))
+        if len(batch) >= batch_size:
+            anomalies_collection.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        anomalies_collection.bulk_write(batch, ordered=False)
+        updated += len(batch)
+    return updated
+
+
+def delete_audit_anomalies(anomalies_collection, audit_id):
+    """Remove all anomaly records for an audit"""
+    return anomalies_collection.delete_many({'audit_id': str(audit_id)}).deleted_count
+
+
+def _apply_resolve_status(anomalies_collection, audits_collection, audit_id, image_names,
+                          new_status, session=None):
+    """Flip matching records to new_status and move the audit's corrected counter by the same amount"""
+    # Only records whose status actually changes are counted, so repeated or
+    # concurrent clicks can never push the counter past the real number of changes
+    result = anomalies_collection.update_many(
+        {'audit_id': str(audit_id), 'image_name': {'$in': list(image_names)},
+         'resolve_status': {'$ne': new_status}},
+        {'$set': {'resolve_status': new_status, 'status_updated_at': datetime.utcnow()}},
+        session=session
+    )
+    changed = result.modified_count
+    if changed:
+        delta = changed if new_status == 'resolved' else -changed
+        # Counter, materialized summary and cache version move together in one update;
+        # the open anomalies' wattage rows and the loss cached from them are regrouped on next read
+        audits_collection.update_one(
+            {'_id': ObjectId(audit_id)},
+            {'$inc': {'anomalies_corrected_count': delta,
+                      'anomaly_summary.status.resolved': delta,
+                      'anomaly_summary.status.pending': -delta,
+                      'anomalies_version': 1},
+             '$unset': {'anomaly_summary.module_watts': '', 'anomaly_summary.loss': ''}},
+            session=session
+        )
+    return changed
+
+
+def set_resolve_status(anomalies_collection, audits_collection, audit_id, image_names, new_status):
+    """
+    Set resolve_status on one or many anomalies of an audit in a single round trip.
+    Runs inside a transaction when the deployment supports one (replica set / Atlas)
+    so the record update and the counter increment commit together.
+    Returns the number of anomalies whose status changed.
+    """
+    if new_status not in RESOLVE_STATUSES:
+        raise ValueError(f"Invalid status: {new_status}")
+    image_names = [name for name in dict.fromkeys(image_names) if name]
+    if not image_names:
+        return 0
+
+    client = anomalies_collection.database.client
+    try:
+        with client.start_session() as session:
+            return session.with_transaction(
+                lambda s: _apply_resolve_status(anomalies_collection, audits_collection,
+                                                audit_id, image_names, new_status, session=s)
+            )
+    except OperationFailure as e:
+        # Standalone mongod has no transactions (code 20 IllegalOperation)
+        if e.code != 20:
+            raise
+    return _apply_resolve_status(anomalies_collection, audits_collection, audit_id, image_names, new_status)
@@ -0,0 +1,293 @@
+"""
+Anomaly Summary Module
+Compact per-audit counts (type, block, severity, resolve status) materialized at
+ingest time so overview and chart endpoints never touch the raw features
+"""
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from anomaly_store import SUMMARY_FIELDS, backfill_module_keys
+from anomaly_classification import (SEVERITY_LEVELS, SEVERITY_COLORS, ANOMALY_TYPE_COLORS, severity_code,
+                                    anomaly_type as canonical_anomaly_type, backfill_classification)
+
+# Bump when the summary layout changes so stale summaries get rebuilt lazily
+SUMMARY_VERSION = 8
+
+
+def _key(value, default='Unknown'):
+    """Summary map keys must be non-empty strings"""
+    if value is None or value == '':
+        return default
+    return str(value)
+
+
+def _inc(counts, key, count):
+    counts[key] = counts.get(key, 0) + count
+
+
+class AnomalySummaryBuilder:
+    """Accumulate summary counts while anomaly records are written"""
+
+    def __init__(self):
+        self.total = 0
+        self.by_type = {}
+        self.by_block = {}
+        self.by_severity = {}
+        self.block_type = {}
+        self.block_severity = {}
+        # Same counts over the canonical severity level / anomaly type (anomaly_classification)
+        self.by_level = {}
+        self.block_level = {}
+        self.by_anomaly_type = {}
+        self.block_anomaly_type = {}
+        # Unresolved anomalies per (canonical type, raw module wattage 'Wat'): the loss model's input
+        self.module_watts = {}
+        self.status = {'pending': 0, 'resolved': 0}
+        # [min_lon, min_lat, max_lon, max_lat] of the record centroids: the audit map's initial view
+        self.extent = None
+
+    def add(self, record, count=1):
+        """
+        Count one anomaly record (or any dict with Block/Anomaly/Severity/resolve_status),
+        or count records sharing those values at once
+        """
+        anomaly_type = _key(record.get('Anomaly'))
+        severity = _key(record.get('Severity'))
+        block = record.get('Block')
+        # Records classified at ingest carry both, older ones are classified here
+        level = record.get('severity_level')
+        level = SEVERITY_LEVELS[severity_code(record.get('Severity')) if level is None else level]
+        canonical_type = record.get('anomaly_type') or canonical_anomaly_type(record.get('Anomaly'))
+
+        self.total += count
+        _inc(self.by_type, anomaly_type, count)
+        _inc(self.by_severity, severity, count)
+        _inc(self.by_level, level, count)
+        _inc(self.by_anomaly_type, canonical_type, count)
+        _inc(self.status, 'resolved' if record.get('resolve_status') == 'resolved' else 'pending', count)
+
+        if block is not None and block != '':
+            block = str(block)
+            _inc(self.by_block, block, count)
+            _inc(self.block_type.setdefault(block, {}), anomaly_type, count)
+            _inc(self.block_severity.setdefault(block, {}), severity, count)
+            _inc(self.block_level.setdefault(block, {}), level, count)
+            _inc(self.block_anomaly_type.setdefault(block, {}), canonical_type, count)
+
+        # Full records carry their properties; aggregated rows get wattage from their own facet.
+        # Resolved anomalies no longer lose power, so only open ones feed the loss
+        if 'properties' in record and record.get('resolve_status') != 'resolved':
+            self.add_module_watt(canonical_type, (record.get('properties') or {}).get('Wat'), count)
+        if record.get('location'):
+            lon, lat = record['location']['coordinates'][:2]
+            self.add_extent([lon, lat, lon, lat])
+
+    def add_module_watt(self, anomaly_type, watt, count=1):
+        _inc(self.module_watts, (anomaly_type, watt), count)
+
+    def add_extent(self, extent):
+        if extent is None or None in extent:
+            return
+        if self.extent is None:
+            self.extent = list(extent)
+        else:
+            self.extent = [min(self.extent[0], extent[0]), min(self.extent[1], extent[1]),
+                           max(self.extent[2], extent[2]), max(self.extent[3], extent[3])]
+
+    def to_document(self):
+        """Summary document stored on the audit as anomaly_summary"""
+        return {
+            'version': SUMMARY_VERSION,
+            'total': self.total,
+            'by_type': self.by_type,
+            'by_block': self.by_block,
+            'by_severity': self.by_severity,
+            'block_type': self.block_type,
+            'block_severity': self.block_severity,
+            'by_level': self.by_level,
+            'block_level': self.block_level,
+            'by_anomaly_type': self.by_anomaly_type,
+            'block_anomaly_type': self.block_anomaly_type,
+            'module_watts': [{'anomaly_type': anomaly_type, 'watt': watt, 'count': count}
+                             for (anomaly_type, watt), count in self.module_watts.items()],
+            'status': self.status,
+            'extent': self.extent,
+            'computed_at': datetime.utcnow()
+        }
+
+
+# Unresolved records per (canonical type, module wattage): the summary's module_watts
+MODULE_WATT_STAGES = [
+    {'$match': {'resolve_status': {'$ne': 'resolved'}}},
+    {'$group': {'_id': {'anomaly_type': '$anomaly_type', 'watt': '$properties.Wat'}, 'count': {'$sum': 1}}}
+]
+
+
+def summary_pipeline(audit_id):
+    """
+    Count an audit's records in the database: one row per distinct combination of
+    the summary fields (a few hundred at most), one per (type, module wattage)
+    of the unresolved records and the centroids' extent, folded into the maps by
+    the builder
+    """
+    return [
+        {'$match': {'audit_id': str(audit_id)}},
+        {'$facet': {
+            'combinations': [
+                {'$group': {'_id': {field: f'${field}' for field in SUMMARY_FIELDS}, 'count': {'$sum': 1}}}
+            ],
+            'module_watts': MODULE_WATT_STAGES,
+            'extent': [
+                {'$match': {'location.coordinates': {'$exists': True}}},
+                {'$group': {
+                    '_id': None,
+                    'min_lon': {'$min': {'$arrayElemAt': ['$location.coordinates', 0]}},
+                    'min_lat': {'$min': {'$arrayElemAt': ['$location.coordinates', 1]}},
+                    'max_lon': {'$max': {'$arrayElemAt': ['$location.coordinates', 0]}},
+                    'max_lat': {'$max': {'$arrayElemAt': ['$location.coordinates', 1]}}
+                }}
+            ]
+        }}
+    ]
+
+
+def build_audit_summary(anomalies_collection, audit_id):
+    """Compute the summary for an audit from its indexed anomaly records"""
+    # Records ingested before classification get their level and type first, in bulk
+    backfill_classification(anomalies_collection, {'audit_id': str(audit_id)})
+    backfill_module_keys(anomalies_collection, {'audit_id': str(audit_id)})
+    builder = AnomalySummaryBuilder()
+    result = next(anomalies_collection.aggregate(summary_pipeline(audit_id)), {})
+    for row in result.get('combinations', []):
+        builder.add(row['_id'], row['count'])
+    for row in result.get('module_watts', []):
+        builder.add_module_watt(row['_id'].get('anomaly_type'), row['_id'].get('watt'), row['count'])
+    for row in result.get('extent', []):
+        builder.add_extent([row.get('min_lon'), row.get('min_lat'), row.get('max_lon'), row.get('max_lat')])
+    return builder.to_document()
+
+
+def module_watt_rows(anomalies_collection, audit_id):
+    """
+    Regroup only the summary's module_watts, dropped from the summary whenever a
+    resolve status changes (anomaly_store.set_resolve_status)
+    """
+    builder = AnomalySummaryBuilder()
+    for row in anomalies_collection.aggregate([{'$match': {'audit_id': str(audit_id)}}] + MODULE_WATT_STAGES):
+        builder.add_module_watt(row['_id'].get('anomaly_type'), row['_id'].get('watt'), row['count'])
+    return builder.to_document()['module_watts']
+
+
+def get_audit_summary(audits_collection, anomalies_collection, audit):
+    """
+    Return the stored summary for an audit document, rebuilding and persisting it
+    when it is missing or from an older layout (audits ingested before summaries)
+    """
+    summary = audit.get('anomaly_summary') or {}
+    if summary.get('version') == SUMMARY_VERSION:
+        return summary
+
+    print(f"🔄 Rebuilding anomaly summary for audit {audit['_id']}")
+    summary = build_audit_summary(anomalies_collection, audit['_id'])
+    audits_collection.update_one({'_id': ObjectId(audit['_id'])}, {'$set': {'anomaly_summary': summary}})
+    return summary
+
+
+def summary_totals(audits_collection, anomalies_collection, query=None):
+    """
+    Anomaly totals, resolve status and canonical type counts over the summaries of
+    the matching audits (one aggregation over audit documents, no anomaly reads)
+    """
+    query = dict(query or {})
+    # Audits ingested before summaries (or with an older layout) are rebuilt once
+    for audit in audits_collection.find(dict(query, **{'anomaly_summary.version': {'$ne': SUMMARY_VERSION}}),
+                                        {'_id': 1}):
+        get_audit_summary(audits_collection, anomalies_collection, audit)
+
+    result = next(audits_collection.aggregate([
+        {'$match': query},
+        {'$facet': {
+            'totals': [{'$group': {
+                '_id': None,
+                'total': {'$sum': '$anomaly_summary.total'},
+                'resolved': {'$sum': '$anomaly_summary.status.resolved'},
+                'pending': {'$sum': '$anomaly_summary.status.pending'}
+            }}],
+            'types': [
+                {'$project': {'types': {'$objectToArray': {'$ifNull': ['$anomaly_summary.by_anomaly_type', {}]}}}},
+                {'$unwind': '$types'},
+                {'$group': {'_id': '$types.k', 'count': {'$sum': '$types.v'}}},
+                {'$sort': {'count': -1}}
+            ]
+        }}
+    ]), {})
+    totals = (result.get('totals') or [{}])[0]
+    return {
+        'total': totals.get('total', 0),
+        'resolved': totals.get('resolved', 0),
+        'pending': totals.get('pending', 0),
+        'by_anomaly_type': result.get('types', [])
+    }
+
+
+def sort_block_labels(block_keys):
+    """Sort block labels numerically where possible (matches the audit page filter order)"""
+    return sorted(block_keys, key=lambda b: (0, int(b), b) if str(b).isdigit() else (1, 0, str(b)))
+
+
+def build_chart_data(summary):
+    """
+    Pie (type), bar (block x type) and severity (block x level) datasets plus the
+    severity/status counts, all from one summary document
+    """
+    type_counts = summary.get('by_anomaly_type', {})
+    block_types = summary.get('block_anomaly_type', {})
+    block_levels = summary.get('block_level', {})
+    by_level = summary.get('by_level', {})
+
+    anomaly_data = {
+        'labels': list(type_counts.keys()),
+        'counts': list(type_counts.values()),
+        'colors': [ANOMALY_TYPE_COLORS.get(label, '#888888') for label in type_counts]
+    }
+
+    blocks = sort_block_labels(block_types.keys())
+    bar_chart_data = {
+        'labels': blocks,
+        'datasets': [{
+            'label': anomaly_type,
+            'data': [block_types[block].get(anomaly_type, 0) for block in blocks],
+            'backgroundColor': ANOMALY_TYPE_COLORS.get(anomaly_type, '#888888')
+        } for anomaly_type in type_counts] if blocks else []
+    }
+
+    severity_blocks = sort_block_labels(block for block, levels in block_levels.items()
+                                        if any(levels.get(level) for level in SEVERITY_COLORS))
+    severity_datasets = []
+    for level, color in SEVERITY_COLORS.items():
+        data = [block_levels[block].get(level, 0) for block in severity_blocks]
+        if any(data):
+            severity_datasets.append({
+                'label': f'{level} Severity',
+                'data': data,
+                'backgroundColor': color,
+                'barThickness': 30
+            })
+    severity_chart_data = {'labels': severity_blocks, 'datasets': severity_datasets}
+
+    status = summary.get('status', {})
+    progress = {
+        'pending': status.get('pending', 0),
+        'resolved': status.get('resolved', 0),
+        'high': by_level.get('High', 0),
+        'medium': by_level.get('Medium', 0),
+        'low': by_level.get('Low', 0)
+    }
+    return {
+        'anomaly_data': anomaly_data,
+        'bar_chart_data': bar_chart_data,
+        'severity_chart_data': severity_chart_data,
+        'progress': progress,
+        'total': summary.get('total', 0)
+    }
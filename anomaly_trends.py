@@ -0,0 +1,119 @@
+"""
+Anomaly Trends Module
+Plant-level time series across audits, answered from the per-audit summaries
+(anomaly_summary); only the recurring modules are grouped from the anomaly records
+"""
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from anomaly_summary import SUMMARY_VERSION, get_audit_summary
+from anomaly_classification import SEVERITY_COLORS
+
+# Audits compared by default / at most
+TREND_AUDITS = 10
+MAX_TREND_AUDITS = 50
+
+# Recurring modules returned by default
+HOTSPOT_LIMIT = 50
+
+# The parts of a summary a trend needs (the block maps stay in the database)
+TREND_FIELDS = ('version', 'total', 'by_level', 'by_anomaly_type', 'status')
+
+
+def ensure_trend_indexes(audits_collection):
+    """Plant audits newest first: the trend query and every 'latest audit' lookup"""
+    audits_collection.create_index([('plant_id', ASCENDING), ('_id', DESCENDING)], name='plant_latest')
+
+
+def audit_date(audit):
+    """When the audit took place: completion date, else start, else creation time"""
+    for field in ('completion_date', 'start_date', 'created_at'):
+        if audit.get(field):
+            return audit[field]
+    return ObjectId(audit['_id']).generation_time.replace(tzinfo=None)
+
+
+def _plant_audits(audits_collection, anomalies_collection, plant_id, limit):
+    """The plant's latest audits, oldest first, each with (at least) its trend summary fields"""
+    projection = {'name': 1, 'start_date': 1, 'completion_date': 1, 'created_at': 1}
+    projection.update({f'anomaly_summary.{field}': 1 for field in TREND_FIELDS})
+    audits = list(audits_collection.find({'plant_id': str(plant_id)}, projection)
+                  .sort('_id', DESCENDING).limit(limit))
+    for audit in audits:
+        if (audit.get('anomaly_summary') or {}).get('version') != SUMMARY_VERSION:
+            # Audits ingested before summaries (or an older layout) are rebuilt once
+            audit['anomaly_summary'] = get_audit_summary(audits_collection, anomalies_collection, audit)
+    audits.sort(key=audit_date)
+    return audits
+
+
+def recurring_modules(anomalies_collection, audits, limit=HOTSPOT_LIMIT):
+    """
+    Modules with anomalies in more than one of the audits, most audits first.
+    Grouped in the database over the (audit_id, module_key) index so the per-module
+    counts never have to be stored on the audits.
+    """
+    dates = {str(audit['_id']): audit_date(audit) for audit in audits}
+    rows = anomalies_collection.aggregate([
+        {'$match': {'audit_id': {'$in': list(dates)}, 'module_key': {'$type': 'string'}}},
+        {'$group': {'_id': {'module': '$module_key', 'audit_id': '$audit_id'}, 'count': {'$sum': 1}}},
+        {'$group': {'_id': '$_id.module', 'audits': {'$sum': 1}, 'anomalies': {'$sum': '$count'},
+                    'audit_ids': {'$push': '$_id.audit_id'}}},
+        {'$match': {'audits': {'$gt': 1}}},
+        {'$sort': {'audits': -1, 'anomalies': -1, '_id': 1}},
+        {'$limit': int(limit)}
+    ])
+
+    recurring = []
+    for row in rows:
+        audit_ids = sorted(row['audit_ids'], key=dates.get)
+        recurring.append({
+            'module': row['_id'],
+            'audits': row['audits'],
+            'anomalies': row['anomalies'],
+            'audit_ids': audit_ids,
+            'last_seen': dates[audit_ids[-1]].date().isoformat()
+        })
+    return recurring
+
+
+def plant_trends(audits_collection, anomalies_collection, plant_id, limit=TREND_AUDITS,
+                 hotspot_limit=HOTSPOT_LIMIT):
+    """
+    Per-audit series for the plant's latest audits (oldest first): anomaly counts
+    by type and severity level, resolution rate and the modules that keep failing
+    """
+    limit = min(max(int(limit), 1), MAX_TREND_AUDITS)
+    audits = _plant_audits(audits_collection, anomalies_collection, plant_id, limit)
+
+    summaries = [audit.get('anomaly_summary') or {} for audit in audits]
+    types = []
+    for summary in summaries:
+        for anomaly_type in summary.get('by_anomaly_type', {}):
+            if anomaly_type not in types:
+                types.append(anomaly_type)
+
+    points = []
+    for audit, summary in zip(audits, summaries):
+        status = summary.get('status', {})
+        total = summary.get('total', 0)
+        points.append({
+            'audit_id': str(audit['_id']),
+            'name': audit.get('name'),
+            'date': audit_date(audit).date().isoformat(),
+            'total': total,
+            'resolved': status.get('resolved', 0),
+            'pending': status.get('pending', 0),
+            'resolution_rate': round(status.get('resolved', 0) / total * 100, 1) if total else 0.0
+        })
+
+    return {
+        'audits': points,
+        'labels': [point['name'] or point['date'] for point in points],
+        'by_type': {anomaly_type: [summary.get('by_anomaly_type', {}).get(anomaly_type, 0) for summary in summaries]
+                    for anomaly_type in types},
+        'by_level': {level: [summary.get('by_level', {}).get(level, 0) for summary in summaries]
+                     for level in SEVERITY_COLORS},
+        'resolution_rate': [point['resolution_rate'] for point in points],
+        'recurring_modules': recurring_modules(anomalies_collection, audits, hotspot_limit) if len(audits) > 1 else []
+    }
@@ -0,0 +1,108 @@
+"""
+Audit Feature Cache Module
+In-process LRU cache of an audit's anomaly feature list, keyed by audit id and
+the audit's anomalies_version so a worker never serves features older than the
+version currently stored in MongoDB
+"""
+import threading
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+
+from anomaly_store import find_audit_features
+
+
+class AuditFeatureCache:
+    """Thread-safe LRU cache bounded by the total number of cached features"""
+
+    def __init__(self, max_features=200000, max_entries=64):
+        self.max_features = max_features
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # audit_id -> (version, features)
+        self._feature_count = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, audit_id, version):
+        """Return cached features for this exact version, or None"""
+        with self._lock:
+            entry = self._entries.get(audit_id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(audit_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, audit_id, version, features):
+        """Store features for a version, replacing any older version of the same audit"""
+        size = len(features)
+        if size > self.max_features:
+            # Never let one huge audit flush the whole cache
+            return
+        with self._lock:
+            self._remove(audit_id)
+            self._entries[audit_id] = (version, features)
+            self._feature_count += size
+            while self._entries and (self._feature_count > self.max_features or
+                                     len(self._entries) > self.max_entries):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, audit_id):
+        """Drop an audit from this worker's cache"""
+        with self._lock:
+            self._remove(audit_id)
+
+    def _remove(self, audit_id):
+        entry = self._entries.pop(audit_id, None)
+        if entry is not None:
+            self._feature_count -= len(entry[1])
+
+    def stats(self):
+        """Counters used to size the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'cached_features': self._feature_count,
+                'max_features': self.max_features,
+                'max_entries': self.max_entries
+            }
+
+
+def get_audit_version(audits_collection, audit_id):
+    """Current anomalies_version of an audit (0 for audits that predate versioning)"""
+    audit = audits_collection.find_one({'_id': ObjectId(audit_id)}, {'anomalies_version': 1})
+    if not audit:
+        return None
+    return audit.get('anomalies_version', 0)
+
+
+def get_cached_audit_features(cache, audits_collection, anomalies_collection, audit_id, audit=None):
+    """
+    Return an audit's full feature list, served from the cache when the stored
+    version matches. The version is read from MongoDB on every call (or taken from
+    an audit document the caller just loaded), so updates made by any gunicorn
+    worker invalidate the entry everywhere.
+    """
+    audit_id = str(audit_id)
+    if audit is not None:
+        version = audit.get('anomalies_version', 0)
+    else:
+        version = get_audit_version(audits_collection, audit_id)
+    if version is None:
+        return []
+
+    features = cache.get(audit_id, version)
+    if features is None:
+        features = find_audit_features(anomalies_collection, audit_id)
+        cache.put(audit_id, version, features)
+    return features
@@ -0,0 +1,74 @@
+"""
+Content Store Module
+Index of stored file contents keyed by content hash (see upload_checksums) so a
+file or image that was uploaded before is linked to the existing copy on disk
+and in S3 instead of being written and transferred again
+"""
+from datetime import datetime
+import os
+
+from pymongo import ASCENDING
+
+
+def s3_object_exists(s3_client, bucket, key, size=None):
+    """True if the object is still in the bucket (with the expected size)"""
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+    except Exception:
+        return False
+    return size is None or head.get('ContentLength') == size
+
+
+class ContentIndex:
+    """file_contents collection: one document per distinct content hash"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index([('s3_bucket', ASCENDING), ('s3_key', ASCENDING)], name='s3_object')
+
+    def find(self, content_hash, size=None):
+        if not content_hash:
+            return None
+        record = self.collection.find_one({'_id': content_hash})
+        if record and size is not None and record.get('size') != size:
+            # Same hash, different size: not the same content, never link to it
+            return None
+        return record
+
+    def local_copy(self, record):
+        """Path of the stored file if it is still on this host's disk"""
+        path = record and record.get('file_path')
+        return path if path and os.path.exists(path) else None
+
+    def s3_copy(self, record, s3_client):
+        """(bucket, key, url) of the stored object if it is still in S3"""
+        if not record or not record.get('s3_key'):
+            return None
+        if not s3_object_exists(s3_client, record['s3_bucket'], record['s3_key'], record.get('size')):
+            self.collection.update_one({'_id': record['_id']},
+                                       {'$unset': {'s3_bucket': '', 's3_key': '', 's3_url': ''}})
+            return None
+        return record['s3_bucket'], record['s3_key'], record.get('s3_url')
+
+    def register(self, content_hash, size, file_path=None, s3_bucket=None, s3_key=None, s3_url=None):
+        """Record where a content is stored; locations already known are kept"""
+        if not content_hash:
+            return
+        now = datetime.utcnow()
+        update = {'$setOnInsert': {'size': size, 'created_at': now},
+                  '$set': {'last_used_at': now},
+                  '$inc': {'references': 1}}
+        # Only fill in locations that are missing, the first stored copy stays canonical
+        self.collection.update_one({'_id': content_hash}, update, upsert=True)
+        if file_path:
+            self.collection.update_one({'_id': content_hash, 'file_path': {'$exists': False}},
+                                       {'$set': {'file_path': file_path}})
+        if s3_key:
+            self.collection.update_one({'_id': content_hash, 's3_key': {'$exists': False}},
+                                       {'$set': {'s3_bucket': s3_bucket, 's3_key': s3_key, 's3_url': s3_url}})
+
+    def replace_local_copy(self, content_hash, file_path):
+        """Point at a new local copy after the recorded one disappeared"""
+        self.collection.update_one({'_id': content_hash}, {'$set': {'file_path': file_path}})
@@ -0,0 +1,387 @@
+"""
+Direct Upload Module
+Browser-to-S3 multipart uploads with presigned part URLs. The browser PUTs
+every part straight to the bucket; the server only starts the multipart
+upload, signs part URLs, completes it and records the data_uploads entry,
+so no upload bytes pass through the web workers. Parts carry a SHA256
+checksum S3 verifies; with 5 MB parts those checksums are the content hash
+blocks, so direct uploads are deduplicated like chunked ones.
+"""
+import base64
+import binascii
+import math
+import os
+import uuid
+from datetime import datetime
+
+from flask import request, jsonify
+from pymongo import ReturnDocument
+
+from upload_progress import UploadProgressTracker, upload_status
+from s3_multipart import MB, MIN_PART_SIZE, MAX_PARTS
+from render_upload_endpoints import SESSION_TTL
+from upload_checksums import HASH_BLOCK_SIZE, content_hash
+
+DIRECT_SESSION = 'direct'
+
+# Part size used when the client does not ask for one
+DEFAULT_PART_SIZE = 16 * MB
+MAX_PART_SIZE = 5 * 1024 * MB
+
+# Presigned part URLs stay valid this long; clients ask for more as they go
+PRESIGN_EXPIRY_SECONDS = 3600
+MAX_URLS_PER_REQUEST = 100
+
+
+def direct_part_size(file_size, requested=None, checksums=False):
+    """
+    Requested (or default) part size, kept within S3's part size and part count
+    limits. Checksummed uploads use content hash blocks as parts where possible.
+    """
+    if checksums and file_size <= HASH_BLOCK_SIZE * MAX_PARTS:
+        return HASH_BLOCK_SIZE
+    part_size = min(max(int(requested or DEFAULT_PART_SIZE), MIN_PART_SIZE), MAX_PART_SIZE)
+    return max(part_size, math.ceil(file_size / MAX_PARTS))
+
+
+def _checksum_b64(value):
+    """Base64 SHA256 (as S3 expects it) from the client's hex or base64 digest"""
+    value = str(value or '').strip()
+    try:
+        digest = bytes.fromhex(value) if len(value) == 64 else base64.b64decode(value, validate=True)
+    except (ValueError, binascii.Error):
+        raise ValueError('invalid SHA256 checksum')
+    if len(digest) != 32:
+        raise ValueError('invalid SHA256 checksum')
+    return base64.b64encode(digest).decode('ascii')
+
+
+def _verified_content_hash(session, parts):
+    """
+    Content hash from the SHA256 checksums S3 verified for every part, or None when
+    parts are not hash blocks or S3 did not report checksums
+    """
+    if not session.get('checksum_algorithm') or session['part_size'] != HASH_BLOCK_SIZE:
+        return None
+    checksums = [parts[n].get('ChecksumSHA256') for n in range(1, session['total_parts'] + 1)]
+    if not all(checksums):
+        return None
+    return content_hash([base64.b64decode(checksum).hex() for checksum in checksums])
+
+
+def _part_length(session, part_number):
+    return min(session['part_size'], session['file_size'] - (part_number - 1) * session['part_size'])
+
+
+def _listed_parts(s3_client, bucket_name, session):
+    """{part_number: part} of the parts S3 holds for the session's upload"""
+    parts = {}
+    paginator = s3_client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=bucket_name, Key=session['s3_key'], UploadId=session['s3_upload_id']):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = part
+    return parts
+
+
+def _complete_parts(session, parts):
+    """Part numbers S3 holds with the expected size"""
+    return sorted(n for n, part in parts.items()
+                  if 1 <= n <= session['total_parts'] and part['Size'] == _part_length(session, n))
+
+
+def _direct_tracker(session):
+    tracker = upload_status.get(session['_id'])
+    if tracker is None:
+        tracker = UploadProgressTracker(session['_id'], session['filename'], session['file_size'])
+    return tracker
+
+
+def register_direct_upload_endpoints(app, data_uploads_collection, get_s3_resource, upload_sessions_collection,
+                                     content_index=None, login_required=None):
+    """Register the presigned direct upload endpoints with the Flask app"""
+    login_required = login_required or (lambda f: f)
+    bucket_name = os.environ.get('bucket_name', 'sylo-energy')
+    region_name = os.environ.get('region_name', 'ap-south-1')
+
+    def find_session(upload_id):
+        return upload_sessions_collection.find_one({'_id': upload_id, 'kind': DIRECT_SESSION})
+
+    def touch(upload_id, fields=None):
+        now = datetime.utcnow()
+        upload_sessions_collection.update_one(
+            {'_id': upload_id},
+            {'$set': dict(fields or {}, updated_at=now, expires_at=now + SESSION_TTL)}
+        )
+
+    @app.route('/api/upload/direct/init', methods=['POST'])
+    @login_required
+    def init_direct_upload():
+        """Start an S3 multipart upload the browser sends its parts to"""
+        try:
+            data = request.json
+            file_size = int(data['fileSize'])
+            if file_size < 1:
+                return jsonify({'success': False, 'error': 'fileSize must be positive'}), 400
+            # SHA256 part checksums: S3 rejects a part whose bytes do not match
+            checksum_algorithm = 'SHA256' if str(data.get('checksumAlgorithm', '')).upper() == 'SHA256' else None
+            part_size = direct_part_size(file_size, data.get('partSize'), checksums=bool(checksum_algorithm))
+            total_parts = math.ceil(file_size / part_size)
+
+            upload_id = str(uuid.uuid4())
+            final_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S_')}{os.path.basename(data['filename'])}"
+            s3_key = f"uploads/{data['plant_id']}/{data['audit_id']}/{final_filename}"
+            create_args = {'Bucket': bucket_name, 'Key': s3_key}
+            if data.get('contentType'):
+                create_args['ContentType'] = data['contentType']
+            if checksum_algorithm:
+                create_args['ChecksumAlgorithm'] = checksum_algorithm
+            s3_upload_id = get_s3_resource().create_multipart_upload(**create_args)['UploadId']
+
+            now = datetime.utcnow()
+            session = {
+                '_id': upload_id,
+                'kind': DIRECT_SESSION,
+                'filename': data['filename'],
+                'file_size': file_size,
+                'part_size': part_size,
+                'total_parts': total_parts,
+                'audit_type': data['audit_type'],
+                'plant_id': data['plant_id'],
+                'audit_id': data['audit_id'],
+                'final_filename': final_filename,
+                's3_key': s3_key,
+                's3_upload_id': s3_upload_id,
+                'checksum_algorithm': checksum_algorithm,
+                'created_at': now,
+                'updated_at': now,
+                'expires_at': now + SESSION_TTL,
+                'status': 'initialized'
+            }
+            upload_sessions_collection.insert_one(session)
+
+            tracker = UploadProgressTracker(upload_id, data['filename'], file_size)
+            tracker.set_stage('uploading_to_s3', 'Browser uploading parts directly to S3')
+
+            print(f"🚀 Direct S3 Upload Initialized [{upload_id}]: {data['filename']} "
+                  f"({file_size} bytes, {total_parts} parts of {part_size} bytes)")
+
+            return jsonify({
+                'success': True,
+                'uploadId': upload_id,
+                'partSize': part_size,
+                'totalParts': total_parts,
+                'checksumAlgorithm': checksum_algorithm,
+                'key': s3_key,
+                'urlExpiresIn': PRESIGN_EXPIRY_SECONDS
+            })
+
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': f'Invalid request: {str(e)}'}), 400
+        except Exception as e:
+            return jsonify({'success': False, 'error': f'Failed to initialize upload: {str(e)}'}), 500
+
+    @app.route('/api/upload/direct/<upload_id>/part-urls', methods=['POST'])
+    @login_required
+    def direct_part_urls(upload_id):
+        """Presigned PUT URLs for the requested part numbers (1-based)"""
+        session = find_session(upload_id)
+        if not session:
+            return jsonify({'success': False, 'error': 'Upload session not found'}), 404
+        if session['status'] not in ('initialized', 'uploading'):
+            return jsonify({'success': False, 'error': f"Upload is {session['status']}"}), 409
+
+        data = request.json or {}
+        try:
+            part_numbers = sorted({int(n) for n in data.get('partNumbers', [])})
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'partNumbers must be integers'}), 400
+        if not part_numbers or len(part_numbers) > MAX_URLS_PER_REQUEST:
+            return jsonify({'success': False,
+                            'error': f'Ask for 1 to {MAX_URLS_PER_REQUEST} part URLs at a time'}), 400
+        if part_numbers[0] < 1 or part_numbers[-1] > session['total_parts']:
+            return jsonify({'success': False, 'error': 'Invalid part number'}), 400
+
+        # Checksummed sessions sign each part's checksum into its URL: the PUT must send
+        # it as x-amz-checksum-sha256 and S3 verifies the bytes against it
+        checksums = {}
+        if session.get('checksum_algorithm'):
+            try:
+                checksums = {n: _checksum_b64((data.get('checksums') or {}).get(str(n))) for n in part_numbers}
+            except ValueError:
+                return jsonify({'success': False, 'error': 'Send the SHA256 checksum of every part'}), 400
+
+        # Signing is local (no request to S3)
+        s3_client = get_s3_resource()
+        urls = {}
+        for n in part_numbers:
+            params = {'Bucket': bucket_name, 'Key': session['s3_key'],
+                      'UploadId': session['s3_upload_id'], 'PartNumber': n}
+            if n in checksums:
+                params['ChecksumSHA256'] = checksums[n]
+            urls[str(n)] = s3_client.generate_presigned_url('upload_part', Params=params,
+                                                            ExpiresIn=PRESIGN_EXPIRY_SECONDS, HttpMethod='PUT')
+        touch(upload_id, {'status': 'uploading'})
+
+        # The client reports how far it got, so the shared progress shows direct uploads too
+        uploaded_bytes = data.get('uploadedBytes')
+        if uploaded_bytes is not None:
+            _direct_tracker(session).update_progress(min(int(uploaded_bytes), session['file_size']),
+                                                     'uploading_to_s3')
+
+        return jsonify({'success': True, 'urls': urls, 'expiresIn': PRESIGN_EXPIRY_SECONDS})
+
+    @app.route('/api/upload/direct/<upload_id>/parts', methods=['GET'])
+    @login_required
+    def direct_uploaded_parts(upload_id):
+        """Parts S3 already holds, so an interrupted browser upload resumes with the rest"""
+        session = find_session(upload_id)
+        if not session:
+            return jsonify({'success': False, 'error': 'Upload session not found'}), 404
+        if session['status'] == 'completed':
+            return jsonify({'success': True, 'status': 'completed', 'result': session['result']})
+        try:
+            parts = _listed_parts(get_s3_resource(), bucket_name, session)
+        except Exception as e:
+            return jsonify({'success': False, 'error': f'Could not list parts: {str(e)}'}), 502
+        received = _complete_parts(session, parts)
+        return jsonify({
+            'success': True,
+            'uploadId': upload_id,
+            'status': session['status'],
+            'partSize': session['part_size'],
+            'totalParts': session['total_parts'],
+            'checksumAlgorithm': session.get('checksum_algorithm'),
+            'receivedParts': received,
+            'missingParts': session['total_parts'] - len(received)
+        })
+
+    @app.route('/api/upload/direct/<upload_id>/complete', methods=['POST'])
+    @login_required
+    def complete_direct_upload(upload_id):
+        """Complete the multipart upload from the parts S3 holds and record the upload"""
+        session = find_session(upload_id)
+        if not session:
+            return jsonify({'success': False, 'error': 'Upload session not found'}), 404
+        if session['status'] == 'completed':
+            # Retried complete: report the earlier result
+            return jsonify(session['result'])
+
+        # Only one request (on any worker) may complete the upload
+        session = upload_sessions_collection.find_one_and_update(
+            {'_id': upload_id, 'status': {'$in': ['initialized', 'uploading']}},
+            {'$set': {'status': 'finalizing', 'updated_at': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not session:
+            return jsonify({'success': False, 'error': 'Upload is already being completed'}), 409
+
+        s3_client = get_s3_resource()
+        tracker = _direct_tracker(session)
+        try:
+            # S3's part list is the source of truth: ETags reported by the browser are not needed
+            parts = _listed_parts(s3_client, bucket_name, session)
+            received = _complete_parts(session, parts)
+            if len(received) != session['total_parts']:
+                missing = sorted(set(range(1, session['total_parts'] + 1)) - set(received))
+                touch(upload_id, {'status': 'uploading'})
+                return jsonify({
+                    'success': False,
+                    'error': f'Missing parts: {len(missing)}',
+                    'missingParts': missing[:MAX_URLS_PER_REQUEST]
+                }), 400
+
+            tracker.set_stage('finalizing', 'Completing S3 multipart upload')
+            completed_parts = []
+            for n in received:
+                part = {'PartNumber': n, 'ETag': parts[n]['ETag']}
+                if parts[n].get('ChecksumSHA256'):
+                    part['ChecksumSHA256'] = parts[n]['ChecksumSHA256']
+                completed_parts.append(part)
+            s3_etag = s3_client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=session['s3_key'],
+                UploadId=session['s3_upload_id'],
+                MultipartUpload={'Parts': completed_parts}
+            ).get('ETag')
+
+            stored_size = s3_client.head_object(Bucket=bucket_name, Key=session['s3_key'])['ContentLength']
+            if stored_size != session['file_size']:
+                raise ValueError(f"S3 object has {stored_size} bytes, expected {session['file_size']}")
+
+            s3_key = session['s3_key']
+            s3_url = f"https://{bucket_name}.s3.{region_name}.amazonaws.com/{s3_key}"
+            final_filename = session['final_filename']
+
+            # Content stored before: keep the earlier object and drop this copy
+            file_hash = _verified_content_hash(session, parts)
+            existing_s3 = None
+            if content_index is not None and file_hash:
+                existing_s3 = content_index.s3_copy(content_index.find(file_hash, session['file_size']), s3_client)
+                if existing_s3 and existing_s3[1] != s3_key:
+                    print(f"♻️ Duplicate upload [{upload_id}]: {session['filename']} matches {file_hash}")
+                    s3_client.delete_object(Bucket=bucket_name, Key=s3_key)
+                    s3_key = existing_s3[1]
+                    s3_url = existing_s3[2] or f"https://{existing_s3[0]}.s3.{region_name}.amazonaws.com/{s3_key}"
+                    final_filename = os.path.basename(s3_key)
+                else:
+                    existing_s3 = None
+                content_index.register(file_hash, session['file_size'],
+                                       s3_bucket=None if existing_s3 else bucket_name,
+                                       s3_key=None if existing_s3 else s3_key, s3_url=s3_url)
+
+            upload_data = {
+                'filename': final_filename,
+                'original_filename': session['filename'],
+                'file_path': None,
+                'file_size': session['file_size'],
+                'audit_type': session['audit_type'],
+                'plant_id': session['plant_id'],
+                'audit_id': session['audit_id'],
+                's3_url': s3_url,
+                's3_etag': s3_etag,
+                'content_hash': file_hash,
+                'deduplicated': bool(existing_s3),
+                'uploaded_at': datetime.utcnow(),
+                'upload_method': 'direct_s3'
+            }
+            result = data_uploads_collection.insert_one(upload_data)
+
+            response = {
+                'success': True,
+                'filename': final_filename,
+                'file_size': session['file_size'],
+                'database_id': str(result.inserted_id),
+                's3_url': s3_url,
+                'content_hash': file_hash,
+                'deduplicated': bool(existing_s3),
+                'message': 'Upload completed successfully'
+            }
+            touch(upload_id, {'status': 'completed', 'result': response, 's3_upload_id': None})
+            tracker.complete(s3_url)
+            print(f"✅ Direct S3 Upload Completed [{upload_id}]: {session['filename']} -> {s3_key}")
+            return jsonify(response)
+
+        except Exception as e:
+            # The parts stay on S3: the client can send missing parts and complete again
+            touch(upload_id, {'status': 'uploading', 'error': str(e)})
+            return jsonify({'success': False, 'error': f'Upload completion failed: {str(e)}'}), 500
+
+    @app.route('/api/upload/direct/<upload_id>/abort', methods=['POST'])
+    @login_required
+    def abort_direct_upload(upload_id):
+        """Abort the multipart upload so S3 drops its parts"""
+        session = find_session(upload_id)
+        if not session:
+            return jsonify({'success': False, 'error': 'Upload session not found'}), 404
+        if session['status'] == 'completed':
+            return jsonify({'success': False, 'error': 'Upload is already completed'}), 409
+        try:
+            get_s3_resource().abort_multipart_upload(Bucket=bucket_name, Key=session['s3_key'],
+                                                     UploadId=session['s3_upload_id'])
+        except Exception as e:
+            print(f"⚠️ Could not abort direct upload {upload_id}: {e}")
+        touch(upload_id, {'status': 'aborted', 's3_upload_id': None})
+        _direct_tracker(session).fail('Upload aborted')
+        return jsonify({'success': True, 'uploadId': upload_id, 'status': 'aborted'})
+
+    print("✅ Direct S3 upload endpoints registered")
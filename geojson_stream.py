@@ -0,0 +1,27 @@
+"""
+GeoJSON Streaming Module
+Iterates the features of a FeatureCollection file one at a time so large
+layouts can be ingested with flat memory
+"""
+import json
+
+try:
+    import ijson
+    STREAMING_ENABLED = True
+except ImportError:
+    STREAMING_ENABLED = False
+    print("ijson not found. GeoJSON files will be parsed in memory.")
+
+
+def iter_geojson_features(path):
+    """
+    Yield the features of a GeoJSON FeatureCollection file in file order.
+    Uses ijson's incremental parser when available, otherwise falls back to
+    json.load (the whole file in memory, as before).
+    """
+    with open(path, 'rb') as f:
+        if STREAMING_ENABLED:
+            # use_float keeps coordinates as float instead of Decimal (BSON cannot store Decimal)
+            yield from ijson.items(f, 'features.item', use_float=True)
+        else:
+            yield from (json.load(f).get('features') or [])
@@ -0,0 +1,222 @@
+"""
+Background Job Queue Module
+Persistent job queue stored in MongoDB and worked by a bounded thread pool in
+every app process. Jobs survive restarts: a job whose worker died is picked up
+again once its lease expires.
+"""
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler for failures that retrying cannot fix (bad input, missing file)"""
+
+
+class JobContext:
+    """Handed to job handlers so they can report progress and keep their lease"""
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+
+    @property
+    def job_id(self):
+        return self.job['_id']
+
+    def progress(self, stage, message=None):
+        """Record the current stage on the job document (also renews the lease)"""
+        self.queue.heartbeat(self.job_id, stage=stage, message=message)
+
+
+class JobQueue:
+    """
+    MongoDB backed job queue.
+
+    Each process runs one dispatcher thread that claims queued jobs atomically
+    (find_one_and_update) and hands them to a ThreadPoolExecutor of max_workers
+    threads, so a process never runs more jobs than that at once.
+    """
+
+    def __init__(self, collection, max_workers=2, lease_seconds=300, poll_interval=5,
+                 max_attempts=3, retry_delay=60):
+        self.collection = collection
+        self.max_workers = max_workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._handlers = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(max_workers, 1))
+        self._wakeup = threading.Event()
+        self._executor = None
+        self._started = False
+
+    def ensure_indexes(self):
+        self.collection.create_index([('status', ASCENDING), ('run_after', ASCENDING),
+                                      ('created_at', ASCENDING)], name='status_run_after')
+        self.collection.create_index([('status', ASCENDING), ('lease_expires_at', ASCENDING)],
+                                     name='status_lease')
+        self.collection.create_index([('dedupe_key', ASCENDING), ('status', ASCENDING)],
+                                     name='dedupe_status')
+
+    def register(self, job_type, handler, on_failure=None):
+        """handler(payload, ctx) runs the job, on_failure(payload, error) runs once it fails for good"""
+        self._handlers[job_type] = (handler, on_failure)
+
+    def enqueue(self, job_type, payload, dedupe_key=None):
+        """
+        Persist a job and return its id. With a dedupe_key an identical job that
+        is still queued or running is returned instead of creating a second one.
+        """
+        now = datetime.utcnow()
+        if dedupe_key:
+            existing = self.collection.find_one(
+                {'dedupe_key': dedupe_key, 'status': {'$in': [QUEUED, RUNNING]}}, {'_id': 1})
+            if existing:
+                return existing['_id']
+        job_id = uuid.uuid4().hex
+        self.collection.insert_one({
+            '_id': job_id,
+            'type': job_type,
+            'payload': payload,
+            'dedupe_key': dedupe_key,
+            'status': QUEUED,
+            'attempts': 0,
+            'max_attempts': self.max_attempts,
+            'created_at': now,
+            'run_after': now,
+            'stage': 'queued'
+        })
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        return self.collection.find_one({'_id': job_id})
+
+    def start(self):
+        """Start the dispatcher and heartbeat threads (idempotent, max_workers=0 disables)"""
+        if self._started or self.max_workers < 1:
+            return
+        self._started = True
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+        print(f"🧵 Job queue started [{self.worker_id}] with {self.max_workers} worker thread(s)")
+
+    def heartbeat(self, job_id, stage=None, message=None):
+        """Extend the lease of a running job owned by this worker"""
+        update = {'lease_expires_at': datetime.utcnow() + timedelta(seconds=self.lease_seconds)}
+        if stage:
+            update['stage'] = stage
+        if message is not None:
+            update['message'] = message
+        self.collection.update_one({'_id': job_id, 'worker': self.worker_id, 'status': RUNNING},
+                                   {'$set': update})
+
+    def _claim(self):
+        """Atomically take the oldest runnable job, or one whose worker stopped renewing its lease"""
+        now = datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {'type': {'$in': list(self._handlers)},
+             '$or': [{'status': QUEUED, 'run_after': {'$lte': now}},
+                     {'status': RUNNING, 'lease_expires_at': {'$lt': now}}]},
+            {'$set': {'status': RUNNING, 'worker': self.worker_id, 'started_at': now,
+                      'lease_expires_at': now + timedelta(seconds=self.lease_seconds)},
+             '$inc': {'attempts': 1}},
+            sort=[('created_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _dispatch_loop(self):
+        while True:
+            # Only claim when a thread is free, so unclaimed jobs stay available to other processes
+            self._slots.acquire()
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"⚠️ Job claim failed: {e}")
+                job = None
+            if job is None:
+                self._slots.release()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            with self._lock:
+                self._running.add(job['_id'])
+            self._executor.submit(self._run, job)
+
+    def _heartbeat_loop(self):
+        # Renew leases well before they expire, even while a handler blocks in a subprocess
+        interval = max(self.lease_seconds / 3, 1)
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                running = list(self._running)
+            for job_id in running:
+                try:
+                    self.heartbeat(job_id)
+                except Exception as e:
+                    print(f"⚠️ Job heartbeat failed [{job_id}]: {e}")
+
+    def _run(self, job):
+        job_id = job['_id']
+        handler, on_failure = self._handlers[job['type']]
+        try:
+            if job['attempts'] > job.get('max_attempts', 1):
+                # Reclaimed after its worker died too many times
+                raise PermanentJobError(f"Job abandoned after {job['attempts'] - 1} attempt(s)")
+            print(f"▶️ Job started [{job_id}] {job['type']} (attempt {job['attempts']})")
+            result = handler(job['payload'], JobContext(self, job))
+            self.collection.update_one(
+                {'_id': job_id, 'worker': self.worker_id},
+                {'$set': {'status': COMPLETED, 'stage': 'completed', 'result': result,
+                          'finished_at': datetime.utcnow()},
+                 '$unset': {'lease_expires_at': '', 'error': ''}}
+            )
+            print(f"✅ Job completed [{job_id}]")
+        except Exception as e:
+            error = str(e)
+            retry = not isinstance(e, PermanentJobError) and job['attempts'] < job.get('max_attempts', 1)
+            print(f"❌ Job failed [{job_id}] (attempt {job['attempts']}): {error}")
+            if not isinstance(e, PermanentJobError):
+                traceback.print_exc()
+            if retry:
+                self.collection.update_one(
+                    {'_id': job_id, 'worker': self.worker_id},
+                    {'$set': {'status': QUEUED, 'stage': 'retry_scheduled', 'error': error,
+                              'run_after': datetime.utcnow() + timedelta(seconds=self.retry_delay)},
+                     '$unset': {'lease_expires_at': '', 'worker': ''}}
+                )
+            else:
+                self.collection.update_one(
+                    {'_id': job_id, 'worker': self.worker_id},
+                    {'$set': {'status': FAILED, 'stage': 'failed', 'error': error,
+                              'finished_at': datetime.utcnow()},
+                     '$unset': {'lease_expires_at': ''}}
+                )
+                if on_failure:
+                    try:
+                        on_failure(job['payload'], error)
+                    except Exception as hook_err:
+                        print(f"⚠️ Job failure hook error [{job_id}]: {hook_err}")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+            self._slots.release()
@@ -0,0 +1,144 @@
+"""
+Loss Model Module
+Estimated power and annual revenue loss of an audit's anomalies. Each anomaly
+type derates a share of its module's output (or of a whole string); the loss is
+computed over the summary's (type, module wattage) counts of the unresolved
+anomalies in one vectorized pass and cached on the audit summary until a resolve
+status, the plant or the settings change.
+"""
+import json
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from bson.objectid import ObjectId
+
+from anomaly_summary import module_watt_rows
+
+# Share of the affected module's (or string's) output lost per anomaly type
+DEFAULT_DERATING = {
+    'Cell': 0.05,
+    'Multi Cell': 0.15,
+    'Bypass Diode': 0.33,
+    'Short Circuit': 0.33,
+    'Junction Box': 0.33,
+    'Module Power Mismatch': 0.10,
+    'Module Offline': 1.0,
+    'Module Missing': 1.0,
+    'String Offline': 1.0,
+    'Partial String Offline': 0.5,
+    'Shading': 0.10,
+    'Vegetation': 0.10,
+    'Physical Damage': 0.20,
+    'Other': 0.05
+}
+
+# Types whose anomaly covers a whole string rather than one module
+STRING_TYPES = ('String Offline', 'Partial String Offline')
+
+# Plausible module ratings (W); anything else in 'Wat' is treated as missing
+MIN_MODULE_WATT = 10
+MAX_MODULE_WATT = 1500
+
+
+def module_watts(values):
+    """Numeric module rating for every raw 'Wat' value ('540', '540 W', 540.0); NaN when unusable"""
+    series = pd.Series(values, dtype='object')
+    numbers = pd.to_numeric(series.astype(str).str.extract(r'(\d+(?:\.\d+)?)', expand=False), errors='coerce')
+    return numbers.where((numbers >= MIN_MODULE_WATT) & (numbers <= MAX_MODULE_WATT)).to_numpy(dtype=float)
+
+
+class LossModel:
+    """Derating table, tariff and yield used to turn anomaly counts into kW and revenue"""
+
+    def __init__(self, tariff=4.0, specific_yield=1500.0, default_module_watt=540.0,
+                 modules_per_string=24, derating=None, default_derating=0.05):
+        self.tariff = float(tariff)                      # currency per kWh
+        self.specific_yield = float(specific_yield)      # kWh per kWp per year
+        self.default_module_watt = float(default_module_watt)
+        self.modules_per_string = int(modules_per_string)
+        self.derating = dict(DEFAULT_DERATING, **(derating or {}))
+        self.default_derating = float(default_derating)
+
+    @classmethod
+    def from_config(cls, get_config):
+        """Build the model from LOSS_* settings (LOSS_DERATING is a JSON object of overrides)"""
+        derating = get_config('LOSS_DERATING')
+        return cls(tariff=get_config('LOSS_TARIFF', 4.0),
+                   specific_yield=get_config('LOSS_SPECIFIC_YIELD', 1500),
+                   default_module_watt=get_config('LOSS_DEFAULT_MODULE_WATT', 540),
+                   modules_per_string=get_config('LOSS_MODULES_PER_STRING', 24),
+                   derating=json.loads(derating) if derating else None)
+
+    def settings_key(self, dc_capacity):
+        """Fingerprint of everything a cached loss depends on besides the counts"""
+        return json.dumps([self.tariff, self.specific_yield, self.default_module_watt, self.modules_per_string,
+                           self.default_derating, sorted(self.derating.items()), float(dc_capacity or 0)])
+
+    def compute(self, module_watt_rows, dc_capacity=None):
+        """
+        Loss of anomaly counts given as [{'anomaly_type', 'watt', 'count'}] (the
+        summary's module_watts). dc_capacity is the plant's DC capacity in MW and
+        caps the power loss. Power in kW, revenue per year.
+        """
+        rows = pd.DataFrame(list(module_watt_rows or []), columns=['anomaly_type', 'watt', 'count'])
+        counts = pd.to_numeric(rows['count'], errors='coerce').fillna(0).to_numpy(dtype=float)
+        watts = module_watts(rows['watt'])
+        known = ~np.isnan(watts)
+        # Modules without a rating get the audit's typical (count-weighted median) rating
+        fallback = self.default_module_watt
+        if counts[known].sum():
+            fallback = float(np.median(np.repeat(watts[known], counts[known].astype(int))))
+        watts = np.where(known, watts, fallback)
+
+        types = rows['anomaly_type'].fillna('Unknown').astype(str)
+        derating = types.map(self.derating).fillna(self.default_derating).to_numpy(dtype=float)
+        modules = np.where(types.isin(STRING_TYPES).to_numpy(), self.modules_per_string, 1)
+        loss_kw = counts * watts * derating * modules / 1000.0
+
+        by_type = pd.Series(loss_kw).groupby(types.to_numpy()).sum()
+        power_loss = float(loss_kw.sum())
+        capacity_kw = float(dc_capacity or 0) * 1000.0
+        if capacity_kw > 0:
+            power_loss = min(power_loss, capacity_kw)
+        return {
+            'power_loss_kw': round(power_loss, 2),
+            'revenue_loss': round(power_loss * self.specific_yield * self.tariff, 2),
+            'energy_loss_kwh': round(power_loss * self.specific_yield, 1),
+            'capacity_loss_percent': round(power_loss / capacity_kw * 100, 3) if capacity_kw > 0 else None,
+            'by_type_kw': {anomaly_type: round(float(kw), 3)
+                           for anomaly_type, kw in by_type.sort_values(ascending=False).items()},
+            'anomalies': int(counts.sum()),
+            'default_watt_used': int(counts[~known].sum()),
+            'tariff': self.tariff,
+            'specific_yield': self.specific_yield
+        }
+
+    def audit_loss(self, audits_collection, anomalies_collection, audit_id, summary, plant):
+        """
+        Loss of an audit from its current summary (anomaly_summary.get_audit_summary)
+        for the plant. Cached on the summary as anomaly_summary.loss and recomputed
+        only when the summary is rebuilt, a resolve status changes or the plant
+        capacity / settings change.
+        """
+        key = self.settings_key(plant.get('dc_capacity'))
+        cached = summary.get('loss') or {}
+        rows = summary.get('module_watts')
+        if cached.get('settings_key') == key and rows is not None:
+            return cached
+
+        query = {'_id': ObjectId(audit_id)}
+        update = {}
+        if rows is None:
+            # A status change dropped the rows: regroup the open anomalies, and only store
+            # them if no further change landed meanwhile (the change bumps anomalies_version)
+            audit = audits_collection.find_one(query, {'anomalies_version': 1}) or {}
+            query['anomalies_version'] = audit.get('anomalies_version')
+            rows = module_watt_rows(anomalies_collection, audit_id)
+            update['anomaly_summary.module_watts'] = rows
+
+        loss = self.compute(rows, plant.get('dc_capacity'))
+        loss.update(settings_key=key, computed_at=datetime.utcnow())
+        update['anomaly_summary.loss'] = loss
+        audits_collection.update_one(query, {'$set': update})
+        return loss
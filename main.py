@@ -1,7 +1,8 @@
 import shutil
 import zipfile
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file,
+                   Response, stream_with_context)
 from flask_pymongo import PyMongo
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
@@ -9,11 +10,11 @@ from bson.objectid import ObjectId
 import os
 from datetime import datetime, timedelta
 import json
+import gzip
 import subprocess
-import boto3
 import io
+import mimetypes
 from werkzeug.utils import secure_filename
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv,dotenv_values
 import  gdown
@@ -126,7 +127,31 @@ s3_prefix = get_config('s3_prefix', 'https://sylo-energy.s3.ap-south-1.amazonaws
 # Import enhanced upload configuration
 from upload_config import UploadConfig, StreamingUpload
 # Import upload progress tracking
-from upload_progress import UploadProgressTracker, StreamingUploadWithProgress, upload_status
+from upload_progress import UploadProgressTracker, StreamingUploadWithProgress, upload_status, progress_sinks
+from progress_store import ProgressStore
+# Import per-feature anomaly storage
+from anomaly_store import (ensure_anomaly_indexes, insert_audit_anomalies, delete_audit_anomalies,
+                           find_audit_features, build_feature_query, find_audit_page,
+                           find_viewport_features, get_features_extent, set_resolve_status,
+                           RESOLVE_STATUSES, MAX_BULK_STATUS_UPDATES, CENTROID_MAX_ZOOM,
+                           MAX_VIEWPORT_FEATURES, PAGE_SIZE, MAX_PAGE_SIZE)
+from anomaly_summary import (AnomalySummaryBuilder, get_audit_summary, sort_block_labels, build_chart_data,
+                             summary_totals)
+from anomaly_classification import ANOMALY_TYPE_COLORS
+from anomaly_trends import ensure_trend_indexes, plant_trends, TREND_AUDITS, HOTSPOT_LIMIT
+from anomaly_matching import classify_recurrence
+from loss_model import LossModel
+from geojson_stream import iter_geojson_features
+from anomaly_listing import (ListingError, ensure_listing_indexes, ensure_manual_indexes, stream_listing,
+                             stream_features_by_block)
+from s3_client import SharedS3Client
+from zip_pipeline import upload_zip_images
+from content_store import ContentIndex
+from upload_checksums import content_hash_of_bytes, FileDigest
+from s3_multipart import MultipartUploader, make_transfer_config, parse_s3_url, has_pending_upload
+from job_queue import JobQueue, PermanentJobError
+from audit_cache import AuditFeatureCache, get_cached_audit_features, get_audit_version
+from vector_tiles import MVT_ENABLED, MVT_MIMETYPE, TileCache, build_tile, is_valid_tile
 import uuid
 
 # Configure upload settings with enhanced support
@@ -149,18 +174,73 @@ plants_collection = mongo.db.plants
 audits_collection = mongo.db.audits
 data_uploads_collection = mongo.db.data_uploads
 anomalies_collection = mongo.db.anomalies
+# Anomalies reported by hand through POST /api/anomalies (not part of any audit's GeoJSON)
+manual_anomalies_collection = mongo.db.manual_anomalies
 anomaly_updates_collection = mongo.db.anomaly_updates
+jobs_collection = mongo.db.jobs
+upload_sessions_collection = mongo.db.upload_sessions
+file_contents_collection = mongo.db.file_contents
+upload_progress_collection = mongo.db.upload_progress
+
+# Indexes for the per-feature anomaly records
+try:
+    ensure_anomaly_indexes(anomalies_collection)
+    ensure_trend_indexes(audits_collection)
+    ensure_listing_indexes(anomalies_collection)
+    ensure_manual_indexes(manual_anomalies_collection)
+except Exception as e:
+    print(f"⚠️ Could not create anomaly indexes: {e}")
+
+# Per-worker cache of decoded audit features, validated against anomalies_version
+audit_feature_cache = AuditFeatureCache(
+    max_features=int(get_config('AUDIT_CACHE_MAX_FEATURES', 200000)),
+    max_entries=int(get_config('AUDIT_CACHE_MAX_ENTRIES', 64))
+)
+
+# Encoded vector tiles, shared by all workers on this host
+tile_cache = TileCache(os.path.join(UPLOAD_FOLDER, 'tiles'))
+
+# Power / revenue loss estimate of an audit's anomalies (LOSS_TARIFF, LOSS_DERATING, ...)
+loss_model = LossModel.from_config(get_config)
+
+# Upload progress shared by all workers: every tracker publishes into it (rate limited)
+progress_store = ProgressStore(upload_progress_collection)
+progress_sinks.append(progress_store.sink)
+try:
+    progress_store.ensure_indexes()
+except Exception as e:
+    print(f"⚠️ Could not create upload progress indexes: {e}")
+
+# Stored file/image contents by hash, so repeat uploads link to the existing copy
+content_index = ContentIndex(file_contents_collection)
+try:
+    content_index.ensure_indexes()
+except Exception as e:
+    print(f"⚠️ Could not create content indexes: {e}")
+
+# Threads used to push zip images to S3, the shared client's pool is sized to keep them all busy
+IMAGE_UPLOAD_WORKERS = int(get_config('IMAGE_UPLOAD_WORKERS', 50))
+
+s3_client = SharedS3Client(
+    access_key=get_config('aws_access_key_id'),
+    secret_key=get_config('aws_secret_access_key'),
+    region_name=get_config('region_name', 'ap-south-1'),  # example: Mumbai region
+    max_pool_connections=int(get_config(
+        'S3_MAX_POOL_CONNECTIONS',
+        # Enough for the image upload pool, or every job thread running a multipart upload
+        max(IMAGE_UPLOAD_WORKERS,
+            int(get_config('S3_MAX_CONCURRENCY', 8)) * max(int(get_config('JOB_WORKERS', 2)), 1))
+    ))
+)
+
 def get_s3_resource():
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=get_config('aws_access_key_id'),
-        aws_secret_access_key=get_config('aws_secret_access_key'),
-        region_name=get_config('region_name', 'ap-south-1')  # example: Mumbai region
-    )
-    return s3
+    """Process-wide S3 client (thread-safe, pooled connections)"""
+    return s3_client.get()
 
 
-non_access_function= ['get_admin', 'user_status_update','register', 'add_audit', 'plants_api', 'upload_file', 'anomalies_api', 'upload', 'upload_images_parallel','get_geojson', 'assign_client']
+non_access_function= ['get_admin', 'user_status_update','register', 'add_audit', 'plants_api', 'upload_file', 'anomalies_api', 'upload', 'upload_images_parallel','get_geojson', 'assign_client',
+                    'lookup_upload_content', 'link_uploaded_content', 'init_direct_upload', 'direct_part_urls',
+                    'direct_uploaded_parts', 'complete_direct_upload', 'abort_direct_upload']
 
 def make_serializable(doc):
     for key, value in doc.items():
@@ -169,6 +249,17 @@ def make_serializable(doc):
         elif isinstance(value, datetime):
             doc[key] = value.date().isoformat()
     return doc
+def compressed_jsonify(payload, status=200):
+    """JSON response gzip-compressed when the client accepts it (large anomaly payloads)"""
+    body = json.dumps(payload, default=str, separators=(',', ':')).encode('utf-8')
+    response = app.response_class(mimetype='application/json', status=status)
+    if len(body) > 1024 and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip.compress(body, compresslevel=5)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_data(body)
+    return response
+
 def login_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session or (f.__name__  in non_access_function and session.get('user_role') != 'admin'):
@@ -421,21 +512,13 @@ def plant_detail(plant_id):
         return redirect(url_for('homepage'))
 
     # Get audits for this plant
-    audits = list(audits_collection.find({'plant_id': str(plant['_id'])}).sort('_id', -1))
-    analysis_data = []
-    try:
-
-        if audits and len(audits) >0:
-            for i in json.loads(audits[0]['anomalies'])['features']:
-                analysis_data.append(i['properties'])
-
-    except Exception as err:
-        print("Error into get features for analysis_data",err)
+    audits = list(audits_collection.find({'plant_id': str(plant['_id'])},
+                                         {'anomalies': 0, 'anomaly_summary': 0}).sort('_id', -1))
     get_session_user = session.get('user_role')
     role = 1 if get_session_user == 'admin' else 0
     audits = [make_serializable(i) for i in audits]
     print("audit length", len(audits))
-    return render_template('plant_detail_1.html', plant=plant, audits=audits,analysis_data=analysis_data,check_mate=role)
+    return render_template('plant_detail_1.html', plant=plant, audits=audits,check_mate=role)
 
 
 # @app.route('/api/audits', methods=['POST'])
@@ -563,47 +646,42 @@ def add_audit():
                 print("invalid jeojso file")
                 return jsonify({'success': False, 'message': 'Invalid GeoJSON file'}), 400
 
-        # Combine form data with file paths
-        complete_audit_data = {**audit_data, **uploaded_files}
-
-        # Here you would typically save to your database
-        # Example with MongoDB (if you're using it):
-        # from pymongo import MongoClient
-        # client = MongoClient('your_connection_string')
-        # db = client.your_database
-        # result = db.audits.insert_one(complete_audit_data)
-
-        # For now, just print the data
-        default_data = {}
         s3_path = f"audits/{str(audit_data['plant_id'])}/{str(audit_data['_id'])}/{geojson_file.filename}"
         audit_data['geojson_file_s3_path'] = s3_path
         print("coming above geojson",s3_path)
 
         anomalies_count = 0
         anomalies_corrected_count = 0
-        with open(uploaded_files['geojson_path']) as f:
-
-            geojson_data = json.load(f)
-            geojson_str = json.dumps(geojson_data)
-            geojson_bytes = io.BytesIO(geojson_str.encode('utf-8'))
-            get_s3_resource().upload_fileobj(geojson_bytes, bucket_name, s3_path)
-            print("data uploaded into s3 successfully")
-            # print(geojson_data)
-            import pandas as pd
-            new_dict = geojson_data
-            features = geojson_data['features']
-            defect_data = []
-            for i in features:
-                if i['properties']['Anomaly'] is not None:
-                    defect_data.append(i)
-            new_dict['features'] = defect_data
-            default_data = new_dict
-            anomalies_count = len(defect_data)
-        audit_data['anomalies'] = json.dumps(default_data)
+        # Original bytes go to S3 straight from disk, no parse / re-serialize round trip
+        get_s3_resource().upload_file(uploaded_files['geojson_path'], bucket_name, s3_path)
+        print("data uploaded into s3 successfully")
+        # Store one record per anomaly feature instead of a JSON blob on the audit.
+        # Features are parsed incrementally and written in batches so memory stays flat.
+        summary = AnomalySummaryBuilder()
+        try:
+            anomalies_count = insert_audit_anomalies(
+                anomalies_collection,
+                audit_data['_id'],
+                audit_data['plant_id'],
+                iter_geojson_features(uploaded_files['geojson_path']),
+                summary=summary
+            )
+        except Exception:
+            # Don't leave records of an audit that was never created
+            delete_audit_anomalies(anomalies_collection, audit_data['_id'])
+            raise
+        audit_data['anomalies_storage'] = 'collection'
+        audit_data['anomaly_summary'] = summary.to_document()
         audit_data['anomalies_count'] =anomalies_count
+        audit_data['anomalies_version'] = 1
         audit_data['anomalies_corrected_count'] = anomalies_corrected_count
         result = audits_collection.insert_one(audit_data)
         print("db insert result", result)
+        try:
+            # New / recurring against the plant's previous audit, for the map filter
+            classify_recurrence(anomalies_collection, audits_collection, audit_data['_id'])
+        except Exception as e:
+            print(f"⚠️ Recurrence classification failed for audit {audit_data['_id']}: {e}")
 
         return jsonify({
             'success': True,
@@ -619,16 +697,13 @@ def add_audit():
 @app.route('/audit/<audit_id>')
 @login_required
 def audit_detail(audit_id):
-    audit = audits_collection.find_one({'_id': ObjectId(audit_id)})
+    audit = audits_collection.find_one({'_id': ObjectId(audit_id)}, {'anomalies': 0})
     if not audit:
         flash('Audit not found', 'error')
         return redirect(url_for('homepage'))
     # print("=----audit",audit['anomalies'])
     plant = plants_collection.find_one({'_id': ObjectId(audit['plant_id'])})
 
-    # Get anomalies for this audit
-    anomalies = json.loads(audit['anomalies'])['features'] if audit and audit.get('anomalies')  else []  #list(anomalies_collection.find({'audit_id': audit_id}))
-    # print("---an", anomalies)
     #ortho_files = [i for i in audit['tif_files'] if i['status'] =='Completed'] if audit['tif_files'] else []
     tif_files = audit.get('tif_files')
     if isinstance(tif_files, list):
@@ -639,42 +714,22 @@ def audit_detail(audit_id):
     thermal_ortho = [i for i in audit['tif_files'] if i['ortho_type'] =='thermal_ortho' and i['status'] =='Completed']
     visual_ortho = [i for i in audit['tif_files'] if i['ortho_type'] == 'visual_ortho' and i['status'] =='Completed']
 
-    block_filters =[]
+    # Filter options and counts come from the summary materialized at ingest time
+    summary = get_audit_summary(audits_collection, anomalies_collection, audit)
+    block_filters = sort_block_labels(summary.get('by_block', {}).keys())
     anomaly_filter = []
-    anomaly_count = {}
-    # print("--anomalies",anomalies)
-    if anomalies:
-        for i in anomalies:
-            block_value = i['properties']['Block']
-            anomaly = i['properties']['Anomaly']
-            if block_value not in block_filters and block_value is not None :
-                block_filters.append(block_value)
-
-            if anomaly not in anomaly_filter and block_value is not None:
+    for type_counts in summary.get('block_type', {}).values():
+        for anomaly in type_counts:
+            if anomaly not in anomaly_filter:
                 anomaly_filter.append(anomaly)
-            if anomaly_count.get(anomaly):
-                anomaly_count[anomaly] +=1
-            else:
-                anomaly_count[anomaly] = 1
-    block_filters = sorted(block_filters, key=int)
+    anomaly_count = summary.get('by_type', {})
+    # Anomalies are loaded by the page from the paginated API, only the total is rendered
+    anomalies_total = summary.get('total', 0)
     s3_base_path = f"{s3_prefix}/audits/{str(audit['plant_id'])}/{str(audit_id)}"
     s3_tif_base_url = s3_prefix
-    fault_colors = {
-        "Cell": "#FF0000",
-        "Multi Cell": "#FFA500",
-        "Bypass Diode": "#9C27B0",
-        "Short Circuit": "#506E9A",
-        "String Offline": "#FF1A94",
-        "Module Power Mismatch": "#65E667",
-        "Shading": "#E77148",
-        "Vegetation": "#2E7D32",
-        "Other": "#8C52FF",
-        "Junction Box": "#BFC494",
-        "Physical Damage": "#C2185B",
-        "Module Missing": "#5CE1E6",
-        "Module Offline": "#545454",
-        "Partial String Offline": "#FF66C4"
-    }
+    # The map loads anomalies as tiles / viewport requests, it only needs the initial extent
+    map_extent = summary.get('extent')
+    fault_colors = ANOMALY_TYPE_COLORS
     audit = make_serializable(audit)
 
     # Add timestamp for cache busting
@@ -684,8 +739,10 @@ def audit_detail(audit_id):
     return render_template('audit_detail.html', 
                           audit=audit, 
                           plant=plant, 
-                          anomalies=anomalies,
-                          geojson=anomalies,
+                          anomalies_total=anomalies_total,
+                          map_extent=map_extent,
+                          tiles_enabled=MVT_ENABLED,
+                          detail_zoom=CENTROID_MAX_ZOOM,
                           s3_url=s3_url,
                           thermal_ortho=thermal_ortho, 
                           visual_ortho=visual_ortho, 
@@ -704,7 +761,7 @@ def data_page():
     # Get all plants for dropdown
     plants = list(plants_collection.find())
     # Get all audits for dropdown
-    audits = list(audits_collection.find())
+    audits = list(audits_collection.find({}, {'anomalies': 0, 'anomaly_summary': 0}))
 
     return render_template('data_upload.html', plants=plants, audits=audits)
 
@@ -753,10 +810,26 @@ def upload_file():
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         
         # Use streaming upload with progress tracking
-        streaming_upload = StreamingUploadWithProgress(file, file_path, tracker)
+        streaming_upload = StreamingUploadWithProgress(file, file_path, tracker,
+                                                       expected_sha256=request.form.get('sha256'))
         result = streaming_upload.save_with_progress()
         
         if result['success']:
+            # Same content stored before: keep the existing copy and drop the new one
+            content_hash = result['hashes']['content_hash']
+            existing = content_index.find(content_hash, file_size)
+            existing_path = content_index.local_copy(existing)
+            deduplicated_from = None
+            if existing_path and existing_path != file_path:
+                os.remove(file_path)
+                print(f"♻️ Duplicate upload [{upload_id}]: {filename} is {existing_path}")
+                deduplicated_from = filename
+                file_path = existing_path
+                filename = os.path.basename(existing_path)
+            elif existing:
+                content_index.replace_local_copy(content_hash, file_path)
+            content_index.register(content_hash, file_size, file_path=file_path)
+
             tracker.set_stage('saving_metadata', 'Saving file metadata to database')
             
             # Save file info to database
@@ -771,7 +844,11 @@ def upload_file():
                 'uploaded_by': session['user_id'],
                 'uploaded_at': datetime.utcnow(),
                 'upload_id': upload_id,
-                'file_size': file_size
+                'file_size': file_size,
+                'sha256': result['hashes']['sha256'],
+                'md5': result['hashes']['md5'],
+                'content_hash': content_hash,
+                'deduplicated': bool(deduplicated_from)
             }
 
             db_result = data_uploads_collection.insert_one(upload_data)
@@ -784,7 +861,9 @@ def upload_file():
                     'message': 'File uploaded successfully',
                     'upload_id': upload_id,
                     'filename': filename,
-                    'file_size': file_size
+                    'file_size': file_size,
+                    'content_hash': content_hash,
+                    'deduplicated': bool(deduplicated_from)
                 })
             else:
                 tracker.fail('Failed to save file metadata to database')
@@ -822,7 +901,8 @@ def anomalies_api():
             'created_by': session['user_id']
         }
 
-        result = anomalies_collection.insert_one(anomaly_data)
+        # Kept apart from the per-feature audit records (summaries, maps); GET lists them after those
+        result = manual_anomalies_collection.insert_one(anomaly_data)
 
         if result.inserted_id:
             return jsonify({'success': True, 'anomaly_id': str(result.inserted_id)})
@@ -830,23 +910,14 @@ def anomalies_api():
             return jsonify({'success': False, 'message': 'Failed to create anomaly'})
 
     else:  # GET
-        audit_id = request.args.get('audit_id')
-        plant_id = request.args.get('plant_id')
-
-        query = {}
-        if audit_id:
-            query['audit_id'] = audit_id
-        if plant_id:
-            query['plant_id'] = plant_id
-
-        anomalies = list(anomalies_collection.find(query))
-
-        # Convert ObjectId to string for JSON serialization
-        for anomaly in anomalies:
-            anomaly['_id'] = str(anomaly['_id'])
-            anomaly['detected_at'] = anomaly['detected_at'].isoformat()
-
-        return jsonify({'anomalies': anomalies})
+        # Cursor paginated listing:
+        # audit_id, plant_id, block, type, severity, resolve_status, fields, sort, limit, cursor
+        # The last page also carries the matching hand-reported anomalies
+        try:
+            body = stream_listing(anomalies_collection, request.args, manual_collection=manual_anomalies_collection)
+        except ListingError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        return Response(stream_with_context(body), mimetype='application/json')
 
 
 @app.route('/api/anomalies/<audit_id>/status', methods=['PUT'])
@@ -855,38 +926,144 @@ def update_anomaly_status(audit_id):
     data = request.get_json()
     new_status = data.get('status')
     anomaly_id = data.get('anomaly_id')
-    if new_status not in ['pending', 'resolved', 'anomaly_id']:
+    if new_status not in RESOLVE_STATUSES:
         print("-----")
         return jsonify({'success': False, 'message': 'Invalid status'})
-    audit = audits_collection.find_one({"_id":ObjectId(audit_id)}, {"anomalies":1})
-    anomalies = json.loads(audit['anomalies']) if audit and audit.get('anomalies') else []
-    print("-----")
-    anomalies_corrected_count =  {"anomalies_corrected_count": -1} if  new_status  =='pending' else  {"anomalies_corrected_count": 1}
-    if anomalies and anomalies['features']:
-        new_dict = anomalies
-        features = anomalies['features']
-        defect_data = []
-        for i in features:
-            if i['properties']['Image name'] == anomaly_id:
-                up_data_new = i
-                up_data_new['resolve_status']= new_status
-                defect_data.append(up_data_new)
-            else:
-                defect_data.append(i)
-
-        new_dict['features'] = defect_data
-        default_data = new_dict
-        audit_data = {}
-        audit_data['anomalies'] = json.dumps(default_data)
-        result = audits_collection.update_one({'_id': ObjectId(audit_id)},{"$set":audit_data,
-                                                                           "$inc":anomalies_corrected_count
-                                                                           })
+    audit = audits_collection.find_one({"_id":ObjectId(audit_id)}, {"_id":1})
     if audit:
-        return jsonify({'success': True, 'message': 'Status updated successfully'})
+        # Updates the single matching record and its counter together
+        changed = set_resolve_status(anomalies_collection, audits_collection, audit_id, [anomaly_id], new_status)
+        return jsonify({'success': True, 'message': 'Status updated successfully', 'updated': changed})
     else:
         return jsonify({'success': False, 'message': 'Failed to update status'})
 
 
+@app.route('/api/anomalies/<audit_id>/status/bulk', methods=['PUT'])
+@login_required
+def bulk_update_anomaly_status(audit_id):
+    """Set the resolve status of many anomalies of an audit in one request"""
+    data = request.get_json() or {}
+    new_status = data.get('status')
+    anomaly_ids = data.get('anomaly_ids') or []
+    if new_status not in RESOLVE_STATUSES:
+        return jsonify({'success': False, 'message': 'Invalid status'}), 400
+    if not isinstance(anomaly_ids, list) or not anomaly_ids:
+        return jsonify({'success': False, 'message': 'anomaly_ids must be a non-empty list'}), 400
+    if len(anomaly_ids) > MAX_BULK_STATUS_UPDATES:
+        return jsonify({'success': False, 'message': f'At most {MAX_BULK_STATUS_UPDATES} anomalies per request'}), 400
+
+    audit = audits_collection.find_one({"_id": ObjectId(audit_id)}, {"_id": 1})
+    if not audit:
+        return jsonify({'success': False, 'message': 'Audit not found'}), 404
+
+    try:
+        changed = set_resolve_status(anomalies_collection, audits_collection, audit_id, anomaly_ids, new_status)
+        print(f"✅ Bulk status update [{audit_id}]: {changed}/{len(anomaly_ids)} anomalies set to {new_status}")
+        return jsonify({'success': True, 'message': 'Status updated successfully',
+                        'requested': len(anomaly_ids), 'updated': changed})
+    except Exception as e:
+        print(f"❌ Bulk status update failed [{audit_id}]: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to update status'}), 500
+
+
+@app.route('/api/audit/<audit_id>/recurrence', methods=['GET', 'POST'])
+@login_required
+def audit_recurrence(audit_id):
+    """New / recurring / fixed-since-last-audit counts; POST recomputes them"""
+    try:
+        audit = audits_collection.find_one({'_id': ObjectId(audit_id)}, {'recurrence_summary': 1})
+        if not audit:
+            return jsonify({'success': False, 'message': 'Audit not found'}), 404
+        summary = audit.get('recurrence_summary')
+        if request.method == 'POST' or not summary:
+            summary = classify_recurrence(anomalies_collection, audits_collection, audit_id)
+        return jsonify({'success': True, 'audit_id': audit_id, 'recurrence': summary})
+    except Exception as e:
+        print(f"❌ Recurrence failed for audit {audit_id}: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to classify recurrence'}), 500
+
+
+@app.route('/api/audit/<audit_id>/anomalies/page', methods=['GET'])
+@login_required
+def audit_anomalies_page(audit_id):
+    """Paginated anomalies of an audit for the inspection list (cursor = last seq seen)"""
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        after_seq = int(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor or limit'}), 400
+
+    filters = {
+        'block': request.args.get('block'),
+        'anomaly': request.args.get('an'),
+        'resolve_status': request.args.get('status'),
+        'recurrence': request.args.get('recurrence')
+    }
+    try:
+        items, next_cursor = find_audit_page(anomalies_collection, audit_id, after_seq, limit, **filters)
+        payload = {'success': True, 'items': items, 'next_cursor': next_cursor}
+        if after_seq is None:
+            # Total only on the first page so the list can size its scrollbar
+            payload['total'] = anomalies_collection.count_documents(build_feature_query(audit_id, **filters))
+        return compressed_jsonify(payload)
+    except Exception as e:
+        print(f"❌ Error fetching anomalies page for audit {audit_id}: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to fetch anomalies'}), 500
+
+
+@app.route('/api/audit/<audit_id>/tiles/<int:z>/<int:x>/<int:y>.mvt')
+@login_required
+def audit_vector_tile(audit_id, z, x, y):
+    """Anomalies of an audit as a Mapbox Vector Tile (clusters below the detail zoom)"""
+    if not MVT_ENABLED:
+        return jsonify({'success': False, 'message': 'Vector tiles are not available. Required libraries not installed.'}), 501
+
+    crs = request.args.get('crs', 'EPSG:3857')
+    if not is_valid_tile(z, x, y, crs):
+        return jsonify({'success': False, 'message': 'Invalid tile'}), 400
+
+    version = get_audit_version(audits_collection, audit_id)
+    if version is None:
+        return jsonify({'success': False, 'message': 'Audit not found'}), 404
+
+    block = request.args.get('block')
+    anomaly = request.args.get('an')
+    recurrence = request.args.get('recurrence')
+    filtered = bool(block or anomaly or recurrence)
+    try:
+        # Only unfiltered tiles are cached, filtered ones are small and rarely repeated
+        data = None if filtered else tile_cache.get(audit_id, version, crs, z, x, y)
+        if data is None:
+            data = build_tile(anomalies_collection, audit_id, z, x, y, crs, block=block, anomaly=anomaly,
+                              recurrence=recurrence)
+            if not filtered:
+                tile_cache.put(audit_id, version, crs, z, x, y, data)
+    except Exception as e:
+        print(f"❌ Tile {z}/{x}/{y} failed for audit {audit_id}: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to build tile'}), 500
+
+    response = Response(data, mimetype=MVT_MIMETYPE)
+    # Revalidate on every use; the ETag changes with anomalies_version
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{audit_id}-{version}-{crs}-{z}-{x}-{y}-{block or ''}-{anomaly or ''}-{recurrence or ''}")
+    return response.make_conditional(request)
+
+
+@app.route('/api/cache/stats')
+@login_required
+def audit_cache_stats():
+    """Hit/miss counters of this worker's audit feature cache"""
+    return jsonify({'success': True, 'worker_pid': os.getpid(), 'cache': audit_feature_cache.stats()})
+
+
+@app.route('/api/s3/pool-stats')
+@login_required
+def s3_pool_stats():
+    """Connection pool usage of this worker's shared S3 client"""
+    return jsonify({'success': True, 'worker_pid': os.getpid(), 's3': s3_client.stats()})
+
+
 @app.route('/api/dashboard/stats')
 @login_required
 def dashboard_stats():
@@ -894,24 +1071,17 @@ def dashboard_stats():
     total_plants = plants_collection.count_documents({})
     total_audits = audits_collection.count_documents({})
 
-    # Anomaly statistics
-    total_anomalies = anomalies_collection.count_documents({})
-    resolved_anomalies = anomalies_collection.count_documents({'status': 'resolved'})
-    pending_anomalies = anomalies_collection.count_documents({'status': 'pending'})
-
-    # Anomaly types distribution
-    anomaly_types = list(anomalies_collection.aggregate([
-        {'$group': {'_id': '$type', 'count': {'$sum': 1}}},
-        {'$sort': {'count': -1}}
-    ]))
+    # Anomaly statistics and type distribution from the per-audit summaries
+    totals = summary_totals(audits_collection, anomalies_collection)
 
     stats = {
         'total_plants': total_plants,
         'total_audits': total_audits,
-        'total_anomalies': total_anomalies,
-        'resolved_anomalies': resolved_anomalies,
-        'pending_anomalies': pending_anomalies,
-        'anomaly_types': anomaly_types
+        'total_anomalies': totals['total'],
+        'resolved_anomalies': totals['resolved'],
+        'pending_anomalies': totals['pending'],
+        'anomaly_types': totals['by_anomaly_type'],
+        'manual_anomalies': manual_anomalies_collection.count_documents({})
     }
 
     return jsonify(stats)
@@ -1054,109 +1224,107 @@ def uploaded_file(filename):
 
 
 
-def copy_to_s3(local_file_path, s3_bucket_path, aws_access_key, aws_secret_key):
-    env = os.environ.copy()
-    env["AWS_ACCESS_KEY_ID"] = aws_access_key
-    env["AWS_SECRET_ACCESS_KEY"] = aws_secret_key
-    env["AWS_DEFAULT_REGION"] = 'ap-south-1'
+# Multipart settings for COG uploads, part size and concurrency trade memory/sockets for throughput
+s3_transfer_config = make_transfer_config(
+    part_size_mb=int(get_config('S3_PART_SIZE_MB', 64)),
+    max_concurrency=int(get_config('S3_MAX_CONCURRENCY', 8)),
+    threshold_mb=int(get_config('S3_MULTIPART_THRESHOLD_MB', 64))
+)
 
-    try:
-        command = ["aws", "s3", "cp", local_file_path, s3_bucket_path]
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1,
-                              text=True) as process:
-            for line in process.stdout:
-                print(line, end='')  # shows real-time CLI progress bar
 
+def copy_to_s3(local_file_path, s3_bucket_path, tracker=None):
+    """
+    Upload a local file to an s3://bucket/key path with a concurrent, resumable
+    multipart upload. Part progress is reported to the tracker.
+    Returns True on success, False if the upload failed (it resumes on the next call).
+    """
+    bucket, key = parse_s3_url(s3_bucket_path)
+    uploader = MultipartUploader(get_s3_resource(), s3_transfer_config)
+
+    def progress(bytes_done, total_bytes):
+        if tracker:
+            tracker.total_size = total_bytes
+            tracker.update_progress(bytes_done, 'uploading_s3')
+
+    try:
+        uploader.upload(local_file_path, bucket, key, progress=progress)
         return True
-    except subprocess.CalledProcessError as e:
-        print("Upload failed:", e)
+    except Exception as e:
+        print(f"❌ S3 upload failed: {e}")
+        app.logger.error(f"S3 upload failed for {local_file_path}: {e}")
         return False
 
 
-@app.route('/audi_tif/upload', methods=['POST'])
-def upload():
-    upload_id = str(uuid.uuid4())
-    
-    try:
-        print(f"🚀 Starting TIF Upload [{upload_id}]")
-        print("request", request.form)
-        
-        fields= ['audit_type', 'plant_id',  'audit_id','g_url', 'tif_file_name']
-        inputs = {}
+TIF_JOB = 'tif_to_cog'
 
-        data = request.form
-        for i in fields:
-            if data.get(i):
-                inputs[i] = data.get(i)
-            else:
-                print(f"❌ TIF Upload Failed [{upload_id}]: Missing field {i}")
-                return jsonify({"status": False, "error": "Invalid params", "upload_id": upload_id}), 400
 
-        tracker = UploadProgressTracker(upload_id, inputs['tif_file_name'], 0)  # Size unknown initially
-        tracker.set_stage('validating', 'Checking Google Drive folder')
+def _tif_query(payload):
+    return {
+        "_id": ObjectId(payload['audit_id']),
+        "tif_files.tif_path": payload['tif_path']
+    }
 
-        try:
-            print(f"🔍 Validating Google Drive URL: {inputs['g_url']}")
-            
-            # Try to access the folder
-            files = gdown.download_folder(inputs['g_url'], skip_download=True, use_cookies=False)
-            
-            if not files:
-                error_msg = f"""No files found in Google Drive folder. 
-                
-TROUBLESHOOTING:
-1. Ensure the folder URL is correct
-2. Set folder permission to 'Anyone with the link'
-3. Check that the folder contains the TIF file: {inputs['tif_file_name']}
 
-Folder URL: {inputs['g_url']}"""
-                tracker.fail(error_msg)
-                print(f"❌ TIF Upload Failed [{upload_id}]: {error_msg}")
-                return jsonify({
-                    "status": False, 
-                    "error": "No files found in Google Drive folder", 
-                    "upload_id": upload_id,
-                    "troubleshooting": "Check folder permissions and URL"
-                }), 400
-            
-        except Exception as folder_err:
-            error_msg = f"""Cannot access Google Drive folder: {str(folder_err)}
+def _tif_upload_path(payload):
+    return os.path.join(
+        app.config['UPLOAD_FOLDER'],
+        str(payload['plant_id']),
+        'audit',
+        str(payload['audit_id'])
+    )
+
+
+def _lower_priority():
+    os.nice(10)
+
+
+def _download_and_convert_tif(payload, tracker, stage):
+    """Google Drive folder -> local TIF -> COG, returns the COG path"""
+    stage('validating', 'Checking Google Drive folder')
+    try:
+        print(f"🔍 Validating Google Drive URL: {payload['g_url']}")
+
+        # Try to access the folder
+        files = gdown.download_folder(payload['g_url'], skip_download=True, use_cookies=False)
+    except Exception as folder_err:
+        error_msg = f"""Cannot access Google Drive folder: {str(folder_err)}
 
 COMMON SOLUTIONS:
 1. Change folder permission to 'Anyone with the link'
 2. Use folder URL instead of file URL
 3. Ensure stable internet connection
 
-URL provided: {inputs['g_url']}"""
-            tracker.fail(error_msg)
-            print(f"❌ TIF Upload Failed [{upload_id}]: {error_msg}")
-            return jsonify({
-                "status": False, 
-                "error": "Cannot access Google Drive folder - check permissions", 
-                "upload_id": upload_id,
-                "details": str(folder_err)
-            }), 400
-
-        file_exist = False
-        file_name = None
-        file_id = None
-
-        print(f"📂 Found {len(files)} file(s) in Google Drive folder")
-        for file in files:
-            file_id_value = file[0]
-            file_name_found = file[1]
-            print(f"📁 Found file: {file_name_found} vs {inputs['tif_file_name']}")
-            if file_name_found == inputs['tif_file_name']:
-                print("file ---", file, file_id_value)
-                file_exist = True
-                file_name = inputs['tif_file_name']
-                file_id = file_id_value
-                break
+URL provided: {payload['g_url']}"""
+        tracker.fail(error_msg)
+        raise PermanentJobError(error_msg)
+
+    if not files:
+        error_msg = f"""No files found in Google Drive folder.
+
+TROUBLESHOOTING:
+1. Ensure the folder URL is correct
+2. Set folder permission to 'Anyone with the link'
+3. Check that the folder contains the TIF file: {payload['tif_file_name']}
+
+Folder URL: {payload['g_url']}"""
+        tracker.fail(error_msg)
+        raise PermanentJobError(error_msg)
+
+    file_name = None
+    file_id = None
+
+    print(f"📂 Found {len(files)} file(s) in Google Drive folder")
+    for file in files:
+        print(f"📁 Found file: {file[1]} vs {payload['tif_file_name']}")
+        if file[1] == payload['tif_file_name']:
+            file_name = payload['tif_file_name']
+            file_id = file[0]
+            break
 
-        if not file_exist:
-            # List available files for user reference
-            available_files = [file[1] for file in files]
-            error_msg = f"""TIF file '{inputs['tif_file_name']}' not found in Google Drive folder.
+    if not file_name:
+        # List available files for user reference
+        available_files = [file[1] for file in files]
+        error_msg = f"""TIF file '{payload['tif_file_name']}' not found in Google Drive folder.
 
 Available files in folder:
 {chr(10).join(f"- {f}" for f in available_files[:10])}
@@ -1166,108 +1334,54 @@ Please check:
 1. File name is exactly correct (case-sensitive)
 2. File exists in the specified folder
 3. File has proper extension (.tif or .tiff)"""
-            
-            tracker.fail(error_msg)
-            print(f"❌ TIF Upload Failed [{upload_id}]: {error_msg}")
-            return jsonify({
-                "status": False, 
-                "message": f"File '{inputs['tif_file_name']}' not found", 
-                "upload_id": upload_id,
-                "available_files": available_files[:10],
-                "total_files": len(available_files)
-            }), 400
-
-        tracker.set_stage('preparing_database', 'Setting up database records')
-
-        file_path = f"audits/{inputs['plant_id']}/{inputs['audit_id']}/{inputs['audit_type']}/{file_name}"
-        file_path = file_path
-        new_task = {
-            "tif_path": file_path,
-            "status": "In Progress",
-            "ortho_type": inputs['audit_type'],
-            "created_at": datetime.utcnow(),
-            "upload_id": upload_id
-        }
-
-        query = {
-            "_id": ObjectId(inputs['audit_id']),
-            "tif_files.tif_path": file_path
-        }
-        set_failed_status ={"$set": {"tif_files.$.status": "failed"  }}
-
-        existing = audits_collection.find_one(query)
-
-        if existing:
-            audits_collection.update_one(query,
-                {
-                    "$set": {
-                        "tif_files.$.status": 'In Progress',
-                        "created_at": datetime.utcnow()
-                    }
-                }
-            )
-        else:
-            audits_collection.update_one(
-                {"_id": ObjectId(inputs['audit_id'])},
-                {"$push": {"tif_files": new_task}}
-            )
-
-        tracker.set_stage('downloading', 'Downloading TIF file from Google Drive')
-
-        # Save original TIF
-        upload_path = os.path.join(
-            app.config['UPLOAD_FOLDER'],
-            str(inputs['plant_id']),
-            'audit',
-            str(inputs['audit_id'])
-        )
-        input_path = os.path.join(upload_path, file_name)
-        os.makedirs(upload_path, exist_ok=True)
-
+        tracker.fail(error_msg)
+        raise PermanentJobError(error_msg)
+
+    # Save original TIF
+    upload_path = _tif_upload_path(payload)
+    input_path = os.path.join(upload_path, file_name)
+    os.makedirs(upload_path, exist_ok=True)
+
+    url = f'https://drive.google.com/uc?id={file_id}'
+    stage('downloading', f'Downloading from Google Drive: {file_name}')
+    print(f"📥 Downloading from Google Drive: {url}")
+
+    # Try multiple download methods for better compatibility
+    download_success = False
+    download_methods = [
+        # Method 1: Standard gdown with fuzzy matching
+        lambda: gdown.download(url, input_path, quiet=True, fuzzy=True, use_cookies=False),
+        # Method 2: gdown with different parameters
+        lambda: gdown.download(url, input_path, quiet=True, fuzzy=False, use_cookies=True),
+        # Method 3: Direct file ID download
+        lambda: gdown.download(f'https://drive.google.com/file/d/{file_id}/view', input_path, quiet=True, fuzzy=True),
+        # Method 4: Alternative URL format
+        lambda: gdown.download(f'https://drive.google.com/open?id={file_id}', input_path, quiet=True, fuzzy=True)
+    ]
+
+    for i, method in enumerate(download_methods, 1):
         try:
-            url = f'https://drive.google.com/uc?id={file_id}'
-            tracker.set_stage('downloading', f'Downloading from Google Drive: {file_name}')
-            print(f"📥 Downloading from Google Drive: {url}")
-            
-            # Try multiple download methods for better compatibility
-            download_success = False
-            download_methods = [
-                # Method 1: Standard gdown with fuzzy matching
-                lambda: gdown.download(url, input_path, quiet=False, fuzzy=True, use_cookies=False),
-                # Method 2: gdown with different parameters
-                lambda: gdown.download(url, input_path, quiet=False, fuzzy=False, use_cookies=True),
-                # Method 3: Direct file ID download
-                lambda: gdown.download(f'https://drive.google.com/file/d/{file_id}/view', input_path, quiet=False, fuzzy=True),
-                # Method 4: Alternative URL format
-                lambda: gdown.download(f'https://drive.google.com/open?id={file_id}', input_path, quiet=False, fuzzy=True)
-            ]
-            
-            for i, method in enumerate(download_methods, 1):
-                try:
-                    print(f"🔄 Trying download method {i}/4...")
-                    tracker.set_stage('downloading', f'Attempting download method {i}/4')
-                    
-                    method()
-                    
-                    # Verify download success
-                    if os.path.exists(input_path) and os.path.getsize(input_path) > 0:
-                        actual_size = os.path.getsize(input_path)
-                        tracker.total_size = actual_size
-                        tracker.update_progress(actual_size, 'download_complete')
-                        print(f"✅ Download Complete (Method {i}): {file_name} ({actual_size} bytes)")
-                        download_success = True
-                        break
-                    else:
-                        print(f"⚠️ Method {i} failed: File not found or empty")
-                        continue
-                        
-                except Exception as method_err:
-                    print(f"⚠️ Method {i} failed: {str(method_err)}")
-                    continue
-            
-            if not download_success:
-                # Provide detailed error message with instructions
-                error_msg = f"""Failed to download file from Google Drive after trying all methods.
+            print(f"🔄 Trying download method {i}/4...")
+            stage('downloading', f'Attempting download method {i}/4')
+
+            method()
+
+            # Verify download success
+            if os.path.exists(input_path) and os.path.getsize(input_path) > 0:
+                actual_size = os.path.getsize(input_path)
+                tracker.total_size = actual_size
+                tracker.update_progress(actual_size, 'download_complete')
+                print(f"✅ Download Complete (Method {i}): {file_name} ({actual_size} bytes)")
+                download_success = True
+                break
+            else:
+                print(f"⚠️ Method {i} failed: File not found or empty")
+        except Exception as method_err:
+            print(f"⚠️ Method {i} failed: {str(method_err)}")
+
+    if not download_success:
+        # Provide detailed error message with instructions
+        error_msg = f"""Failed to download file from Google Drive after trying all methods.
 
 TROUBLESHOOTING STEPS:
 1. Ensure the Google Drive file has 'Anyone with the link' permission
@@ -1279,137 +1393,226 @@ File ID: {file_id}
 Attempted URL: {url}
 
 For better results, use a Google Drive folder URL containing the TIF file."""
-                
-                raise Exception(error_msg)
-                
-        except Exception as err:
-            error_msg = f"Error downloading file from Google Drive: {str(err)}"
-            tracker.fail(error_msg)
-            print(f"❌ Download Failed [{upload_id}]: {error_msg}")
-            app.logger.error(error_msg)
-            audits_collection.update_one(query, set_failed_status)
-            
-            # Provide user-friendly error response
-            return jsonify({
-                "status": False, 
-                "message": "Google Drive download failed - please check file permissions", 
-                "error": "Make sure the file has 'Anyone with the link' permission and try again",
-                "upload_id": upload_id,
-                "troubleshooting": {
-                    "step1": "Right-click the file in Google Drive",
-                    "step2": "Click 'Share'", 
-                    "step3": "Change permission to 'Anyone with the link'",
-                    "step4": "Copy the sharing link and try again"
-                }
-            })
+        tracker.fail(error_msg)
+        app.logger.error(error_msg)
+        # Transient Drive errors are common, let the queue retry
+        raise Exception(error_msg)
+
+    stage('converting', 'Converting TIF to COG format for optimization')
+    output_cog_path = os.path.join(upload_path, f"COG_{file_name}")
+
+    print(f"🔄 Starting GDAL conversion: {input_path} -> {output_cog_path}")
+    app.logger.info(f"GDAL conversion: {input_path} -> {output_cog_path}")
+
+    # Convert to COG
+    conversion_cmd = [
+        "gdal_translate", "-of", "COG",
+        "-co", "COMPRESS=DEFLATE",
+        "-co", "BLOCKSIZE=512",
+        "-co", "BIGTIFF=YES",
+        input_path,
+        output_cog_path
+    ]
+    print(f"🔧 GDAL Command: {' '.join(conversion_cmd)}")
+    try:
+        # Lower priority so conversions never starve the web workers of CPU
+        subprocess.check_call(conversion_cmd, preexec_fn=_lower_priority if os.name == 'posix' else None)
+    except subprocess.CalledProcessError as e:
+        error_msg = f"GDAL conversion failed: {str(e)}"
+        tracker.fail(error_msg)
+        app.logger.error(error_msg)
+        raise PermanentJobError(error_msg)
+
+    # Verify COG creation
+    if not os.path.exists(output_cog_path):
+        tracker.fail("COG file was not created")
+        raise PermanentJobError("COG file was not created")
+    cog_size = os.path.getsize(output_cog_path)
+    print(f"✅ COG Conversion Complete: {output_cog_path} ({cog_size} bytes)")
+    stage('conversion_complete', f'COG conversion completed ({cog_size} bytes)')
+    return output_cog_path
+
+
+def process_tif_job(payload, ctx):
+    """Background job: Google Drive folder -> download -> COG conversion -> S3"""
+    upload_id = payload['upload_id']
+    query = _tif_query(payload)
+    file_path = payload['tif_path']
+
+    tracker = UploadProgressTracker(upload_id, payload['tif_file_name'], 0)  # Size unknown initially
+    audits_collection.update_one(query, {"$set": {"tif_files.$.status": "In Progress"}})
+
+    def stage(name, message):
+        tracker.set_stage(name, message)
+        ctx.progress(name, message)
+
+    output_cog_path = os.path.join(_tif_upload_path(payload), f"COG_{payload['tif_file_name']}")
+    if has_pending_upload(output_cog_path):
+        # A previous attempt converted the file and started uploading it
+        print(f"🔁 Resuming S3 upload of {output_cog_path}")
+    else:
+        output_cog_path = _download_and_convert_tif(payload, tracker, stage)
+    upload_path = os.path.dirname(output_cog_path)
+    file_name = payload['tif_file_name']
 
-        tracker.set_stage('converting', 'Converting TIF to COG format for optimization')
-        output_cog_path = os.path.join(upload_path, f"COG_{file_name}")
-        
-        print(f"🔄 Starting GDAL conversion: {input_path} -> {output_cog_path}")
-        app.logger.info(f"GDAL conversion: {input_path} -> {output_cog_path}")
-        
-        # Convert to COG
-        try:
-            conversion_cmd = [
-                "gdal_translate", "-of", "COG",
-                "-co", "COMPRESS=DEFLATE",
-                "-co", "BLOCKSIZE=512",
-                "-co", "BIGTIFF=YES",
-                input_path,
-                output_cog_path
-            ]
-            print(f"🔧 GDAL Command: {' '.join(conversion_cmd)}")
-            
-            subprocess.check_call(conversion_cmd)
-            
-            # Verify COG creation
-            if os.path.exists(output_cog_path):
-                cog_size = os.path.getsize(output_cog_path)
-                print(f"✅ COG Conversion Complete: {output_cog_path} ({cog_size} bytes)")
-                tracker.set_stage('conversion_complete', f'COG conversion completed ({cog_size} bytes)')
+    stage('uploading_s3', 'Uploading to AWS S3 cloud storage')
+    s3_path = f"s3://{bucket_name}/{file_path}"
+    print(f"☁️ Starting S3 upload: {output_cog_path} -> {s3_path}")
+
+    s3_upload_status = copy_to_s3(output_cog_path, s3_path, tracker)
+    if s3_upload_status == False:
+        error_msg = "S3 upload failed - please check AWS credentials and permissions"
+        tracker.fail(error_msg)
+        raise Exception(error_msg)
+
+    print(f"✅ S3 Upload Successful: {s3_path}")
+    stage('s3_upload_complete', f'File uploaded to S3: {s3_path}')
+
+    stage('cleaning_up', 'Cleaning up temporary files')
+    print(f"🧹 Cleaning up temporary files: {upload_path}")
+    try:
+        shutil.rmtree(upload_path)
+        print(f"✅ Cleanup Complete: {upload_path}")
+    except OSError as e:
+        print(f"⚠️ Cleanup Warning: {e.filename} - {e.strerror}")
+
+    # Mark as completed in database
+    audits_collection.update_one(query, {
+        "$set": {
+            "tif_files.$.status": "Completed",
+            "tif_files.$.s3_path": s3_path,
+            "tif_files.$.completed_at": datetime.utcnow()
+        }
+    })
+
+    tracker.complete(s3_path)
+    print(f"🎉 TIF Upload Complete [{upload_id}]: {file_name} -> {s3_path}")
+    return {'s3_path': s3_path}
+
+
+def fail_tif_job(payload, error):
+    """Job gave up: reflect it on the audit's tif_files entry"""
+    audits_collection.update_one(_tif_query(payload), {
+        "$set": {"tif_files.$.status": "failed", "tif_files.$.error": error[:2000]}
+    })
+
+
+job_queue = JobQueue(
+    jobs_collection,
+    max_workers=int(get_config('JOB_WORKERS', 2)),
+    lease_seconds=int(get_config('JOB_LEASE_SECONDS', 300))
+)
+job_queue.register(TIF_JOB, process_tif_job, on_failure=fail_tif_job)
+try:
+    job_queue.ensure_indexes()
+except Exception as e:
+    print(f"⚠️ Could not create job indexes: {e}")
+job_queue.start()
+
+
+@app.route('/audi_tif/upload', methods=['POST'])
+def upload():
+    upload_id = str(uuid.uuid4())
+
+    try:
+        print(f"🚀 Queueing TIF Upload [{upload_id}]")
+        print("request", request.form)
+
+        fields = ['audit_type', 'plant_id', 'audit_id', 'g_url', 'tif_file_name']
+        inputs = {}
+
+        data = request.form
+        for i in fields:
+            if data.get(i):
+                inputs[i] = data.get(i)
             else:
-                raise Exception("COG file was not created")
-                
-        except subprocess.CalledProcessError as e:
-            error_msg = f"GDAL conversion failed: {str(e)}"
-            tracker.fail(error_msg)
-            print(f"❌ Conversion Failed [{upload_id}]: {error_msg}")
-            app.logger.error(error_msg)
-            audits_collection.update_one(query, set_failed_status)
-            return jsonify({'error': 'GDAL conversion failed', 'details': str(e), 'upload_id': upload_id}), 500
+                print(f"❌ TIF Upload Failed [{upload_id}]: Missing field {i}")
+                return jsonify({"status": False, "error": "Invalid params", "upload_id": upload_id}), 400
 
-        try:
-            tracker.set_stage('uploading_s3', 'Uploading to AWS S3 cloud storage')
-            s3_path = f"s3://{bucket_name}/{file_path}"
-            print(f"☁️ Starting S3 upload: {output_cog_path} -> {s3_path}")
-            print(f"🔑 AWS Config: Key={get_config('aws_access_key_id')[:10]}..., Region={get_config('region_name', 'ap-south-1')}")
-
-            s3_upload_status = copy_to_s3(
-                output_cog_path,
-                s3_path,
-                get_config('aws_access_key_id'),
-                get_config('aws_secret_access_key')
+        file_path = f"audits/{inputs['plant_id']}/{inputs['audit_id']}/{inputs['audit_type']}/{inputs['tif_file_name']}"
+        payload = {**inputs, 'tif_path': file_path, 'upload_id': upload_id}
+
+        # The tif_files entry exists as Queued before a worker can claim the job, so the
+        # worker's status updates always find it and are never overwritten from here
+        query = _tif_query(payload)
+        pushed = audits_collection.update_one(
+            {"_id": ObjectId(inputs['audit_id']), "tif_files.tif_path": {"$ne": file_path}},
+            {"$push": {"tif_files": {
+                "tif_path": file_path,
+                "status": "Queued",
+                "ortho_type": inputs['audit_type'],
+                "created_at": datetime.utcnow(),
+                "upload_id": upload_id
+            }}}
+        ).modified_count
+        if not pushed:
+            # Re-upload: requeue unless a job for this ortho is already processing it
+            audits_collection.update_one(
+                {"_id": ObjectId(inputs['audit_id']),
+                 "tif_files": {"$elemMatch": {"tif_path": file_path, "status": {"$ne": "In Progress"}}}},
+                {"$set": {"tif_files.$.status": 'Queued', "tif_files.$.created_at": datetime.utcnow()}}
             )
-            
-            if s3_upload_status == False:
-                error_msg = "S3 upload failed - please check AWS credentials and permissions"
-                tracker.fail(error_msg)
-                print(f"❌ S3 Upload Failed [{upload_id}]: {error_msg}")
-                audits_collection.update_one(query, set_failed_status)
-                return jsonify({"status": False, "message": "S3 upload failed", "upload_id": upload_id})
-            
-            print(f"✅ S3 Upload Successful: {s3_path}")
-            tracker.set_stage('s3_upload_complete', f'File uploaded to S3: {s3_path}')
 
-            tracker.set_stage('cleaning_up', 'Cleaning up temporary files')
-            print(f"🧹 Cleaning up temporary files: {upload_path}")
-            
-            try:
-                shutil.rmtree(upload_path)
-                print(f"✅ Cleanup Complete: {upload_path}")
-            except OSError as e:
-                print(f"⚠️ Cleanup Warning: {e.filename} - {e.strerror}")
-
-            # Mark as completed in database
-            audits_collection.update_one(query, {
-                "$set": {
-                    "tif_files.$.status": "Completed",
-                    "tif_files.$.s3_path": s3_path,
-                    "tif_files.$.completed_at": datetime.utcnow()
-                }
-            })
-            
-            tracker.complete(s3_path)
-            print(f"🎉 TIF Upload Complete [{upload_id}]: {file_name} -> {s3_path}")
-            
-        except Exception as err:
-            error_msg = f"S3 upload error: {str(err)}"
-            tracker.fail(error_msg)
-            print(f"❌ S3 Upload Error [{upload_id}]: {error_msg}")
-            audits_collection.update_one(query, set_failed_status)
-            return jsonify({"status": False, "message": "Upload processing failed", "upload_id": upload_id})
+        # The same ortho already queued or running is not processed twice
+        job_id = job_queue.enqueue(TIF_JOB, payload, dedupe_key=f"{inputs['audit_id']}:{file_path}")
+        upload_id = job_queue.get(job_id)['payload']['upload_id']
+        audits_collection.update_one(query, {
+            "$set": {"tif_files.$.job_id": job_id, "tif_files.$.upload_id": upload_id}
+        })
+
+        print(f"📋 TIF Upload Queued [{upload_id}]: job {job_id}")
+        return jsonify({"status": True, "message": "File queued for processing",
+                        "job_id": job_id, "upload_id": upload_id}), 202
 
-        return jsonify({"status": True, "message":"File uploaded completed", "upload_id": upload_id})
-    
     except Exception as e:
         error_msg = f"TIF upload failed: {str(e)}"
         print(f"❌ TIF Upload Exception [{upload_id}]: {error_msg}")
-        if upload_id in upload_status:
-            upload_status[upload_id].fail(error_msg)
         return jsonify({"status": False, "message": error_msg, "upload_id": upload_id})
 
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    """State of a background job (queued / running / completed / failed)"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify({
+        'success': True,
+        'job': {
+            'job_id': job['_id'],
+            'type': job['type'],
+            'status': job['status'],
+            'stage': job.get('stage'),
+            'message': job.get('message'),
+            'attempts': job.get('attempts', 0),
+            'error': job.get('error'),
+            'result': job.get('result'),
+            'created_at': job.get('created_at'),
+            'started_at': job.get('started_at'),
+            'finished_at': job.get('finished_at')
+        }
+    })
+
 def upload_single_file(file_name, file_bytes):
-    try:
-        get_s3_resource().upload_fileobj(
+    """
+    Upload one image to S3 (raises on failure). An image already stored under
+    another key is copied inside S3 instead, nothing is sent from this server.
+    """
+    s3 = get_s3_resource()
+    content_hash = content_hash_of_bytes(file_bytes)
+    existing = content_index.s3_copy(content_index.find(content_hash, len(file_bytes)), s3)
+    if existing and existing[1] != file_name:
+        s3.copy_object(CopySource={'Bucket': existing[0], 'Key': existing[1]}, Bucket=bucket_name, Key=file_name)
+    elif not existing:
+        s3.upload_fileobj(
             io.BytesIO(file_bytes),
             bucket_name,
             f'{file_name }',
-            ExtraArgs={'ContentType': 'image/jpeg'}  # optionally detect mime type
+            ExtraArgs={'ContentType': mimetypes.guess_type(file_name)[0] or 'image/jpeg'}
         )
-        return file_name
-    except Exception as e:
-        return f"Failed: {file_name} ({str(e)})"
+    content_index.register(content_hash, len(file_bytes), s3_bucket=bucket_name, s3_key=file_name)
+    return file_name
 
 
 # @app.route("/api/anomalies/<anomoly_id>/status", methods=['PUT'])
@@ -1417,9 +1620,67 @@ def upload_single_file(file_name, file_bytes):
 #     print(request.form,anomoly_id)
 #     return {}
 
+ZIP_JOB = 'zip_images'
+
+# Decompressed bytes allowed to wait for upload before the zip reader pauses
+ZIP_INFLIGHT_BYTES = int(get_config('ZIP_INFLIGHT_MB', 256)) * 1024 * 1024
+
+
+def process_zip_job(payload, ctx):
+    """Background job: stream the images of a saved zip to S3"""
+    zip_local_path = payload['zip_local_path']
+    if not os.path.exists(zip_local_path):
+        raise PermanentJobError(f"Zip file not found: {zip_local_path}")
+    audits_collection.update_one({"_id": ObjectId(payload['audit_id'])},
+                                 {"$set": {"zip_upload_status": "In Progress"}})
+    ctx.progress('uploading', 'Uploading images to S3')
+
+    def progress(done, total, failed):
+        ctx.progress('uploading', f'{done}/{total} image(s) uploaded, {failed} failed')
+
+    try:
+        result = upload_zip_images(
+            zip_local_path,
+            upload_single_file,
+            key_for=lambda name: f"{payload['zip_path']}{name}",
+            workers=IMAGE_UPLOAD_WORKERS,
+            max_inflight_bytes=ZIP_INFLIGHT_BYTES,
+            progress=progress
+        )
+    except zipfile.BadZipFile as e:
+        raise PermanentJobError(f"Invalid zip file: {e}")
+
+    print(f"🖼️ Zip images uploaded [{payload['audit_id']}]: {result['uploaded']}/{result['total']}, "
+          f"{len(result['failed'])} failed, peak buffered {result['peak_inflight_bytes']} bytes")
+    if result['failed'] and not result['uploaded']:
+        raise Exception(f"All {len(result['failed'])} image upload(s) failed")
+
+    audits_collection.update_one({"_id": ObjectId(payload['audit_id'])},
+                                 {"$set": {"zip_upload_status": "Completed",
+                                           "zip_upload_failed": result['failed'][:1000],
+                                           "zip_content_hash": payload.get('zip_content_hash')}})
+    try:
+        os.remove(zip_local_path)
+    except OSError as e:
+        print(f"⚠️ Cleanup Warning: {e}")
+    result['failed'] = result['failed'][:1000]
+    return result
+
+
+def fail_zip_job(payload, error):
+    audits_collection.update_one({"_id": ObjectId(payload['audit_id'])},
+                                 {"$set": {"zip_upload_status": "Failed", "zip_upload_error": error[:2000]}})
+    try:
+        os.remove(payload['zip_local_path'])
+    except OSError:
+        pass
+
+
+job_queue.register(ZIP_JOB, process_zip_job, on_failure=fail_zip_job)
+
+
 @app.route('/audit/upload-images-from-zip-parallel', methods=['POST'])
 def upload_images_parallel():
-    file = request.files['zip_file']
     fields = ['plant_id', 'audit_id']
     print("coming request")
     inputs = {}
@@ -1444,62 +1705,96 @@ def upload_images_parallel():
         return jsonify({'error': 'Empty filename'}), 400
 
     zip_path = f"audits/{str(inputs['plant_id'])}/{str(inputs['audit_id'])}/zip_images/"
-    uploaded_files = []
+
+    # Keep the archive on disk, the job reads it one entry at a time
+    local_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(inputs['plant_id']), 'audit',
+                             str(inputs['audit_id']), 'zip')
+    os.makedirs(local_dir, exist_ok=True)
+    zip_local_path = os.path.join(local_dir, f"{uuid.uuid4().hex}_{secure_filename(zip_file.filename)}")
+    digest = FileDigest()
+    with open(zip_local_path, 'wb') as f:
+        for block in iter(lambda: zip_file.stream.read(8 * 1024 * 1024), b''):
+            f.write(block)
+            digest.update(block)
+    if not zipfile.is_zipfile(zip_local_path):
+        os.remove(zip_local_path)
+        return jsonify({'error': 'Invalid zip file'}), 400
+
+    # The same archive was already extracted into this audit: nothing to do
+    zip_hash = digest.result()['content_hash']
+    audit = audits_collection.find_one({"_id": ObjectId(inputs['audit_id'])},
+                                       {'zip_content_hash': 1, 'zip_upload_status': 1, 'zip_path': 1,
+                                        'zip_upload_failed': 1})
+    if (audit and audit.get('zip_content_hash') == zip_hash and audit.get('zip_path') == zip_path
+            and audit.get('zip_upload_status') == 'Completed' and not audit.get('zip_upload_failed')):
+        os.remove(zip_local_path)
+        print(f"♻️ Duplicate zip upload for audit {inputs['audit_id']}, images already stored")
+        return jsonify({'success': True, 'message': 'These images are already uploaded', 'duplicate': True})
+
+    job_id = job_queue.enqueue(ZIP_JOB, {
+        'plant_id': str(inputs['plant_id']),
+        'audit_id': str(inputs['audit_id']),
+        'zip_path': zip_path,
+        'zip_local_path': zip_local_path,
+        'zip_content_hash': zip_hash
+    })
     audits_collection.update_one(
         {
             "_id": ObjectId(inputs['audit_id']),
         },
         {
-            "$set": {"zip_upload_status":"In Progress", "zip_path":zip_path }
+            "$set": {"zip_upload_status": "Queued", "zip_path": zip_path, "zip_job_id": job_id},
+            "$unset": {"zip_upload_error": "", "zip_upload_failed": ""}
         }
     )
-    print("updaing files s3")
-    try:
-        with zipfile.ZipFile(zip_file) as z:
-            images = [
-                (name, z.read(name)) for name in z.namelist()
-                if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'))
-            ]
-        with ThreadPoolExecutor(max_workers=50) as executor:  # adjust number of threads as needed
-            futures = [executor.submit(upload_single_file, f"audits/{str(inputs['plant_id'])}/{str(inputs['audit_id'])}/zip_images/{name}", data) for name, data in images]
-            for future in as_completed(futures):
-                uploaded_files.append(future.result())
-
-        audits_collection.update_one( { "_id": ObjectId(inputs['audit_id'])},
-            {
-                "$set": {"zip_upload_status": "Completed"}
-            }
-        )
-        return jsonify({'message': 'Upload complete', 'files': uploaded_files})
-
-    except Exception as err:
-        print("Error into zip upload", err)
-        audits_collection.update_one(
-            {
-                "_id": ObjectId(inputs['audit_id']),
-            },
-            {
-                "$set": {"zip_upload_status": "Failed"}
-            }
-        )
-        return jsonify({'error': 'Invalid zip file'}), 400
+    print(f"📦 Zip image upload queued [{job_id}]: {zip_local_path}")
+    return jsonify({'success': True, 'message': 'Upload received, images are being processed',
+                    'job_id': job_id}), 202
 
 @app.route('/api/get_geojson/<audit_id>', methods=['POST'])
 def get_geojson(audit_id):
     try:
         filter_options = dict(request.form)
         print("request data", filter_options, len(filter_options))
-        audit = audits_collection.find_one({"_id":ObjectId(audit_id)}, {"anomalies":1})
-        anomalies = json.loads(audit['anomalies'])['features'] if audit and audit.get('anomalies') else []
-
-        if len(filter_options) >0:
-
-            if filter_options.get('block') is not None and len(filter_options.get('block') ) >0:
-                anomalies =[i for i in anomalies if i.get('properties', {}).get('Block') == filter_options['block'] ]
-
-            if filter_options.get('an') is not None and len(filter_options.get('an')) >0:
-                anomalies =[i for i in anomalies if i.get('properties', {}).get('Anomaly') == filter_options['an'] ]
+        block = filter_options.get('block')
+        anomaly = filter_options.get('an')
+        recurrence = filter_options.get('recurrence')
 
+        # Viewport request: only features whose centroid is inside the map bbox
+        if filter_options.get('bbox'):
+            try:
+                bbox = [float(v) for v in filter_options['bbox'].split(',')]
+                zoom = float(filter_options['zoom']) if filter_options.get('zoom') else None
+                limit = min(int(filter_options.get('limit', MAX_VIEWPORT_FEATURES)), MAX_VIEWPORT_FEATURES)
+            except ValueError:
+                return jsonify({'error': 'Invalid bbox or zoom'}), 400
+            if len(bbox) != 4:
+                return jsonify({'error': 'bbox must be min_lon,min_lat,max_lon,max_lat'}), 400
+
+            features, truncated = [], False
+            if limit > 0:
+                features, truncated = find_viewport_features(anomalies_collection, audit_id, bbox, zoom=zoom,
+                                                             limit=limit, block=block, anomaly=anomaly,
+                                                             recurrence=recurrence)
+            response = {'features': features, 'truncated': truncated}
+            if filter_options.get('with_extent') and (block or anomaly or recurrence):
+                # Total and extent of the whole filter so the map can zoom to it
+                response['total'], response['extent'] = get_features_extent(
+                    anomalies_collection, audit_id, block=block, anomaly=anomaly, recurrence=recurrence)
+            elif filter_options.get('with_extent'):
+                # Unfiltered: both are kept on the audit summary
+                audit = audits_collection.find_one({'_id': ObjectId(audit_id)}, {'anomaly_summary': 1})
+                summary = get_audit_summary(audits_collection, anomalies_collection, audit) if audit else {}
+                response['total'], response['extent'] = summary.get('total', 0), summary.get('extent')
+            return jsonify(response)
+
+        if block or anomaly or recurrence:
+            # Block / anomaly / recurrence filters are applied by the indexed query
+            anomalies = find_audit_features(anomalies_collection, audit_id, block=block, anomaly=anomaly,
+                                            recurrence=recurrence)
+        else:
+            anomalies = get_cached_audit_features(audit_feature_cache, audits_collection,
+                                                  anomalies_collection, audit_id)
 
         return jsonify(anomalies)
     except Exception as e:
@@ -1683,23 +1978,59 @@ def health_check():
 # Import and register Render-optimized upload endpoints
 try:
     from render_upload_endpoints import register_render_endpoints
-    register_render_endpoints(app, data_uploads_collection, get_s3_resource)
+    register_render_endpoints(app, data_uploads_collection, get_s3_resource, upload_sessions_collection,
+                              content_index, login_required=login_required)
     print("✅ Render-optimized upload endpoints loaded successfully")
 except ImportError as e:
     print(f"⚠️ Render upload endpoints not loaded: {e}")
 except Exception as e:
     print(f"⚠️ Error loading render endpoints: {e}")
 
+# Direct browser-to-S3 uploads (presigned multipart part URLs)
+try:
+    from direct_upload_endpoints import register_direct_upload_endpoints
+    register_direct_upload_endpoints(app, data_uploads_collection, get_s3_resource, upload_sessions_collection,
+                                     content_index, login_required=login_required)
+except ImportError as e:
+    print(f"⚠️ Direct upload endpoints not loaded: {e}")
+except Exception as e:
+    print(f"⚠️ Error loading direct upload endpoints: {e}")
+
 # Add upload progress tracking endpoints
+def find_upload_status(upload_id):
+    """This worker's live tracker if it runs the upload, else the shared progress store"""
+    tracker = upload_status.get(upload_id)
+    if tracker:
+        return tracker.get_status()
+    return progress_store.get(upload_id)
+
+
+def sse_response(generator):
+    response = Response(stream_with_context(generator), mimetype='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx must not buffer the stream
+    return response
+
+
+@app.route('/api/upload/progress/<upload_id>/events', methods=['GET'])
+def upload_progress_events(upload_id):
+    """Server-Sent Events: a 'progress' event whenever the upload's status changes"""
+    return sse_response(progress_store.stream(upload_id))
+
+
+@app.route('/api/upload/status/events', methods=['GET'])
+def upload_status_events():
+    """Server-Sent Events: the recent uploads, sent again whenever one of them changes"""
+    return sse_response(progress_store.stream_recent())
+
 @app.route('/api/upload/progress/<upload_id>', methods=['GET'])
 def get_upload_progress(upload_id):
     """Get upload progress status"""
     try:
-        if upload_id in upload_status:
-            tracker = upload_status[upload_id]
+        status = find_upload_status(upload_id)
+        if status:
             return jsonify({
                 'success': True,
-                'status': tracker.get_status()
+                'status': status
             })
         else:
             return jsonify({
@@ -1717,7 +2048,8 @@ def get_upload_progress(upload_id):
 def get_all_upload_status():
     """Get status of all active uploads"""
     try:
-        active_uploads = {}
+        # Uploads of every worker, with this worker's live trackers on top
+        active_uploads = progress_store.recent()
         for upload_id, tracker in upload_status.items():
             active_uploads[upload_id] = tracker.get_status()
         
@@ -1750,9 +2082,8 @@ def google_drive_upload():
 def upload_progress(upload_id):
     """Get upload progress status (simple endpoint for compatibility)"""
     try:
-        if upload_id in upload_status:
-            tracker = upload_status[upload_id]
-            status_data = tracker.get_status()
+        status_data = find_upload_status(upload_id)
+        if status_data:
             return jsonify(status_data)
         else:
             return jsonify({
@@ -1784,7 +2115,7 @@ def plant_overview(plant_id):
     plant = make_serializable(plant)
     
     # Get the latest audit for this plant to fetch real data
-    audits = list(audits_collection.find({'plant_id': str(plant_id)}).sort('_id', -1).limit(1))
+    audits = list(audits_collection.find({'plant_id': str(plant_id)}, {'anomaly_summary': 1}).sort('_id', -1).limit(1))
     print(f"📄 Found {len(audits)} audits for plant {plant_id}")
     
     # Initialize default data
@@ -1819,166 +2150,28 @@ def plant_overview(plant_id):
     }
     
     # If audit data exists, process it
-    if audits and audits[0].get('anomalies'):
+    if audits:
         try:
             audit_id = str(audits[0]['_id'])
             print(f"🏭 Processing plant {plant_id} overview with audit {audit_id}")
             
-            anomalies = json.loads(audits[0]['anomalies'])['features']
-            print(f"📊 Found {len(anomalies)} anomalies to process for overview charts")
-            
-            # Process anomalies for charts
-            anomaly_counts = {}
-            blocks_data = {}
-            severity_blocks_data = {}
+            # Counts come from the summary materialized at ingest time
+            summary = get_audit_summary(audits_collection, anomalies_collection, audits[0])
+            print(f"📊 Using anomaly summary with {summary.get('total', 0)} anomalies for overview charts")
             
-            # Define color mapping for anomaly types
-            color_map = {
-                'Bypass Diode': '#9C27B0',
-                'Multi Cell Hotspot': '#FFA500', 
-                'Cell Hotspot': '#FF0000',
-                'Partial String Offline': '#FF66C4',
-                'Vegetation': '#2E7D32',
-                'Physical Damage': '#C2185B',
-                'Module Power Mismatch': '#65E667',
-                'Shading': '#E77148',
-                'Short Circuit': '#506E9A',
-                'String Offline': '#FF1A94',
-                'Module Offline': '#545454',
-                'Junction Box': '#BFC494',
-                'Module Missing': '#5CE1E6',
-                'Other': '#8C52FF',
-                'Cell': '#FF0000',
-                'Multi Cell': '#FFA500'
-            }
-            
-            for anomaly in anomalies:
-                properties = anomaly['properties']
-                
-                # Debug: Print available properties to understand data structure
-                print(f"🔍 Available properties: {list(properties.keys())}")
-                
-                # Use the correct property name based on your existing code
-                anomaly_type = properties.get('Anomaly', 'Unknown')
-                block_value = properties.get('Block', 'Unknown')
-                severity_value = properties.get('Severity', 'Unknown')
-                
-                print(f"   Anomaly type: {anomaly_type}, Block: {block_value}, Severity: {severity_value}")
-                
-                # Count anomaly types
-                if anomaly_type in anomaly_counts:
-                    anomaly_counts[anomaly_type] += 1
-                else:
-                    anomaly_counts[anomaly_type] = 1
-                
-                # Count severity levels for progress data - more flexible matching
-                severity_lower = severity_value.lower()
-                if 'high' in severity_lower or 'critical' in severity_lower or 'severe' in severity_lower or ('remediation' in severity_lower and 'recommended' in severity_lower):
-                    progress_data['high'] += 1
-                elif 'medium' in severity_lower or 'moderate' in severity_lower or 'warning' in severity_lower or ('monitor' in severity_lower and 'remediate' in severity_lower):
-                    progress_data['medium'] += 1
-                elif 'low' in severity_lower or 'minor' in severity_lower or 'info' in severity_lower or ('long-term' in severity_lower and 'monitoring' in severity_lower):
-                    progress_data['low'] += 1
-                
-                # Count status (check if this anomaly has resolve_status)
-                resolve_status = properties.get('resolve_status', 'pending')
-                if resolve_status == 'resolved':
-                    progress_data['resolved'] += 1
-                else:
-                    progress_data['pending'] += 1
-                
-                # Group by blocks for bar chart
-                if block_value != 'Unknown':
-                    if block_value not in blocks_data:
-                        blocks_data[block_value] = {}
-                    
-                    if anomaly_type in blocks_data[block_value]:
-                        blocks_data[block_value][anomaly_type] += 1
-                    else:
-                        blocks_data[block_value][anomaly_type] = 1
-                
-                # Group by severity and blocks for severity chart
-                if block_value != 'Unknown' and severity_value != 'Unknown':
-                    if block_value not in severity_blocks_data:
-                        severity_blocks_data[block_value] = {}
-                    
-                    if severity_value in severity_blocks_data[block_value]:
-                        severity_blocks_data[block_value][severity_value] += 1
-                    else:
-                        severity_blocks_data[block_value][severity_value] = 1
-            
-            print(f"📈 Anomaly type distribution for overview:")
-            for anomaly_type, count in anomaly_counts.items():
-                print(f"   {anomaly_type}: {count}")
-            
-            print(f"🏗️ Block distribution for overview:")
-            for block, type_data in blocks_data.items():
-                total_in_block = sum(type_data.values())
-                print(f"   Block {block}: {total_in_block} anomalies")
-            
-            # Prepare pie chart data
-            anomaly_data['labels'] = list(anomaly_counts.keys())
-            anomaly_data['counts'] = list(anomaly_counts.values())
-            anomaly_data['colors'] = [color_map.get(label, '#888888') for label in anomaly_data['labels']]
-            
-            # Prepare bar chart data
-            if blocks_data:
-                sorted_blocks = sorted(blocks_data.keys())
-                bar_chart_data['labels'] = sorted_blocks
-                
-                # Create datasets for each anomaly type
-                datasets = []
-                for anomaly_type in anomaly_counts.keys():
-                    dataset_data = []
-                    for block in sorted_blocks:
-                        count = blocks_data[block].get(anomaly_type, 0)
-                        dataset_data.append(count)
-                    
-                    datasets.append({
-                        'label': anomaly_type,
-                        'data': dataset_data,
-                        'backgroundColor': color_map.get(anomaly_type, '#888888')
-                    })
-                
-                bar_chart_data['datasets'] = datasets
-                print(f"📊 Created {len(datasets)} datasets for {len(sorted_blocks)} blocks")
-            
-            # Prepare severity chart data
-            severity_chart_data = {'labels': [], 'datasets': []}
-            if severity_blocks_data:
-                sorted_severity_blocks = sorted(severity_blocks_data.keys())
-                severity_chart_data['labels'] = sorted_severity_blocks
-                
-                # Define severity levels and their colors
-                severity_levels = {
-                    'High': '#DC2626',
-                    'Medium': '#F59E0B', 
-                    'Low': '#10B981'
-                }
-                
-                # Create datasets for each severity level
-                severity_datasets = []
-                for severity_level, color in severity_levels.items():
-                    severity_dataset_data = []
-                    for block in sorted_severity_blocks:
-                        count = severity_blocks_data[block].get(severity_level, 0)
-                        severity_dataset_data.append(count)
-                    
-                    severity_datasets.append({
-                        'label': f'{severity_level} Severity',
-                        'data': severity_dataset_data,
-                        'backgroundColor': color,
-                        'barThickness': 30
-                    })
-                
-                severity_chart_data['datasets'] = severity_datasets
-                print(f"📊 Created severity chart with {len(severity_datasets)} severity levels for {len(sorted_severity_blocks)} blocks")
+            # Pie, bar and severity datasets all come from the one summary document
+            charts = build_chart_data(summary)
+            anomaly_data = charts['anomaly_data']
+            bar_chart_data = charts['bar_chart_data']
+            severity_chart_data = charts['severity_chart_data']
+            progress_data.update(charts['progress'])
+            print(f"📊 Created {len(bar_chart_data['datasets'])} datasets for {len(bar_chart_data['labels'])} blocks, "
+                  f"{len(severity_chart_data['datasets'])} severity levels")
             
-            # Calculate some basic analytics
-            total_anomalies = sum(anomaly_counts.values())
-            # Estimate power loss (placeholder calculation)
-            analytics['power_loss'] = str(total_anomalies * 2)  # 2kW per anomaly estimate
-            analytics['revenue_loss'] = str(total_anomalies * 1500)  # Rs 1500 per anomaly estimate
+            # Loss per anomaly type and module wattage, cached on the summary
+            loss = loss_model.audit_loss(audits_collection, anomalies_collection, audit_id, summary, plant)
+            analytics['power_loss'] = f"{loss['power_loss_kw']:,.2f}"
+            analytics['revenue_loss'] = f"{loss['revenue_loss']:,.0f}"
             
             print(f"💰 Calculated analytics:")
             print(f"   Power loss estimate: {analytics['power_loss']} kW")
@@ -2173,142 +2366,19 @@ def get_plant_severity_chart_data(plant_id):
             return jsonify({'success': False, 'message': 'Plant not found'}), 404
 
         # Get the latest audit for this plant
-        audits = list(audits_collection.find({'plant_id': str(plant['_id'])}).sort('_id', -1).limit(1))
+        audits = list(audits_collection.find({'plant_id': str(plant['_id'])}, {'anomaly_summary': 1}).sort('_id', -1).limit(1))
         
         severity_chart_data = {'labels': [], 'datasets': []}
         
-        if audits and audits[0].get('anomalies'):
+        if audits:
             try:
-                anomalies = json.loads(audits[0]['anomalies'])['features']
-                print(f"📊 Found {len(anomalies)} anomalies for severity analysis")
+                summary = get_audit_summary(audits_collection, anomalies_collection, audits[0])
+                print(f"📊 Using anomaly summary with {summary.get('total', 0)} anomalies for severity analysis")
                 
-                # Debug: check first few anomalies to see what properties are available
-                if anomalies:
-                    print(f"🔍 Sample anomaly properties: {list(anomalies[0]['properties'].keys())}")
-                    for i, anomaly in enumerate(anomalies[:3]):  # Check first 3 anomalies
-                        props = anomaly['properties']
-                        print(f"   Anomaly {i+1}: Block={props.get('Block')}, Severity={props.get('Severity')}")
-                
-                severity_blocks_data = {}
-                
-                # Process anomalies to group by severity and blocks
-                severity_values_found = set()
-                for anomaly in anomalies:
-                    properties = anomaly['properties']
-                    block_value = properties.get('Block', 'Unknown')
-                    severity_value = properties.get('Severity', 'Unknown')
-                    
-                    # Debug: collect all severity values found
-                    if severity_value != 'Unknown':
-                        severity_values_found.add(severity_value)
-                    
-                    print(f"🔍 Processing anomaly - Block: {block_value}, Severity: {severity_value}")
-                    
-                    if block_value != 'Unknown' and severity_value != 'Unknown':
-                        if block_value not in severity_blocks_data:
-                            severity_blocks_data[block_value] = {}
-                        
-                        # Normalize severity value to standard format
-                        normalized_severity = severity_value.strip().title()
-                        
-                        if normalized_severity in severity_blocks_data[block_value]:
-                            severity_blocks_data[block_value][normalized_severity] += 1
-                        else:
-                            severity_blocks_data[block_value][normalized_severity] = 1
-                
-                print(f"📊 Found severity values: {severity_values_found}")
-                print(f"📊 Severity blocks data: {severity_blocks_data}")
-                
-                # Prepare chart data
-                if severity_blocks_data:
-                    sorted_severity_blocks = sorted(severity_blocks_data.keys())
-                    severity_chart_data['labels'] = [f'Block {block}' for block in sorted_severity_blocks]
-                    
-                    # Define severity levels and their colors - more flexible matching
-                    severity_levels = {
-                        'High': '#DC2626',
-                        'Medium': '#F59E0B', 
-                        'Low': '#10B981',
-                        'High Severity': '#DC2626',
-                        'Medium Severity': '#F59E0B', 
-                        'Low Severity': '#10B981',
-                        # Add more variations that might exist in data
-                        'Critical': '#DC2626',
-                        'Moderate': '#F59E0B',
-                        'Minor': '#10B981',
-                        'Severe': '#DC2626',
-                        'Major': '#DC2626',
-                        'Warning': '#F59E0B',
-                        'Info': '#10B981',
-                        'Error': '#DC2626',
-                        # Specific severity descriptions from your data
-                        'Remediation Recommended (High) Severity': '#DC2626',
-                        'Monitor & Remediate (Medium) Severity': '#F59E0B',
-                        'Long-Term Monitoring (Low) Severity': '#10B981',
-                        'Remediation Recommended': '#DC2626',
-                        'Monitor & Remediate': '#F59E0B',
-                        'Long-Term Monitoring': '#10B981',
-                        # Numeric severity levels
-                        '1': '#10B981',  # Low
-                        '2': '#F59E0B',  # Medium  
-                        '3': '#DC2626',  # High
-                        'Level 1': '#10B981',
-                        'Level 2': '#F59E0B',
-                        'Level 3': '#DC2626'
-                    }
-                    
-                    # Get all unique severity levels from the data
-                    all_severities_in_data = set()
-                    for block_data in severity_blocks_data.values():
-                        all_severities_in_data.update(block_data.keys())
-                    
-                    print(f"📊 All severities in data: {all_severities_in_data}")
-                    
-                    # Create datasets for each severity level found in data
-                    severity_datasets = []
-                    for severity_level in all_severities_in_data:
-                        # Use predefined color or default - with better matching
-                        color = '#888888'  # default gray
-                        
-                        # More flexible color matching
-                        severity_lower = severity_level.lower()
-                        if 'high' in severity_lower or 'critical' in severity_lower or 'severe' in severity_lower or ('remediation' in severity_lower and 'recommended' in severity_lower):
-                            color = '#DC2626'  # Red
-                        elif 'medium' in severity_lower or 'moderate' in severity_lower or 'warning' in severity_lower or ('monitor' in severity_lower and 'remediate' in severity_lower):
-                            color = '#F59E0B'  # Orange
-                        elif 'low' in severity_lower or 'minor' in severity_lower or 'info' in severity_lower or ('long-term' in severity_lower and 'monitoring' in severity_lower):
-                            color = '#10B981'  # Green
-                        else:
-                            # Try exact match from our mapping
-                            color = severity_levels.get(severity_level, '#888888')
-                        
-                        # Clean up label name for display
-                        display_label = severity_level
-                        if 'remediation recommended' in severity_level.lower():
-                            display_label = 'High Severity'
-                        elif 'monitor & remediate' in severity_level.lower():
-                            display_label = 'Medium Severity'
-                        elif 'long-term monitoring' in severity_level.lower():
-                            display_label = 'Low Severity'
-                        elif severity_level in ['High', 'Medium', 'Low']:
-                            display_label = f'{severity_level} Severity'
-                        
-                        severity_dataset_data = []
-                        for block in sorted_severity_blocks:
-                            count = severity_blocks_data[block].get(severity_level, 0)
-                            severity_dataset_data.append(count)
-                        
-                        severity_datasets.append({
-                            'label': display_label,
-                            'data': severity_dataset_data,
-                            'backgroundColor': color,
-                            'barThickness': 30
-                        })
-                        
-                        print(f"📊 Added severity dataset: {display_label} with color {color} and data {severity_dataset_data}")
-                    
-                    severity_chart_data['datasets'] = severity_datasets
-                    print(f"📊 Created {len(severity_datasets)} severity datasets")
+                severity_chart_data = build_chart_data(summary)['severity_chart_data']
+                if severity_chart_data['labels']:
+                    severity_chart_data['labels'] = [f'Block {block}' for block in severity_chart_data['labels']]
+                    print(f"📊 Created {len(severity_chart_data['datasets'])} severity datasets")
                 else:
                     print("⚠️ No severity blocks data found")
                     
@@ -2354,6 +2424,56 @@ def get_plant_severity_chart_data(plant_id):
         return jsonify({'success': False, 'message': 'Failed to fetch severity data'}), 500
 
 
+@app.route('/api/plant/<plant_id>/chart-data', methods=['GET'])
+@login_required
+def get_plant_chart_data(plant_id):
+    """Pie, bar and severity datasets of the plant's latest audit in one response"""
+    try:
+        audits = list(audits_collection.find({'plant_id': str(plant_id)}, {'anomaly_summary': 1}).sort('_id', -1).limit(1))
+        if not audits:
+            return jsonify({'success': False, 'message': 'No audit data found for this plant'}), 404
+        
+        summary = get_audit_summary(audits_collection, anomalies_collection, audits[0])
+        charts = build_chart_data(summary)
+        plant = plants_collection.find_one({'_id': ObjectId(plant_id)}, {'dc_capacity': 1}) or {}
+        loss = None
+        try:
+            loss = loss_model.audit_loss(audits_collection, anomalies_collection, audits[0]['_id'], summary, plant)
+            loss = {key: value for key, value in loss.items() if key not in ('settings_key', 'computed_at')}
+        except Exception as e:
+            # The charts are still useful without the loss estimate
+            print(f"❌ Error calculating loss for plant {plant_id}: {e}")
+        return jsonify({
+            'success': True,
+            'audit_id': str(audits[0]['_id']),
+            'total': charts['total'],
+            'anomalyData': charts['anomaly_data'],
+            'barChartData': charts['bar_chart_data'],
+            'severityChartData': charts['severity_chart_data'],
+            'progressData': charts['progress'],
+            'loss': loss
+        })
+    except Exception as e:
+        print(f"❌ Error fetching chart data for plant {plant_id}: {e}")
+        return jsonify({'success': False, 'message': 'Failed to fetch chart data'}), 500
+
+
+@app.route('/api/plant/<plant_id>/trends', methods=['GET'])
+@login_required
+def get_plant_trends(plant_id):
+    """Anomaly counts, resolution rate and recurring modules across the plant's audits"""
+    try:
+        limit = request.args.get('audits', TREND_AUDITS, type=int)
+        hotspots = request.args.get('hotspots', HOTSPOT_LIMIT, type=int)
+        trends = plant_trends(audits_collection, anomalies_collection, plant_id, limit=limit, hotspot_limit=hotspots)
+        if not trends['audits']:
+            return jsonify({'success': False, 'message': 'No audit data found for this plant'}), 404
+        return jsonify({'success': True, **trends})
+    except Exception as e:
+        print(f"❌ Error fetching trends for plant {plant_id}: {e}")
+        return jsonify({'success': False, 'message': 'Failed to fetch plant trends'}), 500
+
+
 @app.route('/api/plant/<plant_id>/severity-data', methods=['GET', 'POST'])
 @login_required
 def plant_severity_data(plant_id):
@@ -2405,31 +2525,13 @@ def audit_anomalies_by_block(audit_id):
     """Get anomalies grouped by block for a specific audit"""
     try:
         print(f"🔍 Fetching anomalies by block for audit: {audit_id}")
-        audit = audits_collection.find_one({'_id': ObjectId(audit_id)})
-        if not audit or not audit.get('anomalies'):
+        # Streamed block by block so the full feature list is never held in memory
+        body = stream_features_by_block(anomalies_collection, audit_id)
+        if body is None:
             print(f"❌ No anomalies data found for audit: {audit_id}")
             return jsonify({'success': False, 'message': 'No anomalies data found'}), 404
 
-        anomalies = json.loads(audit['anomalies'])['features']
-        print(f"📊 Found {len(anomalies)} total anomalies in audit {audit_id}")
-        
-        # Group anomalies by block
-        blocks_data = {}
-        for anomaly in anomalies:
-            block_value = anomaly['properties'].get('Block')
-            if block_value:
-                if block_value not in blocks_data:
-                    blocks_data[block_value] = []
-                blocks_data[block_value].append(anomaly)
-        
-        print(f"🏗️ Grouped anomalies into {len(blocks_data)} blocks:")
-        for block, anomaly_list in blocks_data.items():
-            print(f"   Block {block}: {len(anomaly_list)} anomalies")
-        
-        return jsonify({
-            'success': True,
-            'blocks': blocks_data
-        })
+        return Response(stream_with_context(body), mimetype='application/json')
     except Exception as e:
         print(f"❌ Error in audit_anomalies_by_block for audit {audit_id}: {str(e)}")
         return jsonify({'success': False, 'message': f'Error fetching anomalies by block: {str(e)}'}), 500
@@ -2442,42 +2544,24 @@ def plant_anomalies_by_block(plant_id):
     try:
         print(f"🌱 Fetching anomalies by block for plant: {plant_id}")
         # Get the latest audit for this plant
-        audits = list(audits_collection.find({'plant_id': str(plant_id)}).sort('_id', -1).limit(1))
+        audits = list(audits_collection.find({'plant_id': str(plant_id)}, {'anomaly_summary': 1}).sort('_id', -1).limit(1))
         
-        if not audits or not audits[0].get('anomalies'):
+        summary = get_audit_summary(audits_collection, anomalies_collection, audits[0]) if audits else {}
+        if not summary.get('total'):
             print(f"❌ No anomalies data found for plant: {plant_id}")
             return jsonify({'success': False, 'message': 'No anomalies data found for this plant'}), 404
         
         latest_audit = audits[0]
         audit_id = str(latest_audit['_id'])
         print(f"📄 Using latest audit: {audit_id}")
+        print(f"📊 Found {summary['total']} total anomalies in latest audit")
         
-        anomalies = json.loads(latest_audit['anomalies'])['features']
-        print(f"📊 Found {len(anomalies)} total anomalies in latest audit")
-        
-        # Group anomalies by block and count by type
-        blocks_data = {}
+        # Block x type counts come straight from the materialized summary
+        blocks_data = summary.get('block_type', {})
         anomaly_type_counts = {}
-        
-        for anomaly in anomalies:
-            properties = anomaly['properties']
-            block_value = properties.get('Block')
-            anomaly_type = properties.get('Anomaly', 'Unknown')  # Changed from 'Anomaly_type' to 'Anomaly'
-            
-            print(f"   Processing anomaly - Type: {anomaly_type}, Block: {block_value}")
-            
-            if block_value:
-                if block_value not in blocks_data:
-                    blocks_data[block_value] = {}
-                
-                if anomaly_type not in blocks_data[block_value]:
-                    blocks_data[block_value][anomaly_type] = 0
-                blocks_data[block_value][anomaly_type] += 1
-                
-                # Overall count
-                if anomaly_type not in anomaly_type_counts:
-                    anomaly_type_counts[anomaly_type] = 0
-                anomaly_type_counts[anomaly_type] += 1
+        for type_counts in blocks_data.values():
+            for anomaly_type, count in type_counts.items():
+                anomaly_type_counts[anomaly_type] = anomaly_type_counts.get(anomaly_type, 0) + count
         
         print(f"🏗️ Grouped anomalies into {len(blocks_data)} blocks:")
         for block, type_counts in blocks_data.items():
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+One-shot migration: move audits.anomalies JSON strings into the anomalies collection
+and backfill the centroid, severity/type classification and new/recurring status on older records.
+Hand-reported anomalies (POST /api/anomalies) move to the manual_anomalies collection,
+still listed by GET /api/anomalies
+Usage: python migrate_anomalies.py [--drop-blob]
+"""
+import json
+import os
+import sys
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient, UpdateOne
+from dotenv import load_dotenv, dotenv_values
+
+from anomaly_store import (ensure_anomaly_indexes, insert_audit_anomalies, delete_audit_anomalies,
+                           feature_centroid, backfill_module_keys, INSERT_BATCH_SIZE)
+from anomaly_summary import AnomalySummaryBuilder
+from anomaly_classification import backfill_classification
+from anomaly_matching import classify_recurrence
+from anomaly_listing import ensure_manual_indexes
+
+
+def get_config(key, default=None):
+    """Get configuration from environment variables or .env file"""
+    value = os.environ.get(key)
+    if value:
+        return value
+    try:
+        sec_config = dotenv_values(".env")
+        return sec_config.get(key, default)
+    except:
+        return default
+
+
+def migrate(db, drop_blob=False):
+    """Migrate every audit that still stores its anomalies as a JSON string"""
+    audits_collection = db.audits
+    anomalies_collection = db.anomalies
+
+    ensure_anomaly_indexes(anomalies_collection)
+    move_manual_anomalies(db)
+    ensure_manual_indexes(db.manual_anomalies)
+
+    query = {'anomalies': {'$type': 'string'}, 'anomalies_storage': {'$ne': 'collection'}}
+    migrated = 0
+    for audit in audits_collection.find(query, {'_id': 1}):
+        audit_id = audit['_id']
+        # Load one blob at a time to keep memory bounded
+        full_audit = audits_collection.find_one({'_id': audit_id}, {'anomalies': 1, 'plant_id': 1})
+        try:
+            features = json.loads(full_audit['anomalies']).get('features') or []
+        except (ValueError, AttributeError) as e:
+            print(f"❌ Skipping audit {audit_id}: invalid anomalies JSON ({e})")
+            continue
+
+        # Clear any records left by an interrupted run so the migration can be re-run safely
+        delete_audit_anomalies(anomalies_collection, audit_id)
+        summary = AnomalySummaryBuilder()
+        count = insert_audit_anomalies(anomalies_collection, audit_id, full_audit.get('plant_id'), features,
+                                       summary=summary)
+
+        update = {'$set': {'anomalies_storage': 'collection',
+                           'anomalies_count': count,
+                           'anomaly_summary': summary.to_document(),
+                           'anomalies_migrated_at': datetime.utcnow()},
+                  '$inc': {'anomalies_version': 1}}
+        if drop_blob:
+            update['$unset'] = {'anomalies': ''}
+        audits_collection.update_one({'_id': audit_id}, update)
+        migrated += 1
+        print(f"✅ Migrated audit {audit_id}: {count} anomalies")
+
+    print(f"🎉 Migration complete: {migrated} audit(s) migrated")
+    backfill_locations(anomalies_collection)
+    classified = backfill_classification(anomalies_collection)
+    print(f"🏷️ Classified severity and anomaly type on {classified} anomaly record(s)")
+    print(f"🔖 Backfilled module_key on {backfill_module_keys(anomalies_collection)} anomaly record(s)")
+    for audit in audits_collection.find({'recurrence_summary': {'$exists': False}}, {'_id': 1}):
+        classify_recurrence(anomalies_collection, audits_collection, audit['_id'])
+    return migrated
+
+
+def move_manual_anomalies(db):
+    """
+    Move records written by POST /api/anomalies (no seq: not a GeoJSON feature) to
+    manual_anomalies and drop the summaries that counted them
+    """
+    legacy = {'seq': {'$exists': False}}
+    audit_ids = set()
+    moved = 0
+    for record in db.anomalies.find(legacy):
+        db.manual_anomalies.replace_one({'_id': record['_id']}, record, upsert=True)
+        db.anomalies.delete_one({'_id': record['_id']})
+        if record.get('audit_id'):
+            audit_ids.add(str(record['audit_id']))
+        moved += 1
+    for audit_id in audit_ids:
+        if ObjectId.is_valid(audit_id):
+            # Rebuilt from the remaining records on next read
+            db.audits.update_one({'_id': ObjectId(audit_id)}, {'$unset': {'anomaly_summary': ''}})
+    print(f"📝 Moved {moved} manual anomaly record(s) to manual_anomalies")
+    return moved
+
+
+def backfill_locations(anomalies_collection):
+    """Add the centroid used by viewport queries to records written before it existed"""
+    query = {'location': {'$exists': False}}
+    batch = []
+    updated = 0
+    for record in anomalies_collection.find(query, {'geometry': 1, 'properties': 1}):
+        location = feature_centroid(record)
+        if not location:
+            continue
+        batch.append(UpdateOne({'_id': record['_id']}, {'$set': {'location': location}}))
+        if len(batch) >= INSERT_BATCH_SIZE:
+            anomalies_collection.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        anomalies_collection.bulk_write(batch, ordered=False)
+        updated += len(batch)
+    print(f"📍 Backfilled location on {updated} anomaly record(s)")
+    return updated
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    mongo_uri = get_config('MONGO_CONNECTION')
+    if not mongo_uri:
+        print("❌ ERROR: MONGO_CONNECTION not found")
+        sys.exit(1)
+
+    client = MongoClient(mongo_uri)
+    migrate(client.get_default_database(), drop_blob='--drop-blob' in sys.argv)
+    client.close()
@@ -1,7 +1,8 @@
 # Simple routes for plant overview
 from flask import render_template, flash, redirect, url_for
 from bson import ObjectId
-from main import app, login_required, plants_collection, audits_collection, make_serializable
+from main import (app, login_required, plants_collection, audits_collection, anomalies_collection,
+                  make_serializable, loss_model, get_audit_summary, build_chart_data)
 
 # Note: This should be added to main.py, but due to syntax errors, 
 # we'll create a separate file for now
@@ -15,21 +16,29 @@ def plant_overview(plant_id):
             flash('Plant not found', 'error')
             return redirect(url_for('homepage'))
 
-        # Simple default values for now
         analytics = {
-            'power_loss': 25.5,
-            'revenue_loss': 45000
+            'power_loss': '0',
+            'revenue_loss': '0'
         }
         
         progress_data = {
-            'pending': 35,
-            'resolved': 45,
-            'not_found': 20,
-            'high': 15,
-            'medium': 55,
-            'low': 30
+            'pending': 0,
+            'resolved': 0,
+            'not_found': 0,
+            'high': 0,
+            'medium': 0,
+            'low': 0
         }
         
+        # Same summary-backed numbers as main.plant_overview
+        audits = list(audits_collection.find({'plant_id': str(plant_id)}, {'anomaly_summary': 1}).sort('_id', -1).limit(1))
+        if audits:
+            summary = get_audit_summary(audits_collection, anomalies_collection, audits[0])
+            progress_data.update(build_chart_data(summary)['progress'])
+            loss = loss_model.audit_loss(audits_collection, anomalies_collection, audits[0]['_id'], summary, plant)
+            analytics['power_loss'] = f"{loss['power_loss_kw']:,.2f}"
+            analytics['revenue_loss'] = f"{loss['revenue_loss']:,.0f}"
+        
         plant = make_serializable(plant)
         
         return render_template('plant_overview.html', 
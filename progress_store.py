@@ -0,0 +1,109 @@
+"""
+Progress Store Module
+Upload progress shared by every worker process through MongoDB. Trackers
+publish into it (see upload_progress.progress_sinks); status endpoints read it
+and Server-Sent Events streams push changes to the browser.
+"""
+import json
+import time
+from datetime import datetime, timedelta
+
+from pymongo import DESCENDING
+
+# Keep progress documents this long after their last update
+PROGRESS_TTL = timedelta(hours=24)
+
+# How often a stream checks MongoDB for changes, and sends a keep-alive comment
+STREAM_POLL_SECONDS = 0.5
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Streams end after this long; EventSource reconnects on its own (keeps sync workers free)
+STREAM_MAX_SECONDS = 120
+
+FINISHED = ('completed', 'failed')
+
+
+def sse_event(data, event=None):
+    """One Server-Sent Events message"""
+    lines = [f'event: {event}'] if event else []
+    lines.append('data: ' + json.dumps(data, default=str))
+    return '\n'.join(lines) + '\n\n'
+
+
+class ProgressStore:
+    """upload_progress collection: one document per upload id holding the tracker status"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index('expires_at', expireAfterSeconds=0, name='expires_at_ttl')
+        self.collection.create_index([('updated_at', DESCENDING)], name='updated_at')
+
+    def sink(self, tracker, event):
+        """Progress sink: persist the tracker's current status"""
+        now = datetime.utcnow()
+        status = tracker.get_status()
+        self.collection.update_one(
+            {'_id': tracker.upload_id},
+            {'$set': dict(status, updated_at=now, expires_at=now + PROGRESS_TTL),
+             '$inc': {'version': 1}},
+            upsert=True
+        )
+
+    def get(self, upload_id):
+        doc = self.collection.find_one({'_id': upload_id}, {'expires_at': 0})
+        if doc:
+            doc.pop('_id', None)
+        return doc
+
+    def recent(self, limit=200):
+        """{upload_id: status} of the most recently updated uploads"""
+        uploads = {}
+        for doc in self.collection.find({}, {'expires_at': 0}).sort('updated_at', DESCENDING).limit(limit):
+            uploads[doc.pop('_id')] = doc
+        return uploads
+
+    def stream(self, upload_id, max_seconds=STREAM_MAX_SECONDS):
+        """SSE generator for one upload: a 'progress' event per change, ends once it finishes"""
+        def generate():
+            yield f'retry: {int(STREAM_POLL_SECONDS * 2000)}\n\n'
+            started = last_sent = time.monotonic()
+            version = None
+            while time.monotonic() - started < max_seconds:
+                doc = self.collection.find_one({'_id': upload_id}, {'expires_at': 0})
+                if doc and doc.get('version') != version:
+                    version = doc.get('version')
+                    doc.pop('_id', None)
+                    yield sse_event(doc, 'progress')
+                    last_sent = time.monotonic()
+                    if doc.get('status') in FINISHED:
+                        yield sse_event({'upload_id': upload_id}, 'end')
+                        return
+                elif time.monotonic() - last_sent >= STREAM_KEEPALIVE_SECONDS:
+                    yield ': keep-alive\n\n'
+                    last_sent = time.monotonic()
+                time.sleep(STREAM_POLL_SECONDS)
+
+        return generate()
+
+    def stream_recent(self, limit=200, max_seconds=STREAM_MAX_SECONDS):
+        """SSE generator of the recent uploads snapshot, sent again whenever any of them changes"""
+        def generate():
+            yield f'retry: {int(STREAM_POLL_SECONDS * 2000)}\n\n'
+            started = last_sent = time.monotonic()
+            marker = None
+            while time.monotonic() - started < max_seconds:
+                latest = self.collection.find_one({}, {'updated_at': 1, 'version': 1},
+                                                  sort=[('updated_at', DESCENDING)])
+                current = (latest['_id'], latest.get('version')) if latest else None
+                if current != marker:
+                    marker = current
+                    yield sse_event(self.recent(limit), 'uploads')
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= STREAM_KEEPALIVE_SECONDS:
+                    yield ': keep-alive\n\n'
+                    last_sent = time.monotonic()
+                time.sleep(STREAM_POLL_SECONDS)
+
+        return generate()
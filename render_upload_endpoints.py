@@ -4,62 +4,270 @@ Handles large file uploads within Render's 10-minute timeout limit
 """
 import os
 import json
+import math
+import hashlib
+import secrets
+import shutil
+import threading
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from flask import request, jsonify, render_template
+from pymongo import ReturnDocument
 from upload_progress import UploadProgressTracker, upload_status
+from s3_multipart import FileSlice, MIN_PART_SIZE, MAX_PARTS
+from upload_checksums import ChunkDigest, ChecksumError, HASH_BLOCK_SIZE, content_hash, multipart_etag
 
-# Import these after main app is created to avoid circular imports
-# These will be imported at runtime when the endpoints are registered
+# Upload sessions live in MongoDB (upload_sessions collection) so any worker can
+# accept any chunk and an upload survives restarts. Each chunk is written at its
+# offset in a preallocated file under CHUNK_ROOT on the shared disk of this host,
+# so chunks may arrive in any order and in parallel.
+CHUNK_ROOT = 'temp_chunks'
 
-# In-memory storage for upload sessions (use Redis in production)
-upload_sessions = {}
+# Copy buffer used when writing a chunk into the target file
+WRITE_BLOCK_SIZE = 1024 * 1024
 
-def register_render_endpoints(app, data_uploads_collection, get_s3_resource):
+# Idle sessions (and their chunk lists) expire after this long
+SESSION_TTL = timedelta(hours=24)
+
+# Sessions this close to expiry get their temp file and S3 multipart upload removed
+# by the sweep, before the TTL index deletes the document that points at them
+SWEEP_MARGIN = timedelta(hours=2)
+SWEEP_INTERVAL_SECONDS = 3600
+
+# A chunk being copied into the target file holds off finalize for at most this long
+WRITE_LEASE = timedelta(minutes=2)
+
+# Linking to stored content needs the sha256 of a server-chosen range of the file
+PROOF_RANGE_SIZE = 64 * 1024
+PROOF_TTL = timedelta(minutes=10)
+
+
+def ensure_upload_session_indexes(upload_sessions_collection):
+    """TTL index so abandoned sessions are removed by MongoDB"""
+    upload_sessions_collection.create_index('expires_at', expireAfterSeconds=0, name='expires_at_ttl')
+
+
+def sweep_stale_sessions(upload_sessions_collection, s3_client, bucket_name, now=None):
+    """
+    Abort the S3 multipart upload and delete the temp files of sessions about to
+    expire, then of leftovers no session points at any more (temp dirs and multipart
+    uploads older than SESSION_TTL). Returns (sessions, dirs, multipart uploads) removed.
+    """
+    now = now or datetime.utcnow()
+    sessions = dirs = uploads = 0
+    for session in upload_sessions_collection.find(
+            {'expires_at': {'$lt': now + SWEEP_MARGIN}, 'kind': {'$ne': 'link_challenge'}},
+            {'expires_at': 1, 's3_key': 1, 's3_upload_id': 1, 'chunk_dir': 1}):
+        # Deleting with the same expires_at claims it: a session touched meanwhile is kept
+        if not upload_sessions_collection.find_one_and_delete(
+                {'_id': session['_id'], 'expires_at': session['expires_at']}):
+            continue
+        if session.get('s3_upload_id'):
+            try:
+                s3_client.abort_multipart_upload(Bucket=bucket_name, Key=session['s3_key'],
+                                                 UploadId=session['s3_upload_id'])
+            except Exception as e:
+                print(f"⚠️ Could not abort multipart upload of stale session {session['_id']}: {e}")
+        if session.get('chunk_dir'):
+            shutil.rmtree(session['chunk_dir'], ignore_errors=True)
+        sessions += 1
+
+    # Leftovers of sessions that expired without being swept (or on another worker's host)
+    oldest = time.time() - SESSION_TTL.total_seconds()
+    if os.path.isdir(CHUNK_ROOT):
+        for name in os.listdir(CHUNK_ROOT):
+            path = os.path.join(CHUNK_ROOT, name)
+            if os.path.getmtime(path) < oldest and not upload_sessions_collection.find_one({'_id': name}, {'_id': 1}):
+                shutil.rmtree(path, ignore_errors=True)
+                dirs += 1
+    paginator = s3_client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='uploads/'):
+        for upload in page.get('Uploads', []):
+            if upload['Initiated'].astimezone(timezone.utc).replace(tzinfo=None) >= now - SESSION_TTL:
+                continue
+            if upload_sessions_collection.find_one({'s3_upload_id': upload['UploadId']}, {'_id': 1}):
+                continue
+            s3_client.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+            uploads += 1
+
+    if sessions or dirs or uploads:
+        print(f"🧹 Swept {sessions} stale upload session(s), {dirs} temp dir(s), {uploads} multipart upload(s)")
+    return sessions, dirs, uploads
+
+
+def start_session_sweeper(upload_sessions_collection, get_s3_resource, bucket_name):
+    """Background thread running sweep_stale_sessions every SWEEP_INTERVAL_SECONDS"""
+    def sweep_worker():
+        while True:
+            time.sleep(SWEEP_INTERVAL_SECONDS)
+            try:
+                sweep_stale_sessions(upload_sessions_collection, get_s3_resource(), bucket_name)
+            except Exception as e:
+                print(f"⚠️ Upload session sweep failed: {e}")
+
+    threading.Thread(target=sweep_worker, name='upload-session-sweeper', daemon=True).start()
+
+
+def _session_tracker(session):
+    """This worker's progress tracker for a session, created if the session started elsewhere"""
+    tracker = upload_status.get(session['_id'])
+    if tracker is None:
+        tracker = UploadProgressTracker(session['_id'], session['filename'], session['file_size'])
+    return tracker
+
+
+def _chunk_length(session, chunk_index):
+    return min(session['chunk_size'], session['file_size'] - chunk_index * session['chunk_size'])
+
+
+def _receive_chunk(stream, temp_path, length, digest):
+    """
+    Copy a chunk from stream into its own temp file without buffering it,
+    feeding the written bytes to digest. Never writes more than length;
+    returns the number of bytes the client sent.
+    """
+    received = 0
+    with open(temp_path, 'wb') as target:
+        while True:
+            block = stream.read(WRITE_BLOCK_SIZE)
+            if not block:
+                break
+            room = length - received
+            if room > 0:
+                target.write(block[:room])
+                digest.update(block[:room])
+            received += len(block)
+    return received
+
+
+def _copy_chunk(temp_path, target_path, offset):
+    """Copy a verified chunk into its range of the target file"""
+    with open(temp_path, 'rb') as source, open(target_path, 'r+b') as target:
+        target.seek(offset)
+        shutil.copyfileobj(source, target, WRITE_BLOCK_SIZE)
+
+
+def _use_s3_parts(chunk_size, total_chunks):
+    """Chunks can double as S3 multipart parts (all but the last must be >= 5 MB)"""
+    return total_chunks <= MAX_PARTS and (chunk_size >= MIN_PART_SIZE or total_chunks == 1)
+
+
+def _upload_s3_part(s3_client, bucket_name, session, chunk_index, expected_md5=None):
+    """Send one stored chunk as S3 part chunk_index + 1, returns its ETag (checked against expected_md5)"""
+    with FileSlice(session['target_path'], chunk_index * session['chunk_size'],
+                   _chunk_length(session, chunk_index)) as body:
+        response = s3_client.upload_part(
+            Bucket=bucket_name,
+            Key=session['s3_key'],
+            UploadId=session['s3_upload_id'],
+            PartNumber=chunk_index + 1,
+            ContentLength=len(body),
+            Body=body
+        )
+    etag = response['ETag']
+    if expected_md5 and etag.strip('"') != expected_md5:
+        raise ChecksumError(f'S3 part {chunk_index + 1} ETag {etag} does not match the chunk md5')
+    return etag
+
+
+def _read_range(path, s3_client, s3_copy, offset, length):
+    """Bytes [offset, offset + length) of stored content, from disk or S3"""
+    if path:
+        with open(path, 'rb') as source:
+            source.seek(offset)
+            return source.read(length)
+    response = s3_client.get_object(Bucket=s3_copy[0], Key=s3_copy[1],
+                                    Range=f'bytes={offset}-{offset + length - 1}')
+    return response['Body'].read()
+
+
+def register_render_endpoints(app, data_uploads_collection, get_s3_resource, upload_sessions_collection,
+                              content_index, login_required=None):
     """Register render upload endpoints with the Flask app"""
-    
+    login_required = login_required or (lambda f: f)
+    ensure_upload_session_indexes(upload_sessions_collection)
+    bucket_name = os.environ.get('bucket_name', 'sylo-energy')
+    region_name = os.environ.get('region_name', 'ap-south-1')
+    # Covers the direct upload sessions in the same collection too
+    start_session_sweeper(upload_sessions_collection, get_s3_resource, bucket_name)
+
+    def find_session(upload_id):
+        # Direct-to-S3 sessions and link challenges share the collection but have no chunks
+        return upload_sessions_collection.find_one({'_id': upload_id, 'kind': None})
+
     @app.route('/api/upload/init', methods=['POST'])
     def init_chunked_upload():
         """Initialize a chunked upload session"""
         try:
             data = request.json
-            
+            file_size = int(data['fileSize'])
+            total_chunks = int(data['totalChunks'])
+            chunk_size = int(data.get('chunkSize') or math.ceil(file_size / max(total_chunks, 1)))
+            if file_size < 1 or total_chunks < 1 or chunk_size < 1 or math.ceil(file_size / chunk_size) != total_chunks:
+                return jsonify({'success': False, 'error': 'fileSize, chunkSize and totalChunks do not match'}), 400
+
             # Generate unique upload ID
             upload_id = str(uuid.uuid4())
-            
-            # Create upload session
+            chunk_dir = os.path.join(CHUNK_ROOT, upload_id)
+            os.makedirs(chunk_dir, exist_ok=True)
+
+            # Preallocate the whole file (sparse where the filesystem supports it)
+            target_path = os.path.join(chunk_dir, 'upload.part')
+            with open(target_path, 'wb') as target:
+                target.truncate(file_size)
+
+            final_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S_')}{data['filename']}"
+            s3_key = f"uploads/{data['plant_id']}/{data['audit_id']}/{final_filename}"
+
+            # Every chunk is also sent as a part of this S3 upload as it arrives
+            s3_upload_id = None
+            if _use_s3_parts(chunk_size, total_chunks):
+                try:
+                    s3_upload_id = get_s3_resource().create_multipart_upload(
+                        Bucket=bucket_name, Key=s3_key)['UploadId']
+                except Exception as s3_error:
+                    print(f"S3 multipart upload not started: {s3_error}")
+
+            now = datetime.utcnow()
             session = {
-                'upload_id': upload_id,
+                '_id': upload_id,
                 'filename': data['filename'],
-                'file_size': data['fileSize'],
-                'total_chunks': data['totalChunks'],
+                'file_size': file_size,
+                'chunk_size': chunk_size,
+                'total_chunks': total_chunks,
                 'uploaded_chunks': [],
                 'audit_type': data['audit_type'],
                 'plant_id': data['plant_id'],
                 'audit_id': data['audit_id'],
-                'created_at': datetime.utcnow(),
+                'chunk_dir': chunk_dir,
+                'target_path': target_path,
+                'final_filename': final_filename,
+                'final_path': os.path.join(app.config['UPLOAD_FOLDER'], final_filename),
+                's3_key': s3_key,
+                's3_upload_id': s3_upload_id,
+                'parts': {},
+                'chunk_md5': {},
+                'chunk_blocks': {},
+                'created_at': now,
+                'updated_at': now,
+                'expires_at': now + SESSION_TTL,
                 'status': 'initialized'
             }
-            
-            upload_sessions[upload_id] = session
-            
+            upload_sessions_collection.insert_one(session)
+
             # Create progress tracker
-            tracker = UploadProgressTracker(upload_id, data['filename'], data['fileSize'])
+            tracker = UploadProgressTracker(upload_id, data['filename'], file_size)
             tracker.set_stage('initializing', 'Chunked upload session initialized')
-            
-            # Create temporary directory for chunks
-            chunk_dir = os.path.join('temp_chunks', upload_id)
-            os.makedirs(chunk_dir, exist_ok=True)
-            session['chunk_dir'] = chunk_dir
-            
-            print(f"🚀 Chunked Upload Initialized [{upload_id}]: {data['filename']} ({data['fileSize']} bytes, {data['totalChunks']} chunks)")
-            
+
+            print(f"🚀 Chunked Upload Initialized [{upload_id}]: {data['filename']} ({data['fileSize']} bytes, {total_chunks} chunks)")
+
             return jsonify({
                 'success': True,
                 'uploadId': upload_id,
                 'message': 'Upload session initialized'
             })
-            
+
         except Exception as e:
             return jsonify({
                 'success': False,
@@ -68,112 +276,258 @@ def register_render_endpoints(app, data_uploads_collection, get_s3_resource):
 
     @app.route('/api/upload/chunk', methods=['POST'])
     def upload_chunk():
-        """Upload a single chunk"""
+        """Write a single chunk at its offset (sending the same chunk again just replaces it)"""
+        temp_path = None
+        lease = None
         try:
             upload_id = request.form.get('uploadId')
             chunk_index = int(request.form.get('chunkIndex'))
-            
-            if upload_id not in upload_sessions:
+
+            session = find_session(upload_id)
+            if not session:
                 return jsonify({
                     'success': False,
                     'error': 'Upload session not found'
                 }), 404
-            
-            session = upload_sessions[upload_id]
+            if session['status'] in ('finalizing', 'completed'):
+                return jsonify({'success': False, 'error': f"Upload is {session['status']}"}), 409
+            if not 0 <= chunk_index < session['total_chunks']:
+                return jsonify({'success': False, 'error': 'Invalid chunk index'}), 400
+
             chunk_file = request.files['chunk']
-            
+
             # Get progress tracker
-            tracker = upload_status.get(upload_id)
-            if tracker:
-                tracker.set_stage('uploading_chunks', f'Uploading chunk {chunk_index + 1}/{session["total_chunks"]}')
-            
-            # Save chunk to temporary file
-            chunk_path = os.path.join(session['chunk_dir'], f'chunk_{chunk_index:06d}')
-            chunk_file.save(chunk_path)
-            
-            # Track uploaded chunks
-            session['uploaded_chunks'].append(chunk_index)
-            
+            tracker = _session_tracker(session)
+            # One message for the whole stage: per-chunk counts go out as rate limited progress
+            tracker.set_stage('uploading_chunks', f'Uploading {session["total_chunks"]} chunks')
+
+            # Chunks cover disjoint ranges, so parallel requests never overlap. A chunk is
+            # received into a temp file and only copied over its range once its length and
+            # checksum are verified, so a bad resend never damages an accepted chunk.
+            # Optional client checksum of the chunk (sha256 by default, hex or base64)
+            try:
+                digest = ChunkDigest(request.form.get('checksumAlgorithm'), request.form.get('checksum'),
+                                     block_aligned=session['chunk_size'] % HASH_BLOCK_SIZE == 0)
+            except ChecksumError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+
+            expected = _chunk_length(session, chunk_index)
+            temp_path = os.path.join(session['chunk_dir'], f'chunk-{chunk_index}-{uuid.uuid4().hex}.tmp')
+            received = _receive_chunk(chunk_file.stream, temp_path, expected, digest)
+            if received != expected:
+                return jsonify({
+                    'success': False,
+                    'error': f'Chunk {chunk_index} has {received} bytes, expected {expected}'
+                }), 400
+            try:
+                digest.verify()
+            except ChecksumError as e:
+                print(f"❌ Chunk checksum mismatch [{upload_id}]: chunk {chunk_index}")
+                return jsonify({'success': False, 'error': f'Chunk {chunk_index}: {e}'}), 400
+
+            # Take a write lease unless finalize has started meanwhile; finalize waits for leases
+            now = datetime.utcnow()
+            lease = uuid.uuid4().hex
+            if not upload_sessions_collection.find_one_and_update(
+                    {'_id': upload_id, 'status': {'$nin': ['finalizing', 'completed']}},
+                    {'$push': {'writing': {'lease': lease, 'until': now + WRITE_LEASE}}}):
+                lease = None
+                return jsonify({'success': False, 'error': 'Upload is being finalized'}), 409
+            _copy_chunk(temp_path, session['target_path'], chunk_index * session['chunk_size'])
+
+            update = {'status': 'uploading', f'chunk_md5.{chunk_index}': digest.md5}
+            blocks = digest.block_digests()
+            if blocks is not None:
+                update[f'chunk_blocks.{chunk_index}'] = blocks
+            if session.get('s3_upload_id'):
+                try:
+                    update[f'parts.{chunk_index}'] = _upload_s3_part(get_s3_resource(), bucket_name,
+                                                                     session, chunk_index, digest.md5)
+                except Exception as s3_error:
+                    # Sent again from the stored file at finalize
+                    print(f"S3 part {chunk_index + 1} upload failed: {s3_error}")
+
+            # $addToSet keeps a chunk sent twice from being counted twice
+            now = datetime.utcnow()
+            update.update({'updated_at': now, 'expires_at': now + SESSION_TTL})
+            session = upload_sessions_collection.find_one_and_update(
+                {'_id': upload_id},
+                {'$addToSet': {'uploaded_chunks': chunk_index}, '$set': update,
+                 '$pull': {'writing': {'lease': lease}}},
+                projection={'uploaded_chunks': 1, 'total_chunks': 1, 'file_size': 1, 'chunk_size': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            lease = None
+            uploaded = len(session['uploaded_chunks'])
+
             # Update progress
-            if tracker:
-                bytes_uploaded = len(session['uploaded_chunks']) * (session['file_size'] // session['total_chunks'])
-                tracker.update_progress(bytes_uploaded, 'uploading_chunks')
-            
+            bytes_uploaded = min(uploaded * session['chunk_size'], session['file_size'])
+            tracker.update_progress(bytes_uploaded, 'uploading_chunks')
+
             print(f"📦 Chunk Uploaded [{upload_id}]: {chunk_index + 1}/{session['total_chunks']}")
-            
-            return jsonify({
-                'success': True,
-                'chunkIndex': chunk_index,
-                'uploadedChunks': len(session['uploaded_chunks']),
-                'totalChunks': session['total_chunks']
-            })
-            chunk_file.save(chunk_path)
-            
-            # Track uploaded chunk
-            session['uploaded_chunks'].append(chunk_index)
-            session['status'] = 'uploading'
-            
+
             return jsonify({
                 'success': True,
                 'chunkIndex': chunk_index,
-                'uploadedChunks': len(session['uploaded_chunks']),
+                'uploadedChunks': uploaded,
                 'totalChunks': session['total_chunks']
             })
-            
+
         except Exception as e:
             return jsonify({
                 'success': False,
                 'error': f'Chunk upload failed: {str(e)}'
             }), 500
+        finally:
+            if lease:
+                # The copy failed part way: the range no longer holds the accepted chunk
+                upload_sessions_collection.update_one(
+                    {'_id': upload_id},
+                    {'$pull': {'writing': {'lease': lease}, 'uploaded_chunks': chunk_index},
+                     '$unset': {f'chunk_md5.{chunk_index}': '', f'chunk_blocks.{chunk_index}': '',
+                                f'parts.{chunk_index}': ''}}
+                )
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @app.route('/api/upload/<upload_id>/chunks', methods=['GET'])
+    def get_uploaded_chunks(upload_id):
+        """Chunks the server already holds, so a client can resume with the rest"""
+        session = find_session(upload_id)
+        if not session:
+            return jsonify({'success': False, 'error': 'Upload session not found'}), 404
+        received = sorted(session['uploaded_chunks'])
+        return jsonify({
+            'success': True,
+            'uploadId': upload_id,
+            'status': session['status'],
+            'totalChunks': session['total_chunks'],
+            'chunkSize': session.get('chunk_size'),
+            'receivedChunks': received,
+            'missingChunks': session['total_chunks'] - len(received)
+        })
 
     @app.route('/api/upload/finalize', methods=['POST'])
     def finalize_upload():
-        """Combine chunks and finalize upload"""
+        """Complete the S3 copy and move the assembled file into place"""
+        upload_id = None
         try:
             data = request.json
             upload_id = data['uploadId']
-            
-            if upload_id not in upload_sessions:
+
+            session = find_session(upload_id)
+            if not session:
                 return jsonify({
                     'success': False,
                     'error': 'Upload session not found'
                 }), 404
-            
-            session = upload_sessions[upload_id]
-            
+            if session['status'] == 'completed':
+                # Retried finalize: report the earlier result
+                return jsonify(session['result'])
+
             # Verify all chunks are uploaded
-            if len(session['uploaded_chunks']) != session['total_chunks']:
+            missing = session['total_chunks'] - len(set(session['uploaded_chunks']))
+            if missing:
                 return jsonify({
                     'success': False,
-                    'error': f'Missing chunks: {session["total_chunks"] - len(session["uploaded_chunks"])}'
+                    'error': f'Missing chunks: {missing}'
                 }), 400
-            
-            # Combine chunks into final file
-            final_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S_')}{session['filename']}"
-            final_path = os.path.join(app.config['UPLOAD_FOLDER'], final_filename)
-            
-            os.makedirs(os.path.dirname(final_path), exist_ok=True)
-            
-            with open(final_path, 'wb') as final_file:
-                for i in range(session['total_chunks']):
-                    chunk_path = os.path.join(session['chunk_dir'], f'chunk_{i:06d}')
-                    if os.path.exists(chunk_path):
-                        with open(chunk_path, 'rb') as chunk_file:
-                            final_file.write(chunk_file.read())
-                        os.remove(chunk_path)  # Clean up chunk
-            
-            # Upload to S3 (optional, for backup)
+
+            # Only one request (on any worker) may assemble the file, and only once no
+            # chunk is still being copied into it
+            session = upload_sessions_collection.find_one_and_update(
+                {'_id': upload_id, 'status': {'$nin': ['finalizing', 'completed']},
+                 'writing': {'$not': {'$elemMatch': {'until': {'$gt': datetime.utcnow()}}}}},
+                {'$set': {'status': 'finalizing', 'updated_at': datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+            if not session:
+                return jsonify({'success': False, 'error': 'Upload is being finalized or chunks are still being written'}), 409
+
+            source_path = session['target_path'] if os.path.exists(session['target_path']) else session['final_path']
+            chunk_md5 = session.get('chunk_md5') or {}
+            part_md5s = [chunk_md5.get(str(i)) for i in range(session['total_chunks'])]
+            s3_client = get_s3_resource()
+
+            # Whole-file hash from the per-chunk block hashes: no second read of the file
+            chunk_blocks = session.get('chunk_blocks') or {}
+            file_hash = None
+            if len(chunk_blocks) == session['total_chunks']:
+                file_hash = content_hash([d for i in range(session['total_chunks']) for d in chunk_blocks[str(i)]])
+
+            # Content stored before: link to the existing copies instead of keeping new ones
+            existing = content_index.find(file_hash, session['file_size'])
+            existing_s3 = content_index.s3_copy(existing, s3_client)
+            existing_path = content_index.local_copy(existing)
+            if existing:
+                print(f"♻️ Duplicate upload [{upload_id}]: {session['filename']} matches {file_hash}")
+
             s3_url = None
-            try:
-                s3_client = get_s3_resource()
-                s3_key = f"uploads/{session['plant_id']}/{session['audit_id']}/{final_filename}"
-                bucket_name = os.environ.get('bucket_name', 'sylo-energy')
-                s3_client.upload_file(final_path, bucket_name, s3_key)
-                region_name = os.environ.get('region_name', 'ap-south-1')
-                s3_url = f"https://{bucket_name}.s3.{region_name}.amazonaws.com/{s3_key}"
-            except Exception as s3_error:
-                print(f"S3 upload failed: {s3_error}")
-            
+            s3_key = None
+            s3_etag = None
+            if existing_s3:
+                s3_key = existing_s3[1]
+                s3_url = existing_s3[2] or f"https://{existing_s3[0]}.s3.{region_name}.amazonaws.com/{s3_key}"
+                if session.get('s3_upload_id'):
+                    try:
+                        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=session['s3_key'],
+                                                         UploadId=session['s3_upload_id'])
+                    except Exception as s3_error:
+                        print(f"⚠️ Could not abort duplicate multipart upload: {s3_error}")
+            else:
+                # Complete the S3 copy from the parts sent with each chunk (plus any that failed then)
+                try:
+                    if session.get('s3_upload_id'):
+                        parts = dict(session.get('parts') or {})
+                        part_session = dict(session, target_path=source_path)
+                        for i in range(session['total_chunks']):
+                            if str(i) not in parts:
+                                parts[str(i)] = _upload_s3_part(s3_client, bucket_name, part_session, i, part_md5s[i])
+                        s3_etag = s3_client.complete_multipart_upload(
+                            Bucket=bucket_name,
+                            Key=session['s3_key'],
+                            UploadId=session['s3_upload_id'],
+                            MultipartUpload={'Parts': [{'PartNumber': i + 1, 'ETag': parts[str(i)]}
+                                                       for i in range(session['total_chunks'])]}
+                        ).get('ETag')
+                    else:
+                        # Chunks too small to be S3 parts: upload the file in one pass
+                        s3_client.upload_file(source_path, bucket_name, session['s3_key'])
+                    s3_key = session['s3_key']
+                    s3_url = f"https://{bucket_name}.s3.{region_name}.amazonaws.com/{s3_key}"
+                except Exception as s3_error:
+                    print(f"S3 upload failed: {s3_error}")
+                    if session.get('s3_upload_id'):
+                        try:
+                            s3_client.abort_multipart_upload(Bucket=bucket_name, Key=session['s3_key'],
+                                                             UploadId=session['s3_upload_id'])
+                        except Exception:
+                            pass
+            upload_sessions_collection.update_one({'_id': upload_id}, {'$set': {'s3_upload_id': None}})
+
+            final_filename = session['final_filename']
+            final_path = session['final_path']
+            if existing_path and existing_path != final_path:
+                os.remove(source_path)
+                final_path = existing_path
+                final_filename = os.path.basename(existing_path)
+            elif source_path != final_path:
+                # The chunks were written in place: finalizing is a rename, not a copy
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                shutil.move(source_path, final_path)
+                if existing:
+                    content_index.replace_local_copy(file_hash, final_path)
+            content_index.register(file_hash, session['file_size'], file_path=final_path,
+                                   s3_bucket=bucket_name if s3_key and not existing_s3 else None,
+                                   s3_key=s3_key if not existing_s3 else None, s3_url=s3_url)
+
+            # S3 computes a multipart ETag from the part md5s, so it confirms the stored object
+            etag_verified = None
+            if s3_etag and all(part_md5s):
+                etag_verified = s3_etag.strip('"') == multipart_etag(part_md5s)
+                if not etag_verified:
+                    print(f"⚠️ S3 ETag mismatch [{upload_id}]: {s3_etag} != {multipart_etag(part_md5s)}")
+
             # Save to database
             upload_data = {
                 'filename': final_filename,
@@ -184,35 +538,49 @@ def register_render_endpoints(app, data_uploads_collection, get_s3_resource):
                 'plant_id': session['plant_id'],
                 'audit_id': session['audit_id'],
                 's3_url': s3_url,
+                's3_etag': s3_etag,
+                's3_etag_verified': etag_verified,
+                'content_hash': file_hash,
+                'deduplicated': bool(existing),
                 'uploaded_at': datetime.utcnow(),
                 'upload_method': 'chunked_render'
             }
-            
+
             result = data_uploads_collection.insert_one(upload_data)
-            
-            # Clean up
-            if os.path.exists(session['chunk_dir']):
-                os.rmdir(session['chunk_dir'])
-            del upload_sessions[upload_id]
-            
-            return jsonify({
+
+            response = {
                 'success': True,
                 'filename': final_filename,
                 'file_size': session['file_size'],
                 'database_id': str(result.inserted_id),
                 's3_url': s3_url,
+                'content_hash': file_hash,
+                'deduplicated': bool(existing),
                 'message': 'Upload completed successfully'
-            })
-            
+            }
+
+            # Keep the completed session until it expires so a retried finalize gets the same answer
+            upload_sessions_collection.update_one(
+                {'_id': upload_id},
+                {'$set': {'status': 'completed', 'result': response, 'updated_at': datetime.utcnow()}}
+            )
+
+            # Clean up
+            shutil.rmtree(session['chunk_dir'], ignore_errors=True)
+            tracker = upload_status.get(upload_id)
+            if tracker:
+                tracker.complete(final_path)
+
+            return jsonify(response)
+
         except Exception as e:
-            # Clean up on error
-            if upload_id in upload_sessions:
-                session = upload_sessions[upload_id]
-                if 'chunk_dir' in session and os.path.exists(session['chunk_dir']):
-                    import shutil
-                    shutil.rmtree(session['chunk_dir'])
-                del upload_sessions[upload_id]
-            
+            # Keep the chunks: the client can finalize again (or resend chunks) later
+            if upload_id:
+                upload_sessions_collection.update_one(
+                    {'_id': upload_id, 'status': 'finalizing'},
+                    {'$set': {'status': 'uploading', 'error': str(e)}}
+                )
+
             return jsonify({
                 'success': False,
                 'error': f'Upload finalization failed: {str(e)}'
@@ -221,26 +589,115 @@ def register_render_endpoints(app, data_uploads_collection, get_s3_resource):
     @app.route('/api/upload/status/<upload_id>', methods=['GET'])
     def get_upload_status(upload_id):
         """Get upload progress status"""
-        if upload_id not in upload_sessions:
+        session = find_session(upload_id)
+        if not session:
             return jsonify({
                 'success': False,
                 'error': 'Upload session not found'
             }), 404
-        
-        session = upload_sessions[upload_id]
-        progress = len(session['uploaded_chunks']) / session['total_chunks'] * 100
-        
+
+        uploaded = len(session['uploaded_chunks'])
+        progress = uploaded / session['total_chunks'] * 100
+
         return jsonify({
             'success': True,
             'uploadId': upload_id,
             'progress': progress,
-            'uploadedChunks': len(session['uploaded_chunks']),
+            'uploadedChunks': uploaded,
             'totalChunks': session['total_chunks'],
             'status': session['status'],
             'filename': session['filename'],
             'file_size': session['file_size']
         })
 
+    @app.route('/api/upload/lookup', methods=['GET'])
+    @login_required
+    def lookup_upload_content():
+        """
+        Is a file with this content hash (see upload_checksums.content_hash) already
+        stored? If so, returns a challenge: the byte range whose sha256 /api/upload/link
+        needs as proof that the caller holds the file
+        """
+        file_hash = request.args.get('content_hash')
+        size = request.args.get('size', type=int)
+        record = content_index.find(file_hash, size)
+        exists = bool(content_index.local_copy(record) or content_index.s3_copy(record, get_s3_resource()))
+        response = {'success': True, 'exists': exists, 'contentHash': file_hash}
+        if exists:
+            size = record['size']
+            length = min(PROOF_RANGE_SIZE, size)
+            challenge = {
+                '_id': str(uuid.uuid4()),
+                'kind': 'link_challenge',
+                'content_hash': file_hash,
+                'file_size': size,
+                'offset': secrets.randbelow(size - length + 1),
+                'length': length,
+                'expires_at': datetime.utcnow() + PROOF_TTL
+            }
+            upload_sessions_collection.insert_one(challenge)
+            response['challenge'] = {'id': challenge['_id'], 'offset': challenge['offset'],
+                                     'length': challenge['length']}
+        return jsonify(response)
+
+    @app.route('/api/upload/link', methods=['POST'])
+    @login_required
+    def link_uploaded_content():
+        """Record an upload of already stored content without transferring it again"""
+        try:
+            data = request.json
+            file_hash = data['content_hash']
+            file_size = int(data['fileSize'])
+            # Each challenge answers once
+            challenge = upload_sessions_collection.find_one_and_delete(
+                {'_id': data['challengeId'], 'kind': 'link_challenge', 'content_hash': file_hash,
+                 'file_size': file_size, 'expires_at': {'$gt': datetime.utcnow()}})
+            if not challenge:
+                return jsonify({'success': False, 'error': 'Unknown or expired challenge'}), 403
+            record = content_index.find(file_hash, file_size)
+            path = content_index.local_copy(record)
+            s3_client = get_s3_resource()
+            s3_copy = content_index.s3_copy(record, s3_client)
+            if not (path or s3_copy):
+                return jsonify({'success': False, 'exists': False, 'error': 'Content not stored yet'}), 404
+            expected = hashlib.sha256(_read_range(path, s3_client, s3_copy, challenge['offset'],
+                                                  challenge['length'])).hexdigest()
+            if not secrets.compare_digest(expected, str(data.get('proof', '')).lower()):
+                print(f"❌ Link proof mismatch for {file_hash}")
+                return jsonify({'success': False, 'error': 'Proof does not match the stored content'}), 403
+
+            content_index.register(file_hash, file_size)
+            upload_data = {
+                'filename': os.path.basename(path) if path else os.path.basename(s3_copy[1]),
+                'original_filename': data['filename'],
+                'file_path': path,
+                'file_size': file_size,
+                'audit_type': data['audit_type'],
+                'plant_id': data['plant_id'],
+                'audit_id': data['audit_id'],
+                's3_url': s3_copy[2] if s3_copy else None,
+                'content_hash': file_hash,
+                'deduplicated': True,
+                'uploaded_at': datetime.utcnow(),
+                'upload_method': 'content_link'
+            }
+            result = data_uploads_collection.insert_one(upload_data)
+            print(f"♻️ Upload linked to stored content: {data['filename']} -> {file_hash}")
+
+            return jsonify({
+                'success': True,
+                'filename': upload_data['filename'],
+                'file_size': file_size,
+                'database_id': str(result.inserted_id),
+                's3_url': upload_data['s3_url'],
+                'content_hash': file_hash,
+                'deduplicated': True,
+                'message': 'File already stored, upload linked to the existing copy'
+            })
+
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': f'Invalid request: {str(e)}'}), 400
+
     @app.route('/render-upload')
     def render_upload_page():
         """Serve the Render-optimized upload page"""
@@ -0,0 +1,118 @@
+"""
+S3 Client Module
+One process-wide, thread-safe boto3 S3 client with a connection pool sized for
+the app's upload thread pools, plus counters showing how busy that pool is
+"""
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+
+class PoolMetrics:
+    """
+    Request level view of the connection pool, fed by botocore events.
+    A request holds a pooled connection from before-send until needs-retry
+    (emitted after every HTTP attempt, successful or not).
+    """
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        # Requests sent while every connection was already in use (they waited for one)
+        self.saturated_requests = 0
+        self.started_at = time.time()
+
+    def on_before_send(self, **kwargs):
+        with self._lock:
+            if self.in_flight >= self.pool_size:
+                self.saturated_requests += 1
+            self.in_flight += 1
+            self.requests += 1
+            if self.in_flight > self.peak_in_flight:
+                self.peak_in_flight = self.in_flight
+
+    def on_attempt_done(self, caught_exception=None, **kwargs):
+        with self._lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if caught_exception is not None:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'peak_utilization': round(self.peak_in_flight / self.pool_size, 3) if self.pool_size else None,
+                'requests': self.requests,
+                'errors': self.errors,
+                'saturated_requests': self.saturated_requests,
+                'uptime_seconds': round(time.time() - self.started_at)
+            }
+
+
+class SharedS3Client:
+    """
+    Lazily builds the client on first use (per process, so gunicorn workers
+    never share sockets after a fork) and hands the same instance to every caller.
+    boto3 clients are thread-safe; only their construction needs the lock.
+    """
+
+    def __init__(self, access_key=None, secret_key=None, region_name=None, max_pool_connections=50,
+                 connect_timeout=10, read_timeout=120, max_attempts=5):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region_name = region_name
+        self.max_pool_connections = max(int(max_pool_connections), 1)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.metrics = PoolMetrics(self.max_pool_connections)
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self._build()
+                self._pid = os.getpid()
+            return self._client
+
+    def _build(self):
+        # Own session: boto3's default session is not safe to use from several threads
+        session = boto3.session.Session(
+            aws_access_key_id=self.access_key,
+            aws_secret_access_key=self.secret_key,
+            region_name=self.region_name
+        )
+        client = session.client('s3', config=Config(
+            max_pool_connections=self.max_pool_connections,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            tcp_keepalive=True,
+            # SigV4 on the regional endpoint: presigned URLs (direct browser uploads) need it
+            signature_version='s3v4',
+            s3={'addressing_style': 'virtual'},
+            retries={'max_attempts': self.max_attempts, 'mode': 'standard'}
+        ))
+        events = client.meta.events
+        events.register('before-send.s3', self.metrics.on_before_send)
+        events.register('needs-retry.s3', self.metrics.on_attempt_done)
+        print(f"☁️ S3 client ready [{os.getpid()}] with a pool of {self.max_pool_connections} connection(s)")
+        return client
+
+    def stats(self):
+        stats = self.metrics.stats()
+        stats['initialized'] = self._client is not None and self._pid == os.getpid()
+        return stats
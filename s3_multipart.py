@@ -0,0 +1,295 @@
+"""
+S3 Multipart Upload Module
+In-process, concurrent multipart uploads to S3 driven by boto3's TransferConfig.
+Uploaded parts are recorded in a sidecar state file next to the source so an
+interrupted upload (worker restart, job retry) resumes with the missing parts only.
+"""
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+
+# S3 limits
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+# Attempts per part before the whole upload is reported as failed
+PART_ATTEMPTS = 3
+
+STATE_SUFFIX = '.s3upload.json'
+
+
+def make_transfer_config(part_size_mb=64, max_concurrency=8, threshold_mb=64):
+    """TransferConfig for large raster uploads: big parts, many in flight"""
+    return TransferConfig(
+        multipart_threshold=int(threshold_mb) * MB,
+        multipart_chunksize=max(int(part_size_mb) * MB, MIN_PART_SIZE),
+        max_concurrency=max(int(max_concurrency), 1),
+        use_threads=True
+    )
+
+
+def parse_s3_url(s3_url):
+    """s3://bucket/key -> (bucket, key)"""
+    if not s3_url.startswith('s3://'):
+        raise ValueError(f'Not an s3:// url: {s3_url}')
+    bucket, _, key = s3_url[5:].partition('/')
+    if not bucket or not key:
+        raise ValueError(f'Invalid s3 url: {s3_url}')
+    return bucket, key
+
+
+def state_path(local_path):
+    return local_path + STATE_SUFFIX
+
+
+def has_pending_upload(local_path):
+    """True when local_path has a started, unfinished multipart upload to resume"""
+    return os.path.exists(local_path) and os.path.exists(state_path(local_path))
+
+
+class FileSlice:
+    """
+    Seekable read-only view of [offset, offset + length) of a file. Passed as
+    the part body so a part is streamed from disk instead of held in memory,
+    and botocore can rewind it for checksums and retries.
+    """
+
+    def __init__(self, path, offset, length):
+        self._file = open(path, 'rb')
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+        self._file.seek(offset)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        remaining = self._length - self._pos
+        if remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self._file.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._length
+        self._pos = min(max(pos, 0), self._length)
+        self._file.seek(self._offset + self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MultipartUploader:
+    """
+    Uploads one file at a time with up to config.max_concurrency parts in flight.
+
+    progress(bytes_done, total_bytes) is called after every finished part (and
+    once for parts already on S3 when resuming). It runs on the worker threads.
+    """
+
+    def __init__(self, client, config=None):
+        self.client = client
+        self.config = config or make_transfer_config()
+
+    def part_size_for(self, size):
+        """Configured chunk size, grown when needed to stay within MAX_PARTS"""
+        return max(self.config.multipart_chunksize, MIN_PART_SIZE, math.ceil(size / MAX_PARTS))
+
+    def upload(self, local_path, bucket, key, progress=None):
+        """Upload local_path to s3://bucket/key, returns the object's ETag"""
+        size = os.path.getsize(local_path)
+        if size < self.config.multipart_threshold:
+            return self._upload_single(local_path, bucket, key, size, progress)
+
+        part_size = self.part_size_for(size)
+        part_count = math.ceil(size / part_size)
+        state = self._load_state(local_path, bucket, key, size, part_size)
+        if state:
+            done = self._uploaded_parts(bucket, key, state['upload_id'], part_size, size)
+            print(f"🔁 Resuming S3 multipart upload: {len(done)}/{part_count} part(s) already uploaded")
+        else:
+            upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+            state = {
+                'bucket': bucket,
+                'key': key,
+                'size': size,
+                'mtime': os.path.getmtime(local_path),
+                'part_size': part_size,
+                'upload_id': upload_id
+            }
+            self._save_state(local_path, state)
+            done = {}
+
+        lock = threading.Lock()
+        uploaded = {'bytes': sum(self._part_length(n, part_size, size) for n in done)}
+        if progress and done:
+            progress(uploaded['bytes'], size)
+
+        def on_part_done(part_number):
+            with lock:
+                uploaded['bytes'] += self._part_length(part_number, part_size, size)
+                current = uploaded['bytes']
+            if progress:
+                progress(current, size)
+
+        pending = [n for n in range(1, part_count + 1) if n not in done]
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.config.max_concurrency,
+                                thread_name_prefix='s3-part') as executor:
+            futures = {
+                executor.submit(self._upload_part, local_path, bucket, key, state['upload_id'],
+                                n, part_size, size): n
+                for n in pending
+            }
+            try:
+                for future in as_completed(futures):
+                    part_number = futures[future]
+                    done[part_number] = future.result()
+                    on_part_done(part_number)
+            except Exception:
+                # Leave the upload and state file in place so the next attempt resumes
+                for future in futures:
+                    future.cancel()
+                raise
+
+        result = self.client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=state['upload_id'],
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': done[n]} for n in sorted(done)]}
+        )
+        self._clear_state(local_path)
+        elapsed = max(time.time() - started, 0.001)
+        sent = sum(self._part_length(n, part_size, size) for n in pending)
+        print(f"✅ S3 multipart upload complete: {part_count} part(s), "
+              f"{sent / MB / elapsed:.1f} MB/s over {len(pending)} new part(s)")
+        return result.get('ETag')
+
+    def abort(self, local_path):
+        """Abort a recorded multipart upload and forget it (parts stop being billed)"""
+        state = self._read_state(local_path)
+        if state:
+            try:
+                self.client.abort_multipart_upload(Bucket=state['bucket'], Key=state['key'],
+                                                   UploadId=state['upload_id'])
+            except Exception as e:
+                print(f"⚠️ Could not abort multipart upload {state['upload_id']}: {e}")
+        self._clear_state(local_path)
+
+    def _upload_single(self, local_path, bucket, key, size, progress):
+        uploaded = {'bytes': 0}
+        lock = threading.Lock()
+
+        def callback(bytes_amount):
+            with lock:
+                uploaded['bytes'] += bytes_amount
+                current = uploaded['bytes']
+            if progress:
+                progress(current, size)
+
+        self.client.upload_file(local_path, bucket, key, Config=self.config, Callback=callback)
+        return None
+
+    @staticmethod
+    def _part_length(part_number, part_size, size):
+        return min(part_size, size - (part_number - 1) * part_size)
+
+    def _upload_part(self, local_path, bucket, key, upload_id, part_number, part_size, size):
+        """Upload one part (with retries), returns its ETag"""
+        offset = (part_number - 1) * part_size
+        length = self._part_length(part_number, part_size, size)
+        for attempt in range(1, PART_ATTEMPTS + 1):
+            try:
+                with FileSlice(local_path, offset, length) as body:
+                    response = self.client.upload_part(
+                        Bucket=bucket,
+                        Key=key,
+                        UploadId=upload_id,
+                        PartNumber=part_number,
+                        ContentLength=length,
+                        Body=body
+                    )
+                return response['ETag']
+            except Exception as e:
+                if attempt == PART_ATTEMPTS:
+                    raise
+                print(f"⚠️ S3 part {part_number} attempt {attempt} failed: {e}")
+                time.sleep(2 ** attempt)
+
+    def _uploaded_parts(self, bucket, key, upload_id, part_size, size):
+        """{part_number: etag} of complete parts S3 already holds for upload_id"""
+        parts = {}
+        paginator = self.client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                number = part['PartNumber']
+                if part['Size'] == self._part_length(number, part_size, size):
+                    parts[number] = part['ETag']
+        return parts
+
+    def _load_state(self, local_path, bucket, key, size, part_size):
+        """Saved state if it still describes this file and upload, else None"""
+        state = self._read_state(local_path)
+        if not state:
+            return None
+        matches = (state.get('bucket') == bucket and state.get('key') == key
+                   and state.get('size') == size and state.get('part_size') == part_size
+                   and state.get('mtime') == os.path.getmtime(local_path))
+        if not matches:
+            # The file or target changed since: the old parts are useless
+            self.abort(local_path)
+            return None
+        try:
+            self.client.list_parts(Bucket=bucket, Key=key, UploadId=state['upload_id'], MaxParts=1)
+        except self.client.exceptions.NoSuchUpload:
+            self._clear_state(local_path)
+            return None
+        return state
+
+    @staticmethod
+    def _read_state(local_path):
+        try:
+            with open(state_path(local_path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save_state(local_path, state):
+        path = state_path(local_path)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _clear_state(local_path):
+        try:
+            os.remove(state_path(local_path))
+        except OSError:
+            pass
@@ -0,0 +1,213 @@
+// Direct browser-to-S3 multipart upload (see direct_upload_endpoints.py).
+// The server signs part URLs; every part is PUT straight to the bucket, so no
+// file bytes go through the app. Interrupted uploads resume with the parts S3
+// does not have yet when the same file is picked again. Where SubtleCrypto is
+// available every part carries its SHA256, which S3 checks before accepting it.
+const DirectUpload = (() => {
+    const PARALLEL_PARTS = 4;
+    const URL_BATCH = 20;
+    const MAX_PART_RETRIES = 5;
+    // Content hash block size (upload_checksums.HASH_BLOCK_SIZE)
+    const HASH_BLOCK_SIZE = 5 * 1024 * 1024;
+
+    function sessionKey(file) {
+        return `directUpload:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    async function postJson(url, body) {
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body || {})
+        });
+        return response.json();
+    }
+
+    async function resumeSession(file) {
+        const uploadId = localStorage.getItem(sessionKey(file));
+        if (!uploadId) return null;
+        try {
+            const data = await (await fetch(`/api/upload/direct/${uploadId}/parts`)).json();
+            if (!data.success || data.status === 'completed' || data.status === 'aborted') {
+                localStorage.removeItem(sessionKey(file));
+                return null;
+            }
+            return data;
+        } catch (error) {
+            return null;
+        }
+    }
+
+    function canHash() {
+        // SubtleCrypto is only available on https (or localhost)
+        return Boolean(window.crypto && window.crypto.subtle);
+    }
+
+    function toHex(buffer) {
+        return Array.from(new Uint8Array(buffer)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    function hexToBase64(hex) {
+        return btoa(hex.match(/../g).map(byte => String.fromCharCode(parseInt(byte, 16))).join(''));
+    }
+
+    function putPart(url, blob, onBytes, checksum) {
+        // XHR rather than fetch: it reports upload progress
+        return new Promise((resolve, reject) => {
+            const xhr = new XMLHttpRequest();
+            xhr.open('PUT', url);
+            if (checksum) {
+                // Signed into the URL: S3 rejects the part if the bytes hash differently
+                xhr.setRequestHeader('x-amz-checksum-sha256', hexToBase64(checksum));
+            }
+            let sent = 0;
+            xhr.upload.onprogress = (event) => {
+                onBytes(event.loaded - sent);
+                sent = event.loaded;
+            };
+            xhr.onload = () => {
+                if (xhr.status >= 200 && xhr.status < 300) {
+                    resolve();
+                } else {
+                    onBytes(-sent);
+                    reject(new Error(`S3 rejected part (HTTP ${xhr.status})`));
+                }
+            };
+            xhr.onerror = () => {
+                onBytes(-sent);
+                reject(new Error('Network error while sending part'));
+            };
+            xhr.send(blob);
+        });
+    }
+
+    // fields: {audit_type, plant_id, audit_id}; options: {onProgress(bytes, total), onMessage(text),
+    // partChecksums: hex SHA256 of every 5 MB block if the caller already hashed the file}
+    async function upload(file, fields, options = {}) {
+        const onProgress = options.onProgress || (() => {});
+        const onMessage = options.onMessage || (() => {});
+
+        let session = await resumeSession(file);
+        let received = new Set();
+        if (session) {
+            received = new Set(session.receivedParts);
+            onMessage(`Resuming upload: ${received.size}/${session.totalParts} parts already in S3`);
+        } else {
+            session = await postJson('/api/upload/direct/init', Object.assign({
+                filename: file.name,
+                fileSize: file.size,
+                contentType: file.type || undefined,
+                checksumAlgorithm: canHash() ? 'SHA256' : undefined
+            }, fields));
+            if (!session.success) {
+                throw new Error(session.error || 'Failed to initialize direct upload');
+            }
+            localStorage.setItem(sessionKey(file), session.uploadId);
+        }
+
+        const { uploadId, partSize, totalParts, checksumAlgorithm } = session;
+        const partLength = (n) => Math.min(partSize, file.size - (n - 1) * partSize);
+        const partBlob = (n) => file.slice((n - 1) * partSize, (n - 1) * partSize + partLength(n));
+
+        const checksums = {};
+        async function partChecksum(n) {
+            if (!checksums[n]) {
+                const known = partSize === HASH_BLOCK_SIZE && options.partChecksums;
+                checksums[n] = known && known[n - 1]
+                    ? known[n - 1]
+                    : toHex(await crypto.subtle.digest('SHA-256', await partBlob(n).arrayBuffer()));
+            }
+            return checksums[n];
+        }
+        let uploadedBytes = 0;
+        const pending = [];
+        for (let n = 1; n <= totalParts; n++) {
+            if (received.has(n)) {
+                uploadedBytes += partLength(n);
+            } else {
+                pending.push(n);
+            }
+        }
+        onProgress(uploadedBytes, file.size);
+
+        // Presigned URLs are fetched in batches as the upload goes (they expire)
+        const urls = {};
+        let urlRequest = null;
+        async function urlFor(partNumber) {
+            while (!urls[partNumber]) {
+                if (!urlRequest) {
+                    const batch = [partNumber].concat(pending.slice(0, URL_BATCH - 1));
+                    urlRequest = (async () => {
+                        const body = { partNumbers: batch, uploadedBytes: uploadedBytes };
+                        if (checksumAlgorithm) {
+                            body.checksums = {};
+                            for (const n of batch) body.checksums[n] = await partChecksum(n);
+                        }
+                        return postJson(`/api/upload/direct/${uploadId}/part-urls`, body);
+                    })().then((data) => {
+                        if (!data.success) throw new Error(data.error || 'Could not get part URLs');
+                        Object.assign(urls, data.urls);
+                    }).finally(() => { urlRequest = null; });
+                }
+                await urlRequest;
+            }
+            const url = urls[partNumber];
+            delete urls[partNumber];
+            return url;
+        }
+
+        async function sendPart(partNumber) {
+            const blob = partBlob(partNumber);
+            for (let attempt = 1; ; attempt++) {
+                try {
+                    const url = await urlFor(partNumber);
+                    const checksum = checksumAlgorithm ? await partChecksum(partNumber) : null;
+                    await putPart(url, blob, (bytes) => {
+                        uploadedBytes += bytes;
+                        onProgress(uploadedBytes, file.size);
+                    }, checksum);
+                    return;
+                } catch (error) {
+                    if (attempt > MAX_PART_RETRIES) throw error;
+                    onMessage(`Part ${partNumber} failed: ${error.message} (retrying)`);
+                    await new Promise(resolve => setTimeout(resolve, 2000 * attempt));
+                }
+            }
+        }
+
+        let failed = false;
+        const worker = async () => {
+            while (pending.length && !failed) {
+                try {
+                    await sendPart(pending.shift());
+                } catch (error) {
+                    failed = true;
+                    throw error;
+                }
+            }
+        };
+        await Promise.all(Array.from({ length: Math.min(PARALLEL_PARTS, pending.length) }, () => worker()));
+
+        const result = await postJson(`/api/upload/direct/${uploadId}/complete`);
+        if (!result.success) {
+            throw new Error(result.error || 'Could not complete the upload');
+        }
+        localStorage.removeItem(sessionKey(file));
+        onProgress(file.size, file.size);
+        return Object.assign({ uploadId: uploadId }, result);
+    }
+
+    // Drop the file's unfinished upload (and the parts S3 holds), e.g. before falling back
+    async function abort(file) {
+        const uploadId = localStorage.getItem(sessionKey(file));
+        if (!uploadId) return;
+        localStorage.removeItem(sessionKey(file));
+        try {
+            await postJson(`/api/upload/direct/${uploadId}/abort`);
+        } catch (error) {
+            console.error('Could not abort direct upload:', error);
+        }
+    }
+
+    return { upload: upload, abort: abort, sessionKey: sessionKey };
+})();
@@ -71,6 +71,8 @@ def check_main_app():
     print("🔍 Checking Main Application...")
     
     try:
+        # Importing main must not start background job workers
+        os.environ.setdefault('JOB_WORKERS', '0')
         import main
         from upload_config import UploadConfig
         max_size_gb = UploadConfig.get_file_size_gb(UploadConfig.MAX_FILE_SIZE)
@@ -0,0 +1,169 @@
+"""
+Upload Checksums Module
+Incremental hashing for uploads: per-chunk checksum verification while a chunk
+is written, a whole-file content hash built from fixed size blocks (so chunks
+hashed out of order, in any worker, combine without reading the file again)
+and the expected S3 multipart ETag
+"""
+import base64
+import binascii
+import hashlib
+import zlib
+
+try:
+    import google_crc32c
+    CRC32C_ENABLED = True
+except ImportError:
+    CRC32C_ENABLED = False
+    print("google-crc32c not found. CRC32C chunk checksums will be rejected.")
+
+# The content hash is the sha256 of the sha256 digests of consecutive blocks of this size.
+# Chunked uploads can only build it when their chunk size is a multiple of it.
+HASH_BLOCK_SIZE = 5 * 1024 * 1024
+CONTENT_HASH_PREFIX = 'sha256-5m:'
+
+CHECKSUM_ALGORITHMS = ('md5', 'sha256', 'crc32', 'crc32c')
+
+
+class ChecksumError(ValueError):
+    """Checksum missing, malformed or not matching the received bytes"""
+
+
+class _Crc32:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, 'big')
+
+
+def _new_hash(algorithm):
+    if algorithm in ('md5', 'sha256'):
+        return hashlib.new(algorithm)
+    if algorithm == 'crc32':
+        return _Crc32()
+    if algorithm == 'crc32c':
+        if not CRC32C_ENABLED:
+            raise ChecksumError('crc32c checksums are not supported on this server')
+        return google_crc32c.Checksum()
+    raise ChecksumError(f'Unsupported checksum algorithm: {algorithm}')
+
+
+def _decode_checksum(value):
+    """Accept hex (any case) or base64 encoded digests"""
+    value = (value or '').strip()
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        pass
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise ChecksumError('Checksum must be hex or base64 encoded')
+
+
+class BlockHasher:
+    """sha256 of each HASH_BLOCK_SIZE block of data that starts on a block boundary"""
+
+    def __init__(self):
+        self.digests = []
+        self._current = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(HASH_BLOCK_SIZE - self._filled, len(view))
+            self._current.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == HASH_BLOCK_SIZE:
+                self._flush()
+
+    def _flush(self):
+        self.digests.append(self._current.hexdigest())
+        self._current = hashlib.sha256()
+        self._filled = 0
+
+    def finish(self):
+        """Close a trailing partial block, returns the hex digests"""
+        if self._filled:
+            self._flush()
+        return self.digests
+
+
+def content_hash(block_digests):
+    """Whole-file content hash from the block digests in file order"""
+    combined = hashlib.sha256(b''.join(bytes.fromhex(d) for d in block_digests)).hexdigest()
+    return CONTENT_HASH_PREFIX + combined
+
+
+def content_hash_of_bytes(data):
+    hasher = BlockHasher()
+    hasher.update(data)
+    return content_hash(hasher.finish())
+
+
+def multipart_etag(part_md5s):
+    """ETag S3 gives a multipart object: md5 of the part md5s, dash, part count"""
+    combined = hashlib.md5(b''.join(bytes.fromhex(m) for m in part_md5s)).hexdigest()
+    return f'{combined}-{len(part_md5s)}'
+
+
+class ChunkDigest:
+    """
+    Hashes one chunk as it streams through: md5 (the S3 part ETag), the
+    content hash blocks and, when the client sent one, its own checksum.
+    """
+
+    def __init__(self, algorithm=None, expected=None, block_aligned=True):
+        self.algorithm = (algorithm or 'sha256').lower() if expected else None
+        self.expected = _decode_checksum(expected) if expected else None
+        self._client_hash = _new_hash(self.algorithm) if self.algorithm else None
+        self._md5 = hashlib.md5()
+        self._blocks = BlockHasher() if block_aligned else None
+
+    def update(self, data):
+        self._md5.update(data)
+        if self._blocks:
+            self._blocks.update(data)
+        if self._client_hash:
+            self._client_hash.update(data)
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def block_digests(self):
+        return self._blocks.finish() if self._blocks else None
+
+    def verify(self):
+        """Raise ChecksumError if the client's checksum does not match"""
+        if self._client_hash is None:
+            return
+        if self._client_hash.digest() != self.expected:
+            raise ChecksumError(f'{self.algorithm} checksum mismatch')
+
+
+class FileDigest:
+    """Whole-file hashes of a stream written front to back"""
+
+    def __init__(self):
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5()
+        self._blocks = BlockHasher()
+
+    def update(self, data):
+        self._sha256.update(data)
+        self._md5.update(data)
+        self._blocks.update(data)
+
+    def result(self):
+        return {
+            'sha256': self._sha256.hexdigest(),
+            'md5': self._md5.hexdigest(),
+            'content_hash': content_hash(self._blocks.finish())
+        }
@@ -8,13 +8,61 @@ import threading
 from datetime import datetime
 from flask import jsonify
 
+from upload_checksums import FileDigest
+
 # Global upload status tracking
 upload_status = {}
 
+# Publishing limits: progress goes out at most every PUBLISH_INTERVAL seconds,
+# or sooner once PUBLISH_BYTES more bytes have been transferred
+PUBLISH_INTERVAL = 1.0
+PUBLISH_BYTES = 256 * 1024 * 1024
+
+
+def log_progress(tracker, event):
+    """Default sink: one console line per published progress update"""
+    if event == 'progress':
+        print(f"📊 Upload Progress - {tracker.filename}: {tracker.progress_percentage:.1f}% "
+              f"({tracker.bytes_uploaded}/{tracker.total_size} bytes) - {tracker.stage}")
+
+
+# Sinks called with (tracker, event) for every published update; event is
+# 'progress', 'stage', 'completed' or 'failed'. Other modules may append to it.
+progress_sinks = [log_progress]
+
+
+class ProgressPublisher:
+    """Rate limits progress updates of one tracker before they reach the sinks"""
+
+    def __init__(self, interval=PUBLISH_INTERVAL, min_bytes=PUBLISH_BYTES, sinks=None):
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.sinks = progress_sinks if sinks is None else sinks
+        self._last_time = 0.0
+        self._last_bytes = 0
+        self._lock = threading.Lock()
+
+    def publish(self, tracker, event='progress', force=False):
+        now = time.monotonic()
+        with self._lock:
+            due = (force or now - self._last_time >= self.interval
+                   or tracker.bytes_uploaded - self._last_bytes >= self.min_bytes)
+            if not due:
+                return False
+            self._last_time = now
+            self._last_bytes = tracker.bytes_uploaded
+        for sink in self.sinks:
+            try:
+                sink(tracker, event)
+            except Exception as e:
+                print(f"⚠️ Progress sink failed: {e}")
+        return True
+
+
 class UploadProgressTracker:
     """Track upload progress with detailed status information"""
     
-    def __init__(self, upload_id, filename, total_size):
+    def __init__(self, upload_id, filename, total_size, publisher=None):
         self.upload_id = upload_id
         self.filename = filename
         self.total_size = total_size
@@ -26,6 +74,8 @@ class UploadProgressTracker:
         self.progress_percentage = 0
         self.upload_speed = 0
         self.eta = 0
+        self.message = None
+        self.publisher = publisher or ProgressPublisher()
         
         # Initialize in global tracker
         upload_status[upload_id] = self
@@ -46,15 +96,21 @@ class UploadProgressTracker:
         
         self.status = 'uploading'
         
-        # Log progress
-        print(f"📊 Upload Progress - {self.filename}: {self.progress_percentage:.1f}% "
-              f"({self.bytes_uploaded}/{self.total_size} bytes) - {stage}")
+        # Cheap to call per chunk: only rate limited updates reach the log and other sinks
+        self.publisher.publish(self)
     
     def set_stage(self, stage, message=None):
-        """Update the current stage of upload"""
+        """
+        Update the current stage of upload. Entering a new stage is published and
+        logged right away; a new message within the same stage goes through the
+        rate limit like a progress update.
+        """
+        changed = stage != self.stage
         self.stage = stage
-        if message:
+        self.message = message
+        if message and changed:
             print(f"🔄 Upload Stage - {self.filename}: {stage} - {message}")
+        self.publisher.publish(self, 'stage', force=changed)
     
     def complete(self, final_path=None):
         """Mark upload as completed"""
@@ -63,6 +119,7 @@ class UploadProgressTracker:
         self.progress_percentage = 100
         self.final_path = final_path
         print(f"✅ Upload Completed - {self.filename}: {final_path}")
+        self.publisher.publish(self, 'completed', force=True)
     
     def fail(self, error_message):
         """Mark upload as failed"""
@@ -70,6 +127,7 @@ class UploadProgressTracker:
         self.stage = 'failed'
         self.error = error_message
         print(f"❌ Upload Failed - {self.filename}: {error_message}")
+        self.publisher.publish(self, 'failed', force=True)
     
     def get_status(self):
         """Get current upload status"""
@@ -86,18 +144,36 @@ class UploadProgressTracker:
             'upload_speed_mbps': round(self.upload_speed / (1024 * 1024), 2) if self.upload_speed > 0 else 0,
             'elapsed_time': round(elapsed_time, 1),
             'eta_seconds': round(self.eta, 1) if hasattr(self, 'eta') else 0,
+            'message': self.message,
             'error': self.error
         }
 
 class StreamingUploadWithProgress:
-    """Enhanced streaming upload with progress tracking"""
+    """
+    Enhanced streaming upload with progress tracking. The read size adapts to
+    the observed throughput: it grows while a read+write takes well under
+    TARGET_CHUNK_SECONDS and shrinks when it takes much longer.
+    """
+
+    MIN_CHUNK_SIZE = 1024 * 1024
+    MAX_CHUNK_SIZE = 64 * 1024 * 1024
+    TARGET_CHUNK_SECONDS = 0.25
     
-    def __init__(self, file_obj, upload_path, tracker, chunk_size=8*1024*1024):
+    def __init__(self, file_obj, upload_path, tracker, chunk_size=8*1024*1024, expected_sha256=None):
         self.file_obj = file_obj
         self.upload_path = upload_path
         self.tracker = tracker
-        self.chunk_size = chunk_size
+        self.chunk_size = min(max(chunk_size, self.MIN_CHUNK_SIZE), self.MAX_CHUNK_SIZE)
+        self.expected_sha256 = expected_sha256.lower() if expected_sha256 else None
     
+    def _adapt_chunk_size(self, seconds, size):
+        if size < self.chunk_size:
+            return  # short read near the end says nothing about throughput
+        if seconds < self.TARGET_CHUNK_SECONDS / 2:
+            self.chunk_size = min(self.chunk_size * 2, self.MAX_CHUNK_SIZE)
+        elif seconds > self.TARGET_CHUNK_SECONDS * 2:
+            self.chunk_size = max(self.chunk_size // 2, self.MIN_CHUNK_SIZE)
+
     def save_with_progress(self):
         """Save file with real-time progress updates"""
         try:
@@ -109,20 +185,22 @@ class StreamingUploadWithProgress:
             self.tracker.set_stage('writing_file', 'Starting file write')
             
             bytes_written = 0
+            # Hashed as it is written, so verifying costs no second read
+            digest = FileDigest()
             with open(self.upload_path, 'wb') as f:
                 while True:
+                    started = time.monotonic()
                     chunk = self.file_obj.read(self.chunk_size)
                     if not chunk:
                         break
                     
                     f.write(chunk)
+                    digest.update(chunk)
                     bytes_written += len(chunk)
                     
-                    # Update progress
+                    # Update progress (rate limited by the tracker's publisher)
                     self.tracker.update_progress(bytes_written, 'writing_file')
-                    
-                    # Add small delay to prevent overwhelming the progress tracker
-                    time.sleep(0.01)
+                    self._adapt_chunk_size(time.monotonic() - started, len(chunk))
             
             self.tracker.set_stage('verifying', 'Verifying file integrity')
             
@@ -130,6 +208,9 @@ class StreamingUploadWithProgress:
             actual_size = os.path.getsize(self.upload_path)
             if actual_size != self.tracker.total_size:
                 raise ValueError(f"File size mismatch: expected {self.tracker.total_size}, got {actual_size}")
+            hashes = digest.result()
+            if self.expected_sha256 and hashes['sha256'] != self.expected_sha256:
+                raise ValueError("File checksum mismatch: sha256 does not match the client's")
             
             self.tracker.complete(self.upload_path)
             
@@ -137,6 +218,7 @@ class StreamingUploadWithProgress:
                 'success': True,
                 'file_path': self.upload_path,
                 'bytes_written': bytes_written,
+                'hashes': hashes,
                 'upload_time': time.time() - self.tracker.start_time
             }
             
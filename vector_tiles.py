@@ -0,0 +1,255 @@
+"""
+Vector Tile Module
+Encodes audit anomalies as Mapbox Vector Tiles. Low zoom tiles carry grid
+clusters, high zoom tiles carry the individual anomalies. Unfiltered tiles are
+cached on disk per audit anomalies_version so a status change invalidates them.
+"""
+import math
+import os
+import shutil
+import uuid
+
+try:
+    import mapbox_vector_tile
+    MVT_ENABLED = True
+except ImportError:
+    MVT_ENABLED = False
+    print("mapbox-vector-tile not found. Vector tile endpoint will be disabled.")
+
+from anomaly_store import build_feature_query, CENTROID_MAX_ZOOM
+
+MVT_MIMETYPE = 'application/vnd.mapbox-vector-tile'
+
+# Tile coordinate space and layer name read by the map
+TILE_EXTENT = 4096
+TILE_LAYER = 'anomalies'
+
+# Extra margin (in tile units) so symbols on tile edges are not clipped
+TILE_BUFFER = 64
+
+# Grid cell size (in tile units) used to cluster anomalies below CENTROID_MAX_ZOOM
+CLUSTER_CELL = 256
+
+# Features smaller than this many tile units are drawn as points
+MIN_FEATURE_SIZE = 8
+
+# Supported tile grids: web mercator (standard XYZ) and the EPSG:4326 grid the audit map uses
+TILE_CRS = ('EPSG:3857', 'EPSG:4326')
+
+MAX_ZOOM = 24
+
+_MERCATOR_LAT = 85.0511287798
+
+
+def tile_bounds(z, x, y, crs='EPSG:3857'):
+    """[west, south, east, north] of an XYZ tile in degrees"""
+    n = 2 ** z
+    if crs == 'EPSG:4326':
+        # Same resolutions as an OpenLayers EPSG:4326 view: 360 degrees per tile at z0
+        size = 360.0 / n
+        west = -180 + x * size
+        north = 90 - y * size
+        return [west, north - size, west + size, north]
+    west = x / n * 360.0 - 180
+    east = (x + 1) / n * 360.0 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return [west, south, east, north]
+
+
+def is_valid_tile(z, x, y, crs):
+    """Reject tile addresses outside the grid"""
+    if crs not in TILE_CRS or z < 0 or z > MAX_ZOOM:
+        return False
+    n = 2 ** z
+    rows = n if crs == 'EPSG:3857' else max(1, n // 2)
+    return 0 <= x < n and 0 <= y < rows
+
+
+def _mercator_y(lat):
+    lat = max(min(lat, _MERCATOR_LAT), -_MERCATOR_LAT)
+    return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+
+def _make_projector(bounds, crs):
+    """Return a function mapping (lon, lat) to tile units (y pointing down)"""
+    west, south, east, north = bounds
+    scale_x = TILE_EXTENT / (east - west)
+    if crs == 'EPSG:4326':
+        scale_y = TILE_EXTENT / (north - south)
+        return lambda lon, lat: ((lon - west) * scale_x, (north - lat) * scale_y)
+    top = _mercator_y(north)
+    scale_y = TILE_EXTENT / (top - _mercator_y(south))
+    return lambda lon, lat: ((lon - west) * scale_x, (top - _mercator_y(lat)) * scale_y)
+
+
+def _query_bounds(bounds):
+    """Tile bounds grown by TILE_BUFFER so edge symbols appear in both neighbours"""
+    west, south, east, north = bounds
+    pad_x = (east - west) * TILE_BUFFER / TILE_EXTENT
+    pad_y = (north - south) * TILE_BUFFER / TILE_EXTENT
+    return [west - pad_x, south - pad_y, east + pad_x, north + pad_y]
+
+
+def _ring_wkt(ring):
+    return '(' + ', '.join(f'{x:.0f} {y:.0f}' for x, y in ring) + ')'
+
+
+def _geometry_wkt(geometry, project):
+    """WKT of a GeoJSON Point/Polygon/MultiPolygon in tile units, or None"""
+    if not geometry:
+        return None
+    gtype = geometry.get('type')
+    coords = geometry.get('coordinates')
+    try:
+        if gtype == 'Point':
+            x, y = project(coords[0], coords[1])
+            return f'POINT ({x:.0f} {y:.0f})'
+        if gtype == 'Polygon':
+            rings = [[project(p[0], p[1]) for p in ring] for ring in coords]
+            return 'POLYGON (' + ', '.join(_ring_wkt(r) for r in rings) + ')'
+        if gtype == 'MultiPolygon':
+            polygons = []
+            for polygon in coords:
+                rings = [[project(p[0], p[1]) for p in ring] for ring in polygon]
+                polygons.append('(' + ', '.join(_ring_wkt(r) for r in rings) + ')')
+            return 'MULTIPOLYGON (' + ', '.join(polygons) + ')'
+    except (TypeError, IndexError, ValueError):
+        return None
+    return None
+
+
+def _is_tiny(geometry, project):
+    """True when a polygon would cover only a few tile units at this zoom"""
+    if not geometry or geometry.get('type') == 'Point':
+        return False
+    points = []
+    polygons = geometry['coordinates'] if geometry.get('type') == 'MultiPolygon' else [geometry['coordinates']]
+    for polygon in polygons:
+        for ring in polygon[:1]:
+            points.extend(project(p[0], p[1]) for p in ring)
+    if not points:
+        return True
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return max(xs) - min(xs) < MIN_FEATURE_SIZE and max(ys) - min(ys) < MIN_FEATURE_SIZE
+
+
+def _cluster_features(records, project):
+    """Grid-cluster record centroids into one point per CLUSTER_CELL cell"""
+    cells = {}
+    for record in records:
+        lon, lat = record['location']['coordinates']
+        x, y = project(lon, lat)
+        key = (int(x // CLUSTER_CELL), int(y // CLUSTER_CELL))
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = {'count': 0, 'sum_x': 0.0, 'sum_y': 0.0, 'pending': 0, 'types': {}}
+        cell['count'] += 1
+        cell['sum_x'] += x
+        cell['sum_y'] += y
+        if record.get('resolve_status') != 'resolved':
+            cell['pending'] += 1
+        anomaly = record.get('Anomaly') or 'Unknown'
+        cell['types'][anomaly] = cell['types'].get(anomaly, 0) + 1
+
+    features = []
+    for cell in cells.values():
+        count = cell['count']
+        features.append({
+            'geometry': f"POINT ({cell['sum_x'] / count:.0f} {cell['sum_y'] / count:.0f})",
+            'properties': {
+                'count': count,
+                'pending': cell['pending'],
+                # Dominant type drives the cluster colour on the map
+                'Anomaly': max(cell['types'].items(), key=lambda item: item[1])[0],
+                'cluster': True
+            }
+        })
+    return features
+
+
+def _anomaly_features(records, project):
+    """One tile feature per anomaly, tiny polygons collapsed to their centroid"""
+    features = []
+    for record in records:
+        geometry = record.get('geometry')
+        if _is_tiny(geometry, project) or not geometry:
+            geometry = record.get('location')
+        wkt = _geometry_wkt(geometry, project)
+        if not wkt:
+            continue
+        properties = {
+            'seq': record.get('seq'),
+            'Anomaly': record.get('Anomaly') or 'Unknown',
+            'resolve_status': record.get('resolve_status') or 'pending'
+        }
+        for key, value in (('Block', record.get('Block')), ('Severity', record.get('Severity')),
+                           ('image_name', record.get('image_name')), ('recurrence', record.get('recurrence'))):
+            if value is not None and value != '':
+                properties[key] = str(value)
+        features.append({'geometry': wkt, 'properties': properties})
+    return features
+
+
+def build_tile(anomalies_collection, audit_id, z, x, y, crs='EPSG:3857', **filters):
+    """Encode one tile of an audit's anomalies, returns MVT bytes"""
+    bounds = tile_bounds(z, x, y, crs)
+    project = _make_projector(bounds, crs)
+    query = build_feature_query(audit_id, bbox=_query_bounds(bounds), **filters)
+    clustered = z < CENTROID_MAX_ZOOM
+
+    projection = {'location': 1, 'Anomaly': 1, 'resolve_status': 1}
+    if not clustered:
+        projection.update({'geometry': 1, 'seq': 1, 'Block': 1, 'Severity': 1, 'image_name': 1, 'recurrence': 1})
+    query.setdefault('location', {'$exists': True})
+    records = anomalies_collection.find(query, projection)
+
+    features = _cluster_features(records, project) if clustered else _anomaly_features(records, project)
+    return mapbox_vector_tile.encode(
+        [{'name': TILE_LAYER, 'features': features}],
+        default_options={'extents': TILE_EXTENT, 'y_coord_down': True}
+    )
+
+
+class TileCache:
+    """Disk cache of encoded tiles laid out as <root>/<audit>/v<version>/<crs>/<z>/<x>/<y>.mvt"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _audit_dir(self, audit_id):
+        return os.path.join(self.root, str(audit_id))
+
+    def _path(self, audit_id, version, crs, z, x, y):
+        return os.path.join(self._audit_dir(audit_id), f'v{version}', crs.replace(':', '_'),
+                            str(z), str(x), f'{y}.mvt')
+
+    def get(self, audit_id, version, crs, z, x, y):
+        path = self._path(audit_id, version, crs, z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, audit_id, version, crs, z, x, y, data):
+        path = self._path(audit_id, version, crs, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent workers never read a partial tile
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._drop_old_versions(audit_id, version)
+
+    def _drop_old_versions(self, audit_id, version):
+        """Remove tiles of earlier anomalies_version values (best effort)"""
+        audit_dir = self._audit_dir(audit_id)
+        for name in os.listdir(audit_dir):
+            # Only older versions: a slow worker must not delete tiles newer than its own
+            if name.startswith('v') and name[1:].isdigit() and int(name[1:]) < version:
+                shutil.rmtree(os.path.join(audit_dir, name), ignore_errors=True)
+
+    def invalidate(self, audit_id):
+        shutil.rmtree(self._audit_dir(audit_id), ignore_errors=True)
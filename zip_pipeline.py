@@ -0,0 +1,103 @@
+"""
+Zip Image Pipeline Module
+Streams the images of a zip archive to an upload function through a bounded
+producer/consumer pipeline: one entry is decompressed at a time and reading
+pauses while too many bytes are waiting to be uploaded, so memory use stays
+flat no matter how large the archive is
+"""
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+
+class ByteBudget:
+    """Blocks acquire() while more than max_bytes are held (one oversized item may always pass)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        with self._cond:
+            while self.in_use and self.in_use + size > self.max_bytes:
+                self._cond.wait()
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+
+    def release(self, size):
+        with self._cond:
+            self.in_use -= size
+            self._cond.notify_all()
+
+
+def iter_image_entries(zip_file):
+    """ZipInfo of every image entry, in archive order"""
+    for info in zip_file.infolist():
+        if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+            yield info
+
+
+def upload_zip_images(zip_path, upload_fn, key_for, workers=8, max_inflight_bytes=256 * 1024 * 1024,
+                      progress=None, progress_every=50):
+    """
+    Upload every image in the archive at zip_path with upload_fn(key, data).
+
+    key_for(entry_name) gives the destination key. progress(done, total, failed)
+    is called from the reading thread every progress_every finished uploads.
+    Returns {'total', 'uploaded', 'failed': [entry names], 'peak_inflight_bytes'}.
+    """
+    budget = ByteBudget(max_inflight_bytes)
+    lock = threading.Lock()
+    state = {'done': 0, 'uploaded': 0, 'failed': []}
+
+    def upload(name, data):
+        try:
+            upload_fn(key_for(name), data)
+            ok = True
+        except Exception as e:
+            print(f"⚠️ Zip image upload failed: {name} ({e})")
+            ok = False
+        finally:
+            budget.release(len(data))
+        with lock:
+            state['done'] += 1
+            if ok:
+                state['uploaded'] += 1
+            else:
+                state['failed'].append(name)
+
+    with zipfile.ZipFile(zip_path) as z:
+        entries = list(iter_image_entries(z))
+        total = len(entries)
+        reported = 0
+        with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='zip-upload') as executor:
+            for info in entries:
+                # Backpressure: wait for uploads to finish before decompressing more
+                budget.acquire(info.file_size)
+                try:
+                    data = z.read(info)
+                except Exception:
+                    budget.release(info.file_size)
+                    raise
+                if len(data) != info.file_size:
+                    # Release the estimate and hold the real size instead
+                    budget.release(info.file_size)
+                    budget.acquire(len(data))
+                executor.submit(upload, info.filename, data)
+                del data
+                if progress and state['done'] - reported >= progress_every:
+                    reported = state['done']
+                    progress(reported, total, len(state['failed']))
+
+    if progress:
+        progress(state['done'], total, len(state['failed']))
+    return {
+        'total': total,
+        'uploaded': state['uploaded'],
+        'failed': state['failed'],
+        'peak_inflight_bytes': budget.peak
+    }